@@ -1,36 +1,398 @@
+from itertools import islice
 from textwrap import dedent
+import json
+import os
+import re
+import threading
 
-from flask import Flask, render_template, request, jsonify
-from flask_socketio import SocketIO
+from flask import Flask, Response, abort, has_request_context, render_template, request, jsonify, url_for
+from flask_socketio import SocketIO, emit, join_room
+from werkzeug.exceptions import NotFound
 
-from todotxt import Todo
+from board import Board
+from history import RollbackFailed
+from todotxt import InvalidOperation
 
 app = Flask(__name__)
-socketio = SocketIO(app)
+app.config['TODO_FILE'] = 'todo.txt'
+# seconds to wait for more changes before writing the todo file
+app.config['WRITE_DELAY'] = 0.1
+# levels of todos the board gets with the page, deeper ones are fetched when browsing into them
+app.config['INDEX_DEPTH'] = 2
+# seconds between looking for changes others make to the todo file, e.g. in an editor, None to not look
+app.config['WATCH_INTERVAL'] = 0.5
+# directory with one <name>.txt per board, served as /boards/<name>/, None to only serve TODO_FILE
+app.config['BOARDS_DIRECTORY'] = None
+# how many boards keep their todos in memory, the least recently used ones are unloaded beyond that, None for no limit
+app.config['MAX_RESIDENT_BOARDS'] = 100
+# bytes of todo files whose todos are kept in memory, a rough measure of the memory they need, None for no limit
+app.config['MAX_RESIDENT_SIZE'] = 100 * 1024 * 1024
+# keep the parsed todos next to each todo file when unloading a board or exiting, so restarts do not parse them again
+app.config['PARSE_CACHE'] = False
+# 'threading', or 'eventlet' to serve many clients from one event loop, see server.py
+app.config['ASYNC_MODE'] = os.environ.get('TASK_TRACKER_ASYNC_MODE', 'threading')
+socketio = SocketIO(app, async_mode=app.config['ASYNC_MODE'])
+if 'eventlet' == socketio.async_mode:
+    from eventlet import tpool
+    # the event loop would stand still while waiting for the disk or for other processes
+    Board.run_blocking = staticmethod(tpool.execute)
+
+BOARD_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$')
+
+def current_board():
+    """The board the request is about, aborts with 404 if there is no such board.
+    
+    Boards are addressed by the `board_name` in the url, or the `board` query parameter of socket connections.
+    Without a name, or outside of requests, it is the one in TODO_FILE.
+    """
+    name = None
+    if has_request_context():
+        name = (request.view_args or {}).get('board_name') or request.args.get('board')
+    path = app.config['TODO_FILE'] if name is None else board_path(name)
+    if path is None:
+        abort(404, f'no board named {name}')
+    
+    Board.unload_least_recently_used(max_boards=app.config['MAX_RESIDENT_BOARDS'], max_size=app.config['MAX_RESIDENT_SIZE'])
+    board = Board.for_path(path, write_delay=app.config['WRITE_DELAY'], on_external_change=broadcast_external_change,
+        on_unload=stop_watching, parse_cache=app.config['PARSE_CACHE'])
+    watch(board) # again, if it was unloaded while clients look at it
+    return board
+
+def board_path(name):
+    "The file of the board with that name, None if there is no such board."
+    directory = app.config['BOARDS_DIRECTORY']
+    if directory is None or not BOARD_NAME.match(name):
+        return None
+    path = os.path.join(directory, f'{name}.txt')
+    if not os.path.isfile(path):
+        return None
+    return path
+
+def room_of(board):
+    "Every client looking at a board is in its room, so changes only go to those who need them."
+    return board.path
+
+def broadcast_external_change(board, changed):
+    "Changes others made to the todo file reach the clients as a delta, or as reason to reload if it was replaced."
+    broadcast_tree_change(board, changed)
+    broadcast_text(board)
+
+def broadcast_tree_change(board, changed):
+    if changed is None:
+        socketio.emit('reload', dict(), to=room_of(board))
+    else:
+        socketio.emit('delta', board.task.delta_json(changed), to=room_of(board))
+
+def broadcast_text(board):
+    "Clients editing the text get changes to the tree as text operations, see Board.sync_text()."
+    synced = board.sync_text()
+    if synced is not None:
+        revision, operation = synced
+        socketio.emit('text_operation', dict(revision=revision, operation=operation), to=room_of(board))
+
+_clients = dict() # path of a board -> sids of the socket clients looking at it
+_watchers = dict() # path of a board -> token of the watch_file() task that looks for changes to it
+_watchers_lock = threading.Lock()
+
+def add_client(board, sid):
+    with _watchers_lock:
+        _clients.setdefault(board.path, set()).add(sid)
+    watch(board)
+
+def remove_client(sid):
+    "Stops watching the boards that no client looks at anymore."
+    with _watchers_lock:
+        for path, sids in list(_clients.items()):
+            sids.discard(sid)
+            if not sids:
+                del _clients[path]
+                _watchers.pop(path, None)
+
+def watch(board):
+    """Starts looking for changes to the file of the board in the background, once per board.
+    
+    Only while clients look at it and it is loaded, see `stop_watching()`.
+    """
+    interval = app.config['WATCH_INTERVAL']
+    if interval is None:
+        return
+    with _watchers_lock:
+        if board.path in _watchers or board.path not in _clients:
+            return
+        token = _watchers[board.path] = object()
+    socketio.start_background_task(watch_file, board, interval, token)
+
+def stop_watching(board):
+    "Its watch_file() task ends after the current interval."
+    with _watchers_lock:
+        _watchers.pop(board.path, None)
+
+def is_watching(board, token):
+    with _watchers_lock:
+        return _watchers.get(board.path) is token
+
+def watch_file(board, interval, token):
+    """Applies the changes others make to the file of the board, see Board.follow_file(), until told to stop.
+    
+    Polls, as the change notifications of each platform would need another dependency, and a stat() is cheap.
+    Editors often write a file several times when saving it, so changes are only applied once the file
+    stayed the same for one interval, which also keeps the board from being parsed again for each write.
+    """
+    last_signature = board.file_signature()
+    while True:
+        socketio.sleep(interval)
+        if not is_watching(board, token):
+            return
+        signature = board.file_signature()
+        if signature != last_signature or signature is None:
+            last_signature = signature
+            continue
+        try:
+            board.follow_file()
+        except Exception:
+            app.logger.exception('could not follow the changes to %s', board.path)
+
+def apply_operations(board, operations):
+    "Applies and saves the operations, returns the delta_json() of everything they changed."
+    return change_board(board, lambda history, task: history.apply(task, operations))
+
+def change_board(board, change):
+    """Runs change(history, task) and saves the board, returns the delta_json() of the todos it returns.
+    
+    A failed change is rolled back by the history, only if that fails too the board is reloaded.
+    """
+    with board.lock:
+        task = board.task
+        try:
+            changed = change(board.history, task)
+        except RollbackFailed:
+            board.invalidate()
+            raise
+        
+        # before saving, so a change can not be saved without telling the clients about it
+        delta = task.delta_json(changed)
+        board.save()
+        broadcast_text(board)
+        return delta
 
 @app.route('/', methods=['GET'])
-def index():
-    task = Todo.from_lines(open('todo.txt', encoding='utf8').read())
-    return render_template('index.html', task=task)
+@app.route('/boards/<board_name>/', methods=['GET'])
+def index(board_name=None):
+    board = current_board()
+    with board.lock:
+        task = board.task
+        return render_template('index.html', task_json=task.to_json(depth=app.config['INDEX_DEPTH']),
+            board_name=board_name, api_url=url_for('todos', board_name=board_name))
 
 @app.route('/api/v1/todos', methods=['GET', 'POST'])
-def todos():
-    task = Todo.from_lines(open('todo.txt', encoding='utf8').read())
-    if 'POST' == request.method:
-        task.json = request.json
-        with open('todo.txt', encoding='utf8', mode='w') as f:
-            f.write(str(task))
-    return jsonify(dict(json=task.json, txt=str(task)))
+@app.route('/api/v1/boards/<board_name>/todos', methods=['GET', 'POST'])
+def todos(board_name=None):
+    """The whole board as json and text.
+    
+    GET accepts `root=<uuid>` to get only that subtree and `depth=<levels>` to limit how many levels
+    of children are included, see `Todo.to_json()`. The text is only included for the whole board then.
+    POST replaces the board with the json, and answers 400 if it is malformed.
+    """
+    board = current_board()
+    with board.lock:
+        task = board.task
+        if 'GET' == request.method and ('root' in request.args or 'depth' in request.args):
+            root = requested_subtree(task)
+            if root is None:
+                return jsonify(dict(error=f'no task with uuid {request.args["root"]}')), 404
+            depth = request.args.get('depth', type=int)
+            return jsonify(dict(json=root.to_json(depth=depth)))
+        
+        if 'POST' == request.method:
+            board_json = request.get_json(silent=True)
+            if not isinstance(board_json, dict):
+                return jsonify(dict(error='the board has to be a json object')), 400
+            # a failed change leaves the tree in an unknown state, without unwritten changes it is simply read again
+            board.flush()
+            try:
+                task.json = board_json
+            except (AttributeError, InvalidOperation, KeyError, TypeError, ValueError) as error:
+                board.invalidate()
+                return jsonify(dict(error=str(error))), 400
+            except Exception:
+                board.invalidate()
+                raise
+            board.history.reset() # the logged operations do not fit the new tree
+            board.save()
+            broadcast_tree_change(board, None) # every todo got a new uuid
+            broadcast_text(board)
+        return jsonify(dict(json=task.json, txt=str(task)))
+
+@app.route('/api/v1/todos.ndjson', methods=['GET'])
+@app.route('/api/v1/boards/<board_name>/todos.ndjson', methods=['GET'])
+def todos_ndjson(board_name=None):
+    """The board as newline delimited json, one todo per line in file order, see `Todo.iter_flat_json()`.
+    
+    Streamed in chunks, each generated only when the previous one was sent, so neither the server nor the client
+    needs to hold all of it. Each chunk is generated while holding the lock of the board, but the lock is released
+    while sending it, so a slow download does not hold up changes. So the stream is not a snapshot: the todos of a
+    chunk are as they were when it was generated, todos deleted before their chunk are left out, todos moved
+    while streaming can show up at their old place (with their new parent), at both places, or at neither, and after the board
+    was replaced or reloaded the rest of the stream is the tree from before. Clients in the room of the board get
+    the delta or reload of each of these changes, and apply them after the stream to catch up.
+    Accepts `root` and `depth` like GET /api/v1/todos.
+    """
+    board = current_board()
+    with board.lock:
+        root = requested_subtree(board.task)
+        if root is None:
+            return jsonify(dict(error=f'no task with uuid {request.args["root"]}')), 404
+    
+    return Response(ndjson_chunks(board, root, request.args.get('depth', type=int)), mimetype='application/x-ndjson')
+
+def requested_subtree(task):
+    "The task addressed by the `root` uuid of the request, or the whole board, None if there is no such task."
+    if 'root' not in request.args:
+        return task
+    return task.task_by_uuid(request.args['root'])
+
+def ndjson_chunks(board, root, depth, todos_per_chunk=500):
+    "Resumes iter_flat_json() under the lock of the board for each chunk, and yields it after releasing the lock."
+    todos = root.iter_flat_json(depth=depth)
+    while True:
+        with board.lock:
+            chunk = ''.join(json.dumps(todo_json) + '\n' for todo_json in islice(todos, todos_per_chunk))
+        if not chunk:
+            return
+        yield chunk
+
+@app.route('/api/v1/todos/search', methods=['GET'])
+@app.route('/api/v1/boards/<board_name>/todos/search', methods=['GET'])
+def search(board_name=None):
+    """The todos matching all given criteria, in file order, see `Todo.query()`.
+    
+    E.g. `?status=doing&context=martin&root_id=12` are the tasks martin is working on in story #12.
+    `context`, `project` and `tag` can be given several times, tags as `key:value`, or `key:` for any value.
+    `root` (a uuid) or `root_id` restrict the search to a subtree. With `inherited=1`, contexts, projects and tags
+    also match if they are inherited from the tasks above. Each todo has what it inherits as `inherited`.
+    """
+    tags = dict()
+    for tag in request.args.getlist('tag'):
+        key, _, value = tag.partition(':')
+        tags[key] = value or None
+    
+    board = current_board()
+    with board.lock:
+        task = board.task
+        if 'root_id' in request.args:
+            root = task.task_by_id(request.args['root_id'])
+        else:
+            root = requested_subtree(task)
+        if root is None:
+            return jsonify(dict(error='no such root task')), 404
+        
+        todos = root.query(
+            status=request.args.get('status'),
+            contexts=request.args.getlist('context'),
+            projects=request.args.getlist('project'),
+            tags=tags,
+            id=request.args.get('id'),
+            inherited=request.args.get('inherited', False, type=bool_argument),
+        )
+        return jsonify(dict(todos=[dict(todo.shallow_json, inherited=todo.inherited_json) for todo in todos]))
+
+def bool_argument(value):
+    return value.lower() in ('1', 'true', 'yes')
+
+@app.route('/api/v1/todos/operations', methods=['POST'])
+@app.route('/api/v1/boards/<board_name>/todos/operations', methods=['POST'])
+def operations(board_name=None):
+    """Applies a batch of operations and answers with only the todos they changed.
+    
+    Expects `{"operations": [{"action": "set_status", "uuid": "…", "status": "doing"}, …]}`,
+    see `Todo.on_operation()` for the supported actions.
+    Nothing is saved if any of the operations fails. The batch can be undone with POST /api/v1/todos/undo.
+    """
+    return broadcast_change(lambda history, task: history.apply(task, request.json['operations']))
+
+@app.route('/api/v1/todos/undo', methods=['POST'])
+@app.route('/api/v1/boards/<board_name>/todos/undo', methods=['POST'])
+def undo(board_name=None):
+    "Reverts the last batch of operations on the board, no matter who made it, and answers with the delta."
+    return broadcast_change(lambda history, task: history.undo(task))
+
+@app.route('/api/v1/todos/redo', methods=['POST'])
+@app.route('/api/v1/boards/<board_name>/todos/redo', methods=['POST'])
+def redo(board_name=None):
+    "Applies the last undone batch of operations again and answers with the delta."
+    return broadcast_change(lambda history, task: history.redo(task))
+
+def broadcast_change(change):
+    board = current_board()
+    try:
+        delta = change_board(board, change)
+    except (InvalidOperation, KeyError, TypeError, ValueError) as error:
+        return jsonify(dict(error=str(error))), 400
+    
+    socketio.emit('delta', delta, to=room_of(board))
+    return jsonify(delta)
 
 """
 https://flask-socketio.readthedocs.io/en/latest/
 
 Login: need to be authenticated against the webapp, protect via decorator
-Later: Multi-User: each user talks to a 'pad' url that represents one taskboard, use rooms to organize this
+Multi-User: each user talks to a 'pad' url that represents one taskboard, see BOARDS_DIRECTORY, its clients share a room
 """
+@socketio.on('connect')
+def connect(auth=None):
+    try:
+        board = current_board()
+    except NotFound:
+        return False
+    join_room(room_of(board))
+    add_client(board, request.sid)
+
+@socketio.on('disconnect')
+def disconnect(reason=None):
+    remove_client(request.sid)
+
 @socketio.on('update_todo')
 def update_todo(json):
-    print('received json: ' + str(json))
+    """Applies one operation, e.g. `{action: 'add_child', uuid, child}`, see `Todo.on_operation()`.
+    
+    The other clients on the board get only the resulting delta, the sender gets it as acknowledgement.
+    """
+    try:
+        board = current_board()
+        delta = apply_operations(board, [json])
+    except (InvalidOperation, KeyError, TypeError, ValueError, NotFound) as error:
+        return dict(error=str(error))
+    
+    emit('delta', delta, to=room_of(board), include_self=False)
+    return delta
+
+@socketio.on('get_text')
+def get_text(json=None):
+    "The text of the board and its revision, to base edit_text operations on."
+    board = current_board()
+    with board.lock:
+        document = board.text_document
+        return dict(revision=document.revision, text=document.text)
+
+@socketio.on('edit_text')
+def edit_text(json):
+    """Applies `{revision, operation}` to the text of the board, see textdocument.py, and answers with the new revision.
+    
+    The other clients editing the text get the operation as it was applied, everyone gets the delta of the tree.
+    If the tree reads differently than the text, everyone, the sender too, gets the operation that corrects the text.
+    """
+    try:
+        board = current_board()
+        with board.lock:
+            revision, operation, changed, correction = board.edit_text(json['revision'], json['operation'])
+            emit('text_operation', dict(revision=revision, operation=operation), to=room_of(board), include_self=False)
+            if correction is not None:
+                correction_revision, correction_operation = correction
+                emit('text_operation', dict(revision=correction_revision, operation=correction_operation), to=room_of(board))
+            broadcast_tree_change(board, changed)
+    except (InvalidOperation, KeyError, TypeError, ValueError, NotFound) as error:
+        return dict(error=str(error))
+    return dict(revision=revision)
 
 if __name__ == '__main__':
     socketio.run(app)
@@ -0,0 +1,522 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, mock
+import json
+import os
+import tempfile
+import time
+
+from pyexpect import expect
+
+from app import app, current_board, socketio
+from board import Board
+
+class TemporaryBoardTestCase(TestCase):
+    
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'todo.txt')
+        with open(self.path, mode='w', encoding='utf8') as f:
+            f.write('first #1\n    child #2\nsecond #3')
+        
+        app.config['TODO_FILE'] = self.path
+        self.addCleanup(app.config.__setitem__, 'TODO_FILE', 'todo.txt')
+        app.config['WATCH_INTERVAL'] = None
+        self.addCleanup(app.config.__setitem__, 'WATCH_INTERVAL', 0.5)
+        self.addCleanup(lambda: current_board().unload())
+        self.client = app.test_client()
+    
+    def read(self):
+        current_board().flush()
+        with open(self.path, encoding='utf8') as f:
+            return f.read()
+    
+    def get_json(self):
+        return self.client.get('/api/v1/todos').json['json']
+
+class TodosAPITest(TemporaryBoardTestCase):
+    
+    def test_applies_operations_and_returns_only_changed_todos(self):
+        first, second = self.get_json()['children']
+        response = self.client.post('/api/v1/todos/operations', json=dict(operations=[
+            dict(action='set_status', uuid=first['children'][0]['uuid'], status='doing'),
+            dict(action='add_child', uuid=second['uuid'], child=dict(line='new child')),
+        ]))
+        
+        expect(response.status_code) == 200
+        expect(self.read()) == 'first #1\n    child #2 status:doing\nsecond #3\n    new child'
+        changed = response.json['changed']
+        expect([each['uuid'] for each in changed[:2]]) == [first['children'][0]['uuid'], second['uuid']]
+        expect(changed[0]).has_subdict(status='doing', parent=first['uuid'])
+        expect(changed[2]).has_subdict(line='    new child', parent=second['uuid'])
+        expect(response.json['deleted']) == []
+    
+    def test_uuids_stay_valid_across_requests(self):
+        before = self.get_json()
+        expect(self.get_json()) == before
+        
+        response = self.client.post('/api/v1/todos/operations', json=dict(operations=[
+            dict(action='delete', uuid=before['children'][1]['uuid']),
+        ]))
+        expect(response.json['deleted']) == [before['children'][1]['uuid']]
+        expect(self.get_json()['children'][0]['uuid']) == before['children'][0]['uuid']
+    
+    def test_notices_changes_to_the_file(self):
+        before = self.get_json()
+        with open(self.path, mode='w', encoding='utf8') as f:
+            f.write('first #1\n    child #2\nsecond #3 status:doing')
+        
+        after = self.get_json()
+        expect(after['children'][1]).has_subdict(uuid=before['children'][1]['uuid'], status='doing')
+        
+        with open(self.path, mode='w', encoding='utf8') as f:
+            f.write('changed in an editor')
+        
+        expect(self.get_json()['line']) == 'changed in an editor'
+        expect(self.get_json()['uuid']) != before['uuid']
+    
+    def test_does_not_save_anything_if_an_operation_fails(self):
+        first, second = self.get_json()['children']
+        response = self.client.post('/api/v1/todos/operations', json=dict(operations=[
+            dict(action='delete', uuid=second['uuid']),
+            dict(action='explode', uuid=first['uuid']),
+        ]))
+        
+        expect(response.status_code) == 400
+        expect(response.json['error']).contains('explode')
+        expect(self.read()) == 'first #1\n    child #2\nsecond #3'
+    
+    def test_a_malformed_board_keeps_the_changes_before_it(self):
+        second = self.get_json()['children'][1]
+        response = self.client.post('/api/v1/todos/operations', json=dict(operations=[
+            dict(action='set_status', uuid=second['uuid'], status='doing')]))
+        expect(response.status_code) == 200
+        
+        for malformed in [dict(children=['not a todo']), dict(line=5), ['not a board']]:
+            expect(self.client.post('/api/v1/todos', json=malformed).status_code) == 400
+        expect(self.client.post('/api/v1/todos', data='not json').status_code) == 400
+        expect(self.read()) == 'first #1\n    child #2\nsecond #3 status:doing'
+        expect(self.get_json()['children'][1]['uuid']) == second['uuid']
+    
+    def test_rolls_back_failed_operations_without_changing_uuids(self):
+        before = self.get_json()
+        self.client.post('/api/v1/todos/operations', json=dict(operations=[
+            dict(action='delete', uuid=before['children'][0]['uuid']),
+            dict(action='explode', uuid=before['uuid']),
+        ]))
+        expect(self.get_json()) == before
+    
+    def test_undoes_and_redoes_operations(self):
+        before = self.get_json()
+        first, second = before['children']
+        self.client.post('/api/v1/todos/operations', json=dict(operations=[
+            dict(action='delete', uuid=first['uuid']),
+            dict(action='set_status', uuid=second['uuid'], status='done'),
+        ]))
+        
+        response = self.client.post('/api/v1/todos/undo')
+        expect(response.status_code) == 200
+        expect(self.read()) == 'first #1\n    child #2\nsecond #3'
+        expect(self.get_json()) == before
+        expect([each['uuid'] for each in response.json['changed']]).contains(first['uuid'], second['uuid'])
+        
+        self.client.post('/api/v1/todos/redo')
+        expect(self.read()) == 'x second #3'
+        expect(self.client.post('/api/v1/todos/redo').status_code) == 400
+    
+    def test_rejects_malformed_operations(self):
+        first, second = self.get_json()['children']
+        for operation in ['nonsense', dict(action='edit_line', uuid=second['uuid'], line='two\nlines'),
+                dict(action='change_tag', uuid=second['uuid'], tags=dict(k='a\n    x injected')),
+                dict(action='set_status', uuid=second['uuid'], status='doing\n    x injected')]:
+            response = self.client.post('/api/v1/todos/operations', json=dict(operations=[operation]))
+            expect(response.status_code) == 400
+        expect(self.read()) == 'first #1\n    child #2\nsecond #3'
+    
+    def test_a_failed_move_keeps_the_task(self):
+        first, second = self.get_json()['children']
+        child = first['children'][0]
+        response = self.client.post('/api/v1/todos/operations', json=dict(operations=[
+            dict(action='move', uuid=child['uuid'], parent=second['uuid'], index='x'),
+        ]))
+        expect(response.status_code) == 400
+        expect(self.read()) == 'first #1\n    child #2\nsecond #3'
+        expect(self.get_json()['children'][0]['children'][0]['uuid']) == child['uuid']
+    
+    def test_accepts_lines_that_refer_to_other_tasks(self):
+        first, second = self.get_json()['children']
+        response = self.client.post('/api/v1/todos/operations', json=dict(operations=[
+            dict(action='edit_line', uuid=second['uuid'], line='second #3 blocked by #1 and #2'),
+            dict(action='add_child', uuid=first['uuid'], child=dict(line='after #1 and #3')),
+        ]))
+        
+        expect(response.status_code) == 200
+        expect(response.json['changed'][0]).has_subdict(id='3')
+        expect(self.client.get('/').status_code) == 200
+        expect(self.get_json()['children'][1]['id']) == '3'
+    
+    def test_rejects_unknown_uuids(self):
+        response = self.client.post('/api/v1/todos/operations', json=dict(operations=[
+            dict(action='delete', uuid='not a uuid'),
+        ]))
+        expect(response.status_code) == 400
+    
+    def test_fetches_subtrees_up_to_a_depth(self):
+        first = self.get_json()['children'][0]
+        response = self.client.get('/api/v1/todos', query_string=dict(depth=1))
+        expect(response.json).not_has_key('txt')
+        expect([child['children'] for child in response.json['json']['children']]) == [[], []]
+        expect([child['child_count'] for child in response.json['json']['children']]) == [1, 0]
+        
+        response = self.client.get('/api/v1/todos', query_string=dict(root=first['uuid'], depth=1))
+        expect(response.json['json']).has_subdict(uuid=first['uuid'], line='first #1', child_count=1)
+        expect(response.json['json']['children'][0]).has_subdict(line='    child #2', children=[])
+        
+        response = self.client.get('/api/v1/todos', query_string=dict(root=first['uuid']))
+        expect(response.json['json']) == first
+    
+    def test_fetching_an_unknown_subtree_is_not_found(self):
+        response = self.client.get('/api/v1/todos', query_string=dict(root='not a uuid'))
+        expect(response.status_code) == 404
+    
+    def test_streams_the_board_as_ndjson(self):
+        board = self.get_json()
+        response = self.client.get('/api/v1/todos.ndjson')
+        expect(response.is_streamed).is_true()
+        expect(response.mimetype) == 'application/x-ndjson'
+        
+        todos = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        expect([(todo.get('line'), todo['depth']) for todo in todos]) == [
+            (None, 0), ('first #1', 1), ('    child #2', 2), ('second #3', 1)]
+        expect(todos[2]).has_subdict(parent=board['children'][0]['uuid'])
+        
+        response = self.client.get('/api/v1/todos.ndjson', query_string=dict(root=board['children'][0]['uuid'], depth=0))
+        expect(response.get_data(as_text=True).count('\n')) == 1
+        expect(self.client.get('/api/v1/todos.ndjson', query_string=dict(root='not a uuid')).status_code) == 404
+    
+    def test_does_not_hold_the_board_while_streaming(self):
+        response = self.client.get('/api/v1/todos.ndjson', buffered=False)
+        chunks = response.iter_encoded()
+        expect(next(chunks)).contains(b'first #1')
+        
+        board = current_board()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            expect(executor.submit(board.lock.acquire, timeout=1).result()).is_true()
+            executor.submit(board.lock.release).result()
+        response.close()
+    
+    def test_generates_each_chunk_only_when_it_is_sent(self):
+        with open(self.path, mode='w', encoding='utf8') as f:
+            f.write('\n'.join(f'task #{number}' for number in range(1, 1201)))
+        last = self.get_json()['children'][-1]
+        
+        response = self.client.get('/api/v1/todos.ndjson', buffered=False)
+        chunks = response.iter_encoded()
+        expect(next(chunks)).contains(b'"task #1"')
+        # a response that was generated before sending its first chunk would not know about this
+        self.client.post('/api/v1/todos/operations', json=dict(operations=[
+            dict(action='set_status', uuid=last['uuid'], status='done'),
+        ]))
+        rest = b''.join(chunks).decode('utf8')
+        response.close()
+        
+        todos = [json.loads(line) for line in rest.splitlines()]
+        expect(todos[-1]).has_subdict(uuid=last['uuid'], line='x task #1200', is_done=True)
+    
+    def test_leaves_out_todos_deleted_while_streaming(self):
+        with open(self.path, mode='w', encoding='utf8') as f:
+            f.write('\n'.join(f'task #{number}' for number in range(1, 1201)))
+        *_, before, deleted = self.get_json()['children']
+        
+        response = self.client.get('/api/v1/todos.ndjson', buffered=False)
+        chunks = response.iter_encoded()
+        next(chunks)
+        self.client.post('/api/v1/todos/operations', json=dict(operations=[dict(action='delete', uuid=deleted['uuid'])]))
+        rest = b''.join(chunks).decode('utf8')
+        response.close()
+        
+        uuids = [json.loads(line)['uuid'] for line in rest.splitlines()]
+        expect(uuids[-1]) == before['uuid']
+        expect(uuids).not_contains(deleted['uuid'])
+    
+    def test_searches_the_board(self):
+        with open(self.path, mode='w', encoding='utf8') as f:
+            f.write('story #12\n    first @martin status:doing\n    second @martin sprint:3\nstory #13 +release owner:dwt\n    third @martin status:doing')
+        
+        search = lambda **query: self.client.get('/api/v1/todos/search', query_string=query)
+        lines = lambda response: [todo['line'].strip() for todo in response.json['todos']]
+        expect(lines(search(status='doing', context='martin'))) == ['first @martin status:doing', 'third @martin status:doing']
+        expect(lines(search(status='doing', context='martin', root_id=12))) == ['first @martin status:doing']
+        expect(lines(search(tag='sprint:'))) == ['second @martin sprint:3']
+        expect(lines(search(tag=['sprint:3', 'nothing:here']))) == []
+        
+        response = search(id=13)
+        expect(response.json['todos'][0]).has_subdict(line='story #13 +release owner:dwt', child_count=1)
+        expect(search(root_id=99).status_code) == 404
+        
+        response = search(project='release', inherited='1')
+        expect(lines(response)) == ['story #13 +release owner:dwt', 'third @martin status:doing']
+        expect(response.json['todos'][1]['inherited']) == dict(contexts=['martin'], projects=['release'], tags=dict(owner='dwt', status='doing'))
+        expect(lines(search(project='release'))) == ['story #13 +release owner:dwt']
+    
+    def test_board_page_only_includes_the_first_levels(self):
+        app.config['INDEX_DEPTH'] = 1
+        self.addCleanup(app.config.__setitem__, 'INDEX_DEPTH', 2)
+        
+        page = self.client.get('/').get_data(as_text=True)
+        script = page[page.index('const taskJSON'):]
+        expect(script).contains('first #1')
+        expect(script[:script.index('\n')]).not_contains('child #2')
+        expect(page).not_contains('child #2') # the text is fetched by the text editor
+    
+    def test_concurrent_changes_are_written_together_and_none_is_lost(self):
+        root_uuid = self.get_json()['uuid']
+        board = current_board()
+        
+        def add_child(number):
+            return app.test_client().post('/api/v1/todos/operations', json=dict(operations=[
+                dict(action='add_child', uuid=root_uuid, child=dict(line=f'concurrent #{100 + number}')),
+            ])).status_code
+        
+        with mock.patch.object(board, '_write', wraps=board._write) as write:
+            with ThreadPoolExecutor(max_workers=20) as executor:
+                status_codes = list(executor.map(add_child, range(300)))
+            board.flush()
+        
+        expect(set(status_codes)) == {200}
+        lines = self.read().split('\n')
+        expect(lines[:3]) == ['first #1', '    child #2', 'second #3']
+        expect(sorted(lines[3:])) == sorted(f'concurrent #{100 + number}' for number in range(300))
+        expect(write.call_count) < 300
+
+class UpdateTodoSocketTest(TemporaryBoardTestCase):
+    
+    def setUp(self):
+        super().setUp()
+        self.sender = socketio.test_client(app)
+        self.viewer = socketio.test_client(app)
+        self.addCleanup(self.sender.disconnect)
+        self.addCleanup(self.viewer.disconnect)
+    
+    def deltas(self, client):
+        return [each['args'][0] for each in client.get_received() if 'delta' == each['name']]
+    
+    def test_applies_the_operation_and_acknowledges_with_the_delta(self):
+        first, second = self.get_json()['children']
+        delta = self.sender.emit('update_todo', dict(action='add_child', uuid=second['uuid'],
+            child=dict(uuid='c0ffee00-0000-4000-8000-000000000000', line='new child')), callback=True)
+        
+        expect(self.read()) == 'first #1\n    child #2\nsecond #3\n    new child'
+        expect([each['uuid'] for each in delta['changed']]) == [second['uuid'], 'c0ffee00-0000-4000-8000-000000000000']
+        expect(delta['changed'][0]['child_uuids']) == ['c0ffee00-0000-4000-8000-000000000000']
+        expect(self.get_json()['children'][0]['uuid']) == first['uuid']
+    
+    def test_broadcasts_only_the_delta_to_the_other_clients(self):
+        first, second = self.get_json()['children']
+        delta = self.sender.emit('update_todo', dict(action='set_status', uuid=second['uuid'], status='doing'), callback=True)
+        
+        expect(self.deltas(self.viewer)) == [delta]
+        expect(self.deltas(self.sender)) == []
+        expect(delta['changed']).has_len(1)
+    
+    def test_answers_errors_to_the_sender_only(self):
+        answer = self.sender.emit('update_todo', dict(action='delete', uuid='not a uuid'), callback=True)
+        
+        expect(answer).has_key('error')
+        expect(self.sender.emit('update_todo', 'not an operation', callback=True)).has_key('error')
+        expect(self.deltas(self.viewer)) == []
+        expect(self.read()) == 'first #1\n    child #2\nsecond #3'
+    
+    def test_changes_through_the_http_api_reach_all_clients(self):
+        first, second = self.get_json()['children']
+        response = self.client.post('/api/v1/todos/operations', json=dict(operations=[
+            dict(action='delete', uuid=first['uuid']),
+        ]))
+        
+        expect(self.deltas(self.sender)) == [response.json]
+        expect(self.deltas(self.viewer)) == [response.json]
+    
+    def test_replacing_the_board_makes_all_clients_reload(self):
+        board = self.get_json()
+        board['children'][1]['line'] = 'replaced #3'
+        response = self.client.post('/api/v1/todos', json=board)
+        expect(response.status_code) == 200
+        
+        for client in [self.sender, self.viewer]:
+            expect([each['name'] for each in client.get_received()]).contains('reload')
+    
+    def test_clients_of_other_boards_are_not_bothered(self):
+        other_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(other_directory.cleanup)
+        other_path = os.path.join(other_directory.name, 'todo.txt')
+        with open(other_path, mode='w', encoding='utf8') as f:
+            f.write('other board')
+        app.config['TODO_FILE'] = other_path
+        other = socketio.test_client(app)
+        self.addCleanup(other.disconnect)
+        app.config['TODO_FILE'] = self.path
+        
+        second = self.get_json()['children'][1]
+        self.sender.emit('update_todo', dict(action='set_status', uuid=second['uuid'], status='done'), callback=True)
+        
+        expect(self.deltas(self.viewer)).has_len(1)
+        expect(self.deltas(other)) == []
+
+    def test_pushes_changes_made_in_an_editor(self):
+        app.config['WATCH_INTERVAL'] = 0.01
+        watcher = socketio.test_client(app)
+        self.addCleanup(watcher.disconnect)
+        second = self.get_json()['children'][1]
+        with open(self.path, mode='w', encoding='utf8') as f:
+            f.write('first #1\n    child #2\nsecond #3 status:doing')
+        
+        deadline = time.monotonic() + 5
+        deltas = []
+        while not deltas and time.monotonic() < deadline:
+            time.sleep(0.01)
+            deltas = self.deltas(self.viewer)
+        
+        expect(deltas).has_len(1)
+        expect(deltas[0]['changed'][0]).has_subdict(uuid=second['uuid'], status='doing')
+        
+        with open(self.path, mode='w', encoding='utf8') as f:
+            f.write('one task only')
+        while 'reload' not in [each['name'] for each in self.viewer.get_received()] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        expect(time.monotonic()) < deadline
+
+class EditTextSocketTest(UpdateTodoSocketTest):
+    
+    def received(self, client, name):
+        return [each['args'][0] for each in client.get_received() if name == each['name']]
+    
+    def test_edits_the_text_together(self):
+        state = self.sender.emit('get_text', callback=True)
+        expect(state['text']) == 'first #1\n    child #2\nsecond #3'
+        second = self.get_json()['children'][1]
+        
+        answer = self.sender.emit('edit_text', dict(revision=state['revision'], operation=[31, ' status:doing']), callback=True)
+        expect(answer) == dict(revision=state['revision'] + 1)
+        expect(self.read()) == 'first #1\n    child #2\nsecond #3 status:doing'
+        
+        received = self.viewer.get_received()
+        text_operations = [each['args'][0] for each in received if 'text_operation' == each['name']]
+        expect(text_operations) == [dict(revision=answer['revision'], operation=[31, ' status:doing'])]
+        deltas = [each['args'][0] for each in received if 'delta' == each['name']]
+        expect(deltas[0]['changed'][0]).has_subdict(uuid=second['uuid'], status='doing')
+    
+    def test_changes_to_the_board_reach_the_text(self):
+        revision = self.viewer.emit('get_text', callback=True)['revision']
+        second = self.get_json()['children'][1]
+        self.sender.emit('update_todo', dict(action='set_status', uuid=second['uuid'], status='done'), callback=True)
+        
+        expect(self.received(self.viewer, 'text_operation')) == [dict(revision=revision + 1, operation=[22, 'x ', 9])]
+    
+    def test_edits_lines_that_refer_to_other_tasks(self):
+        revision = self.sender.emit('get_text', callback=True)['revision']
+        answer = self.sender.emit('edit_text', dict(revision=revision, operation=[31, ' after #1']), callback=True)
+        
+        expect(answer) == dict(revision=revision + 1)
+        expect(self.received(self.viewer, 'delta')[0]['changed'][0]).has_subdict(id='3', line='second #3 after #1')
+        expect(self.get_json()['children'][1]['id']) == '3'
+    
+    def test_answers_errors_to_the_sender_only(self):
+        answer = self.sender.emit('edit_text', dict(revision=0, operation=[3]), callback=True)
+        
+        expect(answer).has_key('error')
+        expect(self.viewer.get_received()) == []
+
+    def test_corrects_the_text_of_everyone_if_the_tree_reads_differently(self):
+        revision = self.sender.emit('get_text', callback=True)['revision']
+        # as if the line could be edited in place, which indents it by whole levels
+        with mock.patch('textdocument.is_indented_by_levels', return_value=True):
+            answer = self.sender.emit('edit_text', dict(revision=revision, operation=[9, ' ', 22]), callback=True)
+        
+        correction = dict(revision=answer['revision'] + 1, operation=[13, -1, 18])
+        expect(self.received(self.sender, 'text_operation')) == [correction]
+        expect(self.received(self.viewer, 'text_operation')) == [dict(revision=answer['revision'], operation=[9, ' ', 22]), correction]
+        expect(self.sender.emit('get_text', callback=True)['text']) == self.read() == 'first #1\n    child #2\nsecond #3'
+
+class WatchFileTest(TemporaryBoardTestCase):
+    
+    def setUp(self):
+        super().setUp()
+        app.config['WATCH_INTERVAL'] = 0.01
+        self.board = current_board()
+        patcher = mock.patch.object(self.board, 'file_signature', wraps=self.board.file_signature)
+        self.file_signature = patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def expect_watching(self, is_watching):
+        "Whether the file is still polled a while after the watcher got the chance to notice it should stop."
+        time.sleep(0.05)
+        calls = self.file_signature.call_count
+        time.sleep(0.05)
+        expect(self.file_signature.call_count > calls) == is_watching
+    
+    def test_stops_watching_once_the_last_client_left(self):
+        first, second = socketio.test_client(app), socketio.test_client(app)
+        self.expect_watching(True)
+        first.disconnect()
+        self.expect_watching(True)
+        second.disconnect()
+        self.expect_watching(False)
+    
+    def test_stops_watching_unloaded_boards_until_they_are_used_again(self):
+        client = socketio.test_client(app)
+        self.addCleanup(client.disconnect)
+        self.expect_watching(True)
+        self.board.unload()
+        self.expect_watching(False)
+        self.get_json()
+        self.expect_watching(True)
+
+class MultipleBoardsTest(TestCase):
+    
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for name in ('team-a', 'team-b'):
+            path = os.path.join(directory.name, f'{name}.txt')
+            with open(path, mode='w', encoding='utf8') as f:
+                f.write(f'{name} story\n    task\nsecond')
+            self.addCleanup(lambda path=path: Board.for_path(path).unload())
+        
+        app.config['BOARDS_DIRECTORY'] = directory.name
+        self.addCleanup(app.config.__setitem__, 'BOARDS_DIRECTORY', None)
+        app.config['WATCH_INTERVAL'] = None
+        self.addCleanup(app.config.__setitem__, 'WATCH_INTERVAL', 0.5)
+        self.client = app.test_client()
+    
+    def test_serves_boards_by_name(self):
+        response = self.client.get('/api/v1/boards/team-a/todos')
+        expect(response.json['txt']) == 'team-a story\n    task\nsecond'
+        expect(self.client.get('/api/v1/boards/team-b/todos').json['txt']) == 'team-b story\n    task\nsecond'
+        
+        page = self.client.get('/boards/team-b/').get_data(as_text=True)
+        expect(page).contains('team-b story', '"/api/v1/boards/team-b/todos"')
+    
+    def test_unknown_boards_are_not_found(self):
+        expect(self.client.get('/api/v1/boards/team-c/todos').status_code) == 404
+        expect(self.client.get('/api/v1/boards/.hidden/todos').status_code) == 404
+        expect(self.client.get('/api/v1/boards/..%2Fteam-a/todos').status_code) == 404
+        expect(socketio.test_client(app, query_string='board=team-c').is_connected()).is_false()
+    
+    def test_changes_only_reach_the_clients_of_the_board(self):
+        team_a = socketio.test_client(app, query_string='board=team-a')
+        team_b = socketio.test_client(app, query_string='board=team-b')
+        self.addCleanup(team_a.disconnect)
+        self.addCleanup(team_b.disconnect)
+        
+        second = self.client.get('/api/v1/boards/team-b/todos').json['json']['children'][1]
+        delta = team_b.emit('update_todo', dict(action='set_status', uuid=second['uuid'], status='doing'), callback=True)
+        expect(delta['changed'][0]).has_subdict(uuid=second['uuid'], status='doing')
+        expect(self.client.get('/api/v1/boards/team-b/todos').json['txt']) == 'team-b story\n    task\nsecond status:doing'
+        
+        response = self.client.post('/api/v1/boards/team-b/todos/undo')
+        expect(response.status_code) == 200
+        expect([each['name'] for each in team_b.get_received()]) == ['delta']
+        expect(team_a.get_received()) == []
+        expect(self.client.get('/api/v1/boards/team-a/todos').json['txt']) == 'team-a story\n    task\nsecond'
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+
+"""
+Micro benchmarks for todotxt.
+
+Run with `python benchmark.py`, or `make benchmark` to keep the results of the current commit. Numbers are only
+comparable on the same machine.
+    
+    python benchmark.py                              everything but memory, boards of 1k to 100k lines
+    python benchmark.py boards --sizes 1000000       only the board shapes, with 1M lines
+    python benchmark.py --json new.json --compare old.json
+
+The results are printed, and with --json also written as machine readable results, one entry per measurement
+with its name, parameters, value and unit. --compare prints how much each measurement changed against such a file.
+"""
+
+import argparse
+import datetime
+import gc
+import io
+import json
+import platform
+import subprocess
+import timeit
+import tracemalloc
+
+from reparse import Lines
+from todotxt import Todo, TodoIndex
+from treediff import diff
+
+results = []
+
+def report(name, value, unit, **parameters):
+    "Prints and records one measurement."
+    results.append(dict(name=name, parameters=parameters, value=round(value, 3), unit=unit))
+    label = ', '.join(f'{key}={value}' for key, value in parameters.items())
+    print(f'{name}{f" ({label})" if label else ""}: {value:.2f} {unit}', flush=True)
+
+def synthetic_board(number_of_stories=100, tasks_per_story=100):
+    lines = []
+    for story in range(number_of_stories):
+        lines.append(f'story {story} #{story} +project{story % 7}')
+        for task in range(tasks_per_story):
+            status = ('', ' status:doing', ' status:done', ' status:blocked')[task % 4]
+            done = 'x ' if task % 5 == 0 else ''
+            lines.append(f'    {done}task {task} @person{task % 3} sprint:"sprint {task % 2}"{status}')
+    return '\n'.join(lines)
+
+def deep_board(number_of_chains=50, depth=200):
+    "Chains of tasks, each a child of the one before."
+    lines = []
+    for chain in range(number_of_chains):
+        lines.extend(f'{" " * Todo.INDENT * level}task {chain}.{level} #{chain * depth + level}' for level in range(depth))
+    return '\n'.join(lines)
+
+def wide_board(number_of_lines):
+    "Stories with a thousand tasks each, like a board with few big columns."
+    return synthetic_board(number_of_stories=max(1, number_of_lines // 1000), tasks_per_story=min(999, number_of_lines - 1))
+
+def deep_chains(number_of_lines):
+    return deep_board(number_of_chains=max(1, number_of_lines // 200), depth=min(200, number_of_lines))
+
+def tag_heavy_board(number_of_lines):
+    "Every task has an id, several contexts, projects and tags."
+    lines = []
+    for line in range(number_of_lines):
+        indentation = '' if line % 100 == 0 else ' ' * Todo.INDENT
+        lines.append(f'{indentation}task {line} #{line} @person{line % 3} @person{line % 5 + 3} +project{line % 7} +release{line % 2} '
+            f'sprint:"sprint {line % 4}" estimate:{line % 8} priority:{("low", "high")[line % 2]} '
+            f'due:2024-{line % 12 + 1:02}-01 status:{("new", "doing", "done")[line % 3]}')
+    return '\n'.join(lines)
+
+def body_heavy_board(number_of_lines, body_lines=4):
+    "Tasks with a description of several lines each."
+    lines = []
+    body_indentation = ' ' * Todo.INDENT * 3
+    while len(lines) < number_of_lines:
+        task = len(lines) // (body_lines + 1)
+        indentation = '' if task % 100 == 0 else ' ' * Todo.INDENT
+        lines.append(f'{indentation}task {task} @person{task % 3}')
+        lines.extend(f'{body_indentation}line {line} of the description of task {task}, which goes on for a while' for line in range(body_lines))
+    return '\n'.join(lines[:number_of_lines])
+
+BOARDS = dict(wide=wide_board, deep=deep_chains, tags=tag_heavy_board, bodies=body_heavy_board)
+
+def time_per_task(function, number_of_tasks, repeat=5):
+    "Returns the best of `repeat` runs in microseconds per task."
+    return min(timeit.repeat(function, number=1, repeat=repeat)) / number_of_tasks * 1e6
+
+def benchmark_boards(sizes=(1_000, 10_000, 100_000), shapes=tuple(BOARDS)):
+    "Parsing, serializing and json of each board shape in each size, in µs per line of todo.txt."
+    for shape in shapes:
+        for size in sizes:
+            lines = BOARDS[shape](size)
+            repeat = max(1, min(5, 300_000 // size))
+            parameters = dict(board=shape, lines=size)
+            
+            report('Todo.from_lines', time_per_task(lambda: Todo.from_lines(lines), size, repeat), 'µs per line', **parameters)
+            board = Todo.from_lines(lines)
+            report('str(Todo)', time_per_task(lambda: str(board), size, repeat), 'µs per line', **parameters)
+            
+            boards = iter([Todo.from_lines(lines) for _ in range(repeat)])
+            report('Todo.json get', time_per_task(lambda: next(boards).json, size, repeat), 'µs per line', **parameters)
+            
+            # every task is set to the json it already has, which is what a client sends back after small changes
+            json_ = board.json
+            boards = iter([Todo.from_lines(lines) for _ in range(repeat)])
+            def set_json():
+                next(boards).json = json_
+            report('Todo.json set', time_per_task(set_json, size, repeat), 'µs per line', **parameters)
+
+def benchmark_parse():
+    lines = synthetic_board()
+    number_of_tasks = 100 * 100 + 100
+    report('Todo.from_lines', time_per_task(lambda: Todo.from_lines(lines), number_of_tasks), 'µs per task')
+    report('Todo.from_stream', time_per_task(lambda: Todo.from_stream(io.StringIO(lines)), number_of_tasks), 'µs per task')
+
+def benchmark_serialize():
+    for name, lines in (('wide', synthetic_board()), ('deep', deep_board())):
+        board = Todo.from_lines(lines)
+        number_of_tasks = lines.count('\n') + 1
+        report('str(Todo)', time_per_task(lambda: str(board), number_of_tasks), 'µs per task', board=name)
+        report('Todo.write_to', time_per_task(lambda: board.write_to(io.StringIO()), number_of_tasks), 'µs per task', board=name)
+
+def benchmark_json():
+    lines = synthetic_board()
+    number_of_tasks = 100 * 100 + 100
+    
+    boards = iter([Todo.from_lines(lines) for _ in range(5)])
+    report('Todo.json (first serialization)', time_per_task(lambda: next(boards).json, number_of_tasks), 'µs per task')
+    
+    board = Todo.from_lines(lines)
+    report('Todo.json (repeated serialization)', time_per_task(lambda: board.json, number_of_tasks), 'µs per task')
+
+def benchmark_task_by_uuid():
+    board = Todo.from_lines(synthetic_board())
+    uuids = [task.uuid for task in board.iter_tree()]
+    board.task_by_uuid(uuids[0]) # builds the index
+    
+    def lookup_all():
+        for uuid in uuids:
+            board.task_by_uuid(uuid)
+    
+    report('Todo.task_by_uuid', time_per_task(lookup_all, len(uuids)), 'µs per lookup')
+
+def benchmark_query():
+    board = Todo.from_lines(synthetic_board(number_of_stories=1000, tasks_per_story=100))
+    number_of_tasks = 1000 * 100 + 1000
+    report('TodoIndex (building)', time_per_task(lambda: TodoIndex(board), number_of_tasks, repeat=3), 'µs per task')
+    
+    board.index
+    story = board.task_by_id(500)
+    queries = [
+        ('board', dict(status='doing', contexts=['person1'], tags=dict(sprint='sprint 1'))),
+        ('board', dict(projects=['project3'])),
+        ('story', dict(status='doing', contexts=['person1'])),
+        ('board', dict(projects=['project3'], inherited=True)),
+        ('board', dict(status='doing', projects=['project3'], contexts=['person1'], inherited=True)),
+    ]
+    for scope, query in queries:
+        root = board if 'board' == scope else story
+        milliseconds = min(timeit.repeat(lambda: root.query(**query), number=1, repeat=5)) * 1e3
+        report(f'Todo.query({query})', milliseconds, 'ms', scope=scope, results=len(root.query(**query)))
+
+def benchmark_status_buckets():
+    story = Todo.from_lines(synthetic_board(number_of_stories=1, tasks_per_story=5000))
+    
+    def columns():
+        story.children._invalidate()
+        tagged = story.children.tagged
+        return tagged.new, tagged.doing, tagged.done, tagged.unknown
+    
+    report('FilterableList status buckets', time_per_task(columns, 5000), 'µs per child')
+
+def benchmark_bulk_updates(number_of_tasks=50_000):
+    "Status and tag changes as the board ui sends them, see Todo.on_operation()."
+    lines = synthetic_board(number_of_stories=number_of_tasks // 1000, tasks_per_story=999)
+    
+    def parsed_tasks():
+        board = Todo.from_lines(lines)
+        board.index # like on the server, where every line is parsed already
+        return [task for task in board.iter_tree() if not task.is_virtual]
+    
+    def set_status(tasks):
+        for index, task in enumerate(tasks):
+            task.on_operation('set_status', status=('new', 'doing', 'done')[index % 3])
+    
+    def change_tag(tasks):
+        for index, task in enumerate(tasks):
+            task.on_operation('change_tag', tags=dict(sprint=f'sprint {index % 3}', estimate=str(index % 5)))
+    
+    for operation in (set_status, change_tag):
+        boards = iter([parsed_tasks() for _ in range(3)])
+        microseconds = time_per_task(lambda: operation(next(boards)), number_of_tasks, repeat=3)
+        report(operation.__name__, microseconds, 'µs per task', tasks=number_of_tasks)
+
+def benchmark_diff(number_of_tasks=50_000):
+    "An editor session on a big board: some status changes, a moved story, added and deleted tasks, see treediff.diff()."
+    lines = synthetic_board(number_of_stories=number_of_tasks // 1000, tasks_per_story=999).split('\n')
+    edited = lines[:1000] + lines[30_000:31_000] + lines[1000:30_000] + lines[31_000:]
+    for index in range(1, len(edited), 100):
+        edited[index] += ' status:doing'
+    edited[5000:5000] = ['    a new task', '    another new task']
+    del edited[20_010:20_020]
+    old, new = Todo.from_lines('\n'.join(lines)), Todo.from_lines('\n'.join(edited))
+    
+    microseconds = time_per_task(lambda: diff(old, new), number_of_tasks, repeat=3)
+    report('treediff.diff', microseconds, 'µs per task', tasks=number_of_tasks, operations=len(diff(old, new)))
+
+def benchmark_reparse(number_of_lines=100_000):
+    "Single line edits in the text of a big board, each followed by the edit that undoes it, see reparse.Lines.replace()."
+    board = Todo.from_lines(wide_board(number_of_lines))
+    board.index # like on the server
+    lines = Lines(board)
+    middle = len(lines) // 2 + 500 # a task in the middle of a story
+    task_line = str(board).split('\n', middle + 1)[middle]
+    edits = dict(
+        edit=([task_line + ' @edited'], [task_line]),
+        insert=([task_line, '    a new task'], [task_line]),
+        delete=([], [task_line]),
+        indent=(['    ' + task_line], [task_line]),
+    )
+    
+    def replace(start, stop, new_lines):
+        for operation in lines.replace(start, stop, new_lines):
+            board.apply_operation(operation)
+    
+    for name, (edited, original) in edits.items():
+        def edit_and_undo():
+            replace(middle, middle + 1, edited)
+            replace(middle, middle + len(edited), original)
+        
+        microseconds = min(timeit.repeat(edit_and_undo, number=100, repeat=3)) / 100 / 2 * 1e6
+        report(f'reparse.Lines.replace ({name})', microseconds, 'µs per edit', lines=number_of_lines)
+
+def benchmark_rollups(number_of_tasks=100_000):
+    "Counting the rollups of a big board, then keeping them up to date while statuses change, see Todo.rollup."
+    lines = synthetic_board(number_of_stories=number_of_tasks // 1000, tasks_per_story=999)
+    
+    boards = iter([Todo.from_lines(lines) for _ in range(3)])
+    report('Todo.rollup (counting)', time_per_task(lambda: next(boards).rollup, number_of_tasks, repeat=3), 'µs per task')
+    
+    board = Todo.from_lines(lines)
+    board.rollup
+    tasks = [task for task in board.iter_tree() if not task.is_virtual and not task.has_children()]
+    
+    def set_status():
+        for index, task in enumerate(tasks):
+            task.on_operation('set_status', status=('new', 'doing', 'done')[index % 3])
+    
+    report('set_status (rollups counted)', time_per_task(set_status, len(tasks), repeat=3), 'µs per task')
+
+def benchmark_memory(number_of_tasks=1_000_000):
+    lines = synthetic_board(number_of_stories=number_of_tasks // 1000, tasks_per_story=999)
+    
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    board = Todo.from_lines(lines)
+    parsed = tracemalloc.get_traced_memory()[0]
+    for task in board.iter_tree():
+        task.uuid
+    with_uuids = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    
+    report('Memory after parsing', (parsed - before) / number_of_tasks, 'bytes per task', tasks=number_of_tasks)
+    report('Memory after assigning uuids', (with_uuids - before) / number_of_tasks, 'bytes per task', tasks=number_of_tasks)
+
+BENCHMARKS = dict(
+    boards=benchmark_boards,
+    parse=benchmark_parse,
+    serialize=benchmark_serialize,
+    json=benchmark_json,
+    task_by_uuid=benchmark_task_by_uuid,
+    query=benchmark_query,
+    status_buckets=benchmark_status_buckets,
+    bulk_updates=benchmark_bulk_updates,
+    diff=benchmark_diff,
+    reparse=benchmark_reparse,
+    rollups=benchmark_rollups,
+    memory=benchmark_memory,
+)
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def key_of(result):
+    return (result['name'], tuple(sorted(result['parameters'].items())))
+
+def compare(old_results, new_results):
+    "Prints the change of each measurement that is in both, slower is positive."
+    old_by_key = {key_of(result): result for result in old_results}
+    for result in new_results:
+        old = old_by_key.get(key_of(result))
+        if old is None or not old['value'] or old['unit'] != result['unit']:
+            continue
+        change = (result['value'] - old['value']) / old['value'] * 100
+        label = ', '.join(f'{key}={value}' for key, value in result['parameters'].items())
+        print(f'{change:+6.1f}%  {result["name"]}{f" ({label})" if label else ""}: {old["value"]} -> {result["value"]} {result["unit"]}')
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Micro benchmarks for todotxt.')
+    parser.add_argument('benchmarks', nargs='*', choices=list(BENCHMARKS),
+        help='which benchmarks to run, all but memory by default')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='lines of the boards benchmark, comma separated')
+    parser.add_argument('--shapes', default=','.join(BOARDS), help='boards of the boards benchmark, comma separated')
+    parser.add_argument('--json', metavar='PATH', help='write the results to this file')
+    parser.add_argument('--compare', metavar='PATH', help='results of an earlier run to compare with')
+    arguments = parser.parse_args(arguments)
+    
+    for name in arguments.benchmarks or [name for name in BENCHMARKS if 'memory' != name]:
+        if 'boards' == name:
+            benchmark_boards(sizes=[int(size) for size in arguments.sizes.split(',')], shapes=arguments.shapes.split(','))
+        else:
+            BENCHMARKS[name]()
+    
+    if arguments.json:
+        with open(arguments.json, 'w', encoding='utf8') as f:
+            json.dump(dict(
+                commit=current_commit(),
+                date=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+                python=platform.python_version(),
+                machine=platform.platform(),
+                results=results,
+            ), f, indent=1, ensure_ascii=False)
+    
+    if arguments.compare:
+        with open(arguments.compare, encoding='utf8') as f:
+            print(f'\nCompared to {arguments.compare}:')
+            compare(json.load(f)['results'], results)
+
+if __name__ == '__main__':
+    main()
+    
\ No newline at end of file
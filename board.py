@@ -0,0 +1,480 @@
+"""
+A board is one todo.txt file together with its parsed tree of todos.
+
+Boards are kept in memory for the lifetime of the process, so the uuids handed out to clients
+stay valid across requests. The file is only parsed again if it was changed on disk since it
+was last read or written by us, which is detected by comparing inode, mtime and size.
+
+All access to the tree of a board has to happen while holding its lock.
+Boards that were not used for a while can be unloaded, to keep only the trees of the busy ones in memory,
+see `unload_least_recently_used()`. Their uuids are restored with the tree when they are used again.
+
+Writing is crash safe: the new content goes to a temporary file next to todo.txt, which is
+fsynced and then renamed over the original, so readers see either the old or the new board,
+never a truncated one, which is also why reading needs no lock. Writers in other processes
+are kept out with an flock() on `todo.txt.lock`. Only streaming the tree into the temporary file
+needs the lock of the board, the slow parts of writing happen without holding it.
+Changes that arrive within `write_delay` seconds of each other are written together.
+Everything that can block for long goes through `Board.run_blocking`, so servers with an event loop
+can run it in a thread pool, see server.py: reading and parsing the file, streaming the tree into it, fsync() and flock().
+Callbacks like `on_external_change` still run on the calling thread.
+
+Changes made through `history` can be undone, and survive a restart with their uuids, see history.py.
+With `parse_cache`, the parsed tree is also kept next to the file when the board is unloaded or the process exits,
+so a restart does not have to parse it again, see `checkpoint()` and parsecache.py.
+
+Changes others make to the file, e.g. in an editor, are applied to the tree as operations, see treediff.py,
+so all todos they did not touch keep their uuids. `on_external_change` is told about them,
+and `on_unload` about unloading the board, e.g. to stop looking for such changes.
+
+Clients can also edit the text of the board together, see `text_document` and textdocument.py.
+"""
+
+from collections import OrderedDict
+import atexit
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None # no locking against other processes on this platform
+
+from history import History
+from parsecache import ParseCache
+from textdocument import TextDocument
+from todotxt import Todo
+from treediff import diff
+
+class Board:
+    
+    _boards = dict()
+    _resident = OrderedDict() # boards with a parsed tree, least recently used first
+    _boards_lock = threading.Lock()
+    # Runs function(*args), which blocks on the disk or on other processes
+    run_blocking = staticmethod(lambda function, *args: function(*args))
+    
+    @classmethod
+    def for_path(cls, path, **options):
+        "The one board for this file in this process. Options only apply when it is created."
+        path = os.path.abspath(path)
+        with cls._boards_lock:
+            if path not in cls._boards:
+                cls._boards[path] = cls(path, **options)
+            return cls._boards[path]
+    
+    @classmethod
+    def flush_all(cls):
+        with cls._boards_lock:
+            boards = list(cls._boards.values())
+        for board in boards:
+            board.flush()
+    
+    @classmethod
+    def checkpoint_all(cls):
+        with cls._boards_lock:
+            boards = list(cls._resident.values())
+        for board in boards:
+            board.checkpoint()
+    
+    @classmethod
+    def unload_least_recently_used(cls, max_boards=None, max_size=None):
+        """Unloads the least recently used boards until at most `max_boards` are resident,
+        whose files have at most `max_size` bytes together, as a rough measure of the memory their trees need.
+        
+        Boards that are in use right now are skipped.
+        """
+        with cls._boards_lock:
+            resident = list(cls._resident.values())
+        number_of_boards = len(resident)
+        size = sum(board._size() for board in resident)
+        for board in resident:
+            if (max_boards is None or number_of_boards <= max_boards) and (max_size is None or size <= max_size):
+                break
+            board_size = board._size()
+            try:
+                unloaded = board.unload(blocking=False)
+            except OSError:
+                unloaded = False # could not write its changes, so it has to stay
+            if unloaded:
+                number_of_boards -= 1
+                size -= board_size
+    
+    def __init__(self, path, write_delay=0, on_external_change=None, on_unload=None, parse_cache=False):
+        self.path = path
+        self.write_delay = write_delay
+        # called with the board and the changed todos, or None if the whole tree was replaced
+        self.on_external_change = on_external_change
+        # called with the board after it was unloaded
+        self.on_unload = on_unload
+        self.lock = threading.RLock()
+        # looked up on every call, as servers replace Board.run_blocking after boards may have been created
+        self.history = History(path, run_blocking=lambda function, *args: self.run_blocking(function, *args))
+        self.parse_cache = ParseCache(path) if parse_cache else None
+        self._cached = None # (signature, history sequence) the parse cache has the tree of
+        self._task = None
+        self._signature = None
+        self._is_dirty = False
+        self._write_timer = None
+        # Writes happen outside of the lock, these make sure the newest content wins
+        self._generation = 0
+        self._written_generation = 0
+        self._writes_in_progress = 0
+        self._writes_finished = threading.Condition(self.lock)
+        self._write_lock = threading.Lock() # flock() alone does not serialize threads on every platform
+        self._text_document = None
+        self._text_revision = 0 # of the last text document, the next one continues after it
+    
+    def __repr__(self):
+        return f'<Board(path={self.path!r})>'
+    
+    @property
+    def task(self):
+        """The parsed tree, parsed again only if the file changed.
+        
+        Unsaved changes win over changes on disk, they will overwrite them when written.
+        """
+        with self.lock:
+            if self._task is None:
+                self.run_blocking(self._load)
+            else:
+                self.follow_file()
+            with self._boards_lock:
+                self._resident[self.path] = self
+                self._resident.move_to_end(self.path)
+            return self._task
+    
+    @property
+    def text_document(self):
+        "The text of the board as clients edit it together, see textdocument.py. Created on first use."
+        with self.lock:
+            task = self.task
+            if self._text_document is None:
+                # clients of an earlier document have to fetch the text again, as it may have changed in between
+                self._text_document = TextDocument(str(task), revision=self._text_revision + 1)
+            return self._text_document
+    
+    def edit_text(self, revision, operation):
+        """Applies an operation a client made on `revision` of the text_document, to the text and to the tree.
+        
+        Returns the new revision, the operation as it was applied, the changed todos,
+        or None instead of them if the tree had to be replaced, and the revision and operation
+        that bring the text back in line with the tree, if it reads differently, else None.
+        """
+        with self.lock:
+            task = self.task
+            document = self.text_document
+            operation = document.transform(revision, operation)
+            operations = document.tree_operations(task, operation)
+            document.apply(operation)
+            changed = None
+            if operations is not None:
+                try:
+                    changed = self.history.apply(task, operations)
+                except Exception:
+                    operations = None
+            if operations is None:
+                document.forget_lines()
+                # only if what the root of the tree is changes, indentation is not by whole levels,
+                # or applying the operations failed
+                changed = self.run_blocking(self._follow_text, document.text)
+            revision = document.revision
+            correction = document.replace(str(self._task))
+            if correction is not None:
+                correction = (document.revision, correction)
+            self.save()
+            return revision, operation, changed, correction
+    
+    def sync_text(self):
+        """Brings the text_document up to date after the tree was changed other than through edit_text().
+        
+        Returns the new revision and the operation that did it, or None if the text did not change.
+        """
+        with self.lock:
+            if self._text_document is None or self._task is None:
+                return None
+            document = self._text_document
+            document.forget_lines()
+            operation = document.replace(str(self._task))
+            if operation is None:
+                return None
+            return document.revision, operation
+    
+    def follow_file(self):
+        "Applies the changes others made to the file since it was last read or written by us."
+        with self.lock:
+            if self._task is not None and self._may_reload() and self.file_signature() != self._signature:
+                changed = self.run_blocking(self._follow_file)
+                if self.on_external_change is not None and (changed is None or changed):
+                    self.on_external_change(self, changed)
+    
+    def save(self):
+        "Schedules writing the tree, so several changes in quick succession cause only one write."
+        with self.lock:
+            self._is_dirty = True
+            if self.write_delay <= 0:
+                self.flush()
+            elif self._write_timer is None:
+                self._write_timer = threading.Timer(self.write_delay, self.flush)
+                self._write_timer.daemon = True
+                self._write_timer.start()
+    
+    def flush(self):
+        "Writes pending changes now, returns once everything that was saved is on disk."
+        with self.lock:
+            if self._write_timer is not None:
+                self._write_timer.cancel()
+                self._write_timer = None
+            if not self._is_dirty:
+                self._writes_finished.wait_for(lambda: 0 == self._writes_in_progress)
+                return
+            
+            # Only writing the text needs the tree, syncing it to disk and replacing the file happen outside the lock
+            temporary_file = self.run_blocking(self._write_temporary_file)
+            self._is_dirty = False
+            self._generation += 1
+            generation = self._generation
+            self._writes_in_progress += 1
+        
+        signature = None
+        try:
+            signature = self._write(temporary_file, generation)
+        except:
+            with self.lock:
+                self._is_dirty = True # try again with the next write
+            raise
+        finally:
+            with self.lock:
+                self._writes_in_progress -= 1
+                if signature is not None and generation == self._written_generation:
+                    self._signature = signature
+                self._writes_finished.notify_all()
+    
+    def unload(self, blocking=True):
+        """Writes pending changes and forgets the tree, which is restored with its uuids when it is needed again.
+        
+        Returns False if the board was in use and blocking is False.
+        """
+        if not self.lock.acquire(blocking=blocking):
+            return False
+        try:
+            self.flush()
+            if self._task is not None:
+                if self.parse_cache is None:
+                    self.history.checkpoint(self._task) # else the parse cache keeps the tree with its uuids
+                self.checkpoint()
+            self.history.close()
+            self._task = None
+            self._forget_text_document()
+            self._signature = None
+            with self._boards_lock:
+                self._resident.pop(self.path, None)
+        finally:
+            self.lock.release()
+        
+        if self.on_unload is not None:
+            self.on_unload(self)
+        return True
+    
+    def checkpoint(self):
+        "Writes pending changes and the parse cache, unless it has the tree as it is already."
+        with self.lock:
+            self.flush()
+            if self.parse_cache is None or self._task is None:
+                return
+            state = (self._signature, self.history.sequence)
+            if state == self._cached:
+                return
+            self.run_blocking(self._store_parse_cache)
+            self._cached = state
+    
+    def invalidate(self):
+        """Forget the parsed tree, e.g. after a failed change left it in an unknown state.
+        
+        Changes that were saved but not written yet are written first, as clients were already told about them.
+        """
+        with self.lock:
+            try:
+                self.flush()
+            finally:
+                self._task = None
+                self._signature = None
+                self._is_dirty = False
+                self._forget_text_document()
+    
+    def _forget_text_document(self):
+        if self._text_document is not None:
+            self._text_revision = self._text_document.revision
+            self._text_document = None
+    
+    def _size(self):
+        return 0 if self._signature is None else self._signature[2]
+    
+    def _may_reload(self):
+        "Unsaved changes win over changes on disk, and our own writes are no reason to reload."
+        return not self._is_dirty and 0 == self._writes_in_progress
+    
+    def _load(self):
+        "Restores the tree from the parse cache or the history if it matches the file, so the uuids survive restarts."
+        with open(self.path, encoding='utf8') as f:
+            if self.parse_cache is not None and self._load_cached(f.read(), os.fstat(f.fileno())):
+                return
+            f.seek(0)
+            restored = self.history.restore()
+            if restored is not None and str(restored) == f.read():
+                self._task = restored
+            else:
+                f.seek(0)
+                self._task = Todo.from_stream(f)
+                self.history.reset()
+            self._signature = self._signature_of(os.fstat(f.fileno()))
+    
+    def _load_cached(self, text, stat):
+        cached = self.parse_cache.load(text)
+        if cached is None:
+            return False
+        task, sequence = cached
+        if not self.history.resume(sequence):
+            return False
+        self._task = task
+        self._signature = self._signature_of(stat)
+        self._cached = (self._signature, sequence)
+        return True
+    
+    def _store_parse_cache(self):
+        self.parse_cache.store(self._task, str(self._task), self.history.sequence)
+    
+    def _follow_file(self):
+        "Returns the changed todos, see `_follow_text()`."
+        with open(self.path, encoding='utf8') as f:
+            text = f.read()
+            signature = self._signature_of(os.fstat(f.fileno()))
+        changed = self._follow_text(text)
+        
+        self._signature = signature
+        return changed
+    
+    def _follow_text(self, text):
+        """Applies the differences between the tree and text to the tree, through the history.
+        
+        Returns the changed todos, or None if the tree had to be replaced by the parsed text,
+        which is also the case if the result is not exactly text.
+        """
+        new_task = Todo.from_lines(text)
+        changed = None
+        operations = diff(self._task, new_task)
+        if operations:
+            try:
+                changed = self.history.apply(self._task, operations)
+            except Exception:
+                changed = None
+        elif operations is not None:
+            changed = []
+        # REFACT indentation that is not a multiple of Todo.INDENT can not be expressed as operations
+        if changed is None or str(self._task) != text:
+            self._task = new_task
+            self.history.reset()
+            changed = None
+        return changed
+    
+    def _write_temporary_file(self):
+        "Streams the tree into a new file next to the board, see Todo.write_to()."
+        directory, name = os.path.split(self.path)
+        temporary_file = tempfile.NamedTemporaryFile(mode='w', encoding='utf8', dir=directory,
+            prefix=f'.{name}.', suffix='.tmp', delete=False)
+        try:
+            self._task.write_to(temporary_file)
+            temporary_file.flush()
+        except:
+            self._discard(temporary_file)
+            raise
+        return temporary_file
+            
+    def _write(self, temporary_file, generation):
+        """Replaces the board with the temporary file once it is on disk.
+        
+        Returns the signature of the written file, or None if a newer generation was written already.
+        """
+        directory = os.path.dirname(self.path)
+        try:
+            self.run_blocking(os.fsync, temporary_file.fileno())
+            self._copy_permissions(temporary_file.fileno())
+            temporary_file.close()
+            with self._write_lock, FileLock(self.path + '.lock', run_blocking=self.run_blocking):
+                if generation < self._written_generation:
+                    self._discard(temporary_file)
+                    return None
+                
+                os.replace(temporary_file.name, self.path)
+                self._written_generation = generation
+                signature = self.file_signature()
+        except:
+            self._discard(temporary_file)
+            raise
+        
+        self._fsync_directory(directory)
+        return signature
+    
+    def _discard(self, temporary_file):
+        temporary_file.close()
+        try:
+            os.unlink(temporary_file.name)
+        except FileNotFoundError:
+            pass
+    
+    def _copy_permissions(self, fileno):
+        try:
+            os.chmod(fileno, os.stat(self.path).st_mode)
+        except (FileNotFoundError, NotImplementedError):
+            pass
+    
+    def _fsync_directory(self, directory):
+        "Makes the rename itself durable."
+        try:
+            fileno = os.open(directory, os.O_RDONLY)
+        except OSError: # pragma: no cover
+            return # e.g. on windows
+        try:
+            self.run_blocking(os.fsync, fileno)
+        finally:
+            os.close(fileno)
+    
+    def file_signature(self):
+        "Changes whenever the file is replaced or written to."
+        try:
+            return self._signature_of(os.stat(self.path))
+        except FileNotFoundError:
+            return None
+    
+    @staticmethod
+    def _signature_of(stat):
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+class FileLock:
+    "Exclusive flock() on a separate lock file, which is never replaced like the file it protects."
+    
+    def __init__(self, path, run_blocking=lambda function, *args: function(*args)):
+        self.path = path
+        self.run_blocking = run_blocking
+        self._fileno = None
+    
+    def __enter__(self):
+        if fcntl is None: # pragma: no cover
+            return self
+        self._fileno = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.run_blocking(fcntl.flock, self._fileno, fcntl.LOCK_EX)
+        return self
+    
+    def __exit__(self, *exc_info):
+        if self._fileno is None:
+            return
+        try:
+            fcntl.flock(self._fileno, fcntl.LOCK_UN)
+        finally:
+            os.close(self._fileno)
+            self._fileno = None
+
+atexit.register(Board.flush_all)
+# runs first, see atexit
+atexit.register(Board.checkpoint_all)
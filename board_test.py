@@ -0,0 +1,271 @@
+from unittest import TestCase, mock
+import os
+import threading
+import time
+import tempfile
+
+from pyexpect import expect
+
+from board import Board
+
+class BoardTest(TestCase):
+    
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'todo.txt')
+        self.write('first\n    child\nsecond')
+        self.board = Board.for_path(self.path)
+        self.addCleanup(self.board.unload)
+    
+    def write(self, text):
+        with open(self.path, mode='w', encoding='utf8') as f:
+            f.write(text)
+    
+    def read(self):
+        with open(self.path, encoding='utf8') as f:
+            return f.read()
+    
+    def test_one_board_per_file(self):
+        expect(Board.for_path(self.path)).is_(self.board)
+        expect(Board.for_path(os.path.join(os.path.dirname(self.path), '.', 'todo.txt'))).is_(self.board)
+    
+    def test_parses_only_once(self):
+        task = self.board.task
+        expect(self.board.task).is_(task)
+    
+    def test_follows_external_changes_keeping_the_uuids(self):
+        task = self.board.task
+        first, second = task.children
+        self.board.on_external_change = mock.Mock()
+        self.write('first\n    child status:doing\nsecond\nthird')
+        
+        expect(self.board.task).is_(task)
+        expect(str(task)) == 'first\n    child status:doing\nsecond\nthird'
+        expect(task.children[:2]) == [first, second]
+        (board, changed), _ = self.board.on_external_change.call_args
+        expect(board).is_(self.board)
+        expect(changed).contains(first.children[0], task)
+        
+        self.write('only one task now')
+        expect(self.board.task).not_is_(task)
+        expect(self.board.on_external_change.call_args[0][1]).is_none()
+    
+    def test_saving_does_not_cause_a_reparse(self):
+        task = self.board.task
+        task.children[1].on_operation('set_status', status='doing')
+        self.board.save()
+        expect(self.read()) == 'first\n    child\nsecond status:doing'
+        expect(self.board.task).is_(task)
+    
+    def test_invalidate(self):
+        task = self.board.task
+        self.board.invalidate()
+        expect(self.board.task).not_is_(task)
+    
+    def test_invalidate_writes_the_changes_that_were_saved(self):
+        self.board.write_delay = 10
+        self.board.task.children[1].on_operation('set_status', status='doing')
+        self.board.save()
+        self.board.invalidate()
+        expect(self.read()) == 'first\n    child\nsecond status:doing'
+        expect(str(self.board.task)) == 'first\n    child\nsecond status:doing'
+    
+    def test_writes_changes_within_the_write_delay_together(self):
+        self.board.write_delay = 0.05
+        task = self.board.task
+        with mock.patch.object(self.board, '_write', wraps=self.board._write) as write:
+            for status in ('doing', 'done', 'doing'):
+                task.children[1].on_operation('set_status', status=status)
+                self.board.save()
+            expect(self.read()) == 'first\n    child\nsecond'
+            
+            deadline = time.monotonic() + 5
+            while self.read() == 'first\n    child\nsecond' and time.monotonic() < deadline:
+                time.sleep(0.01)
+        
+        expect(self.read()) == 'first\n    child\nsecond status:doing'
+        expect(write.call_count) == 1
+        expect(self.board.task).is_(task)
+    
+    def test_runs_the_calls_that_block_through_run_blocking(self):
+        calls = []
+        def run_blocking(function, *args):
+            calls.append(function.__name__)
+            return function(*args)
+        
+        with mock.patch.object(Board, 'run_blocking', staticmethod(run_blocking)):
+            self.board.task.children[1].on_operation('set_status', status='doing')
+            self.board.save()
+            expect(self.read()) == 'first\n    child\nsecond status:doing'
+            self.write('first\n    child\nsecond status:done')
+            self.board.follow_file()
+        expect(str(self.board.task)) == 'first\n    child\nsecond status:done'
+        expect(calls).contains('_load', '_write_temporary_file', 'fsync', 'flock', '_follow_file')
+    
+    def test_writes_the_history_and_the_parse_cache_through_run_blocking(self):
+        board = Board(self.path, parse_cache=True)
+        calls = []
+        def run_blocking(function, *args):
+            calls.append(function.__name__)
+            return function(*args)
+        
+        with mock.patch.object(Board, 'run_blocking', staticmethod(run_blocking)):
+            task = board.task
+            board.history.apply(task, [dict(action='set_status', uuid=task.children[1].uuid, status='doing')])
+            # indentation that is not whole levels replaces the tree
+            board.edit_text(board.text_document.revision, [6, ' ', 29])
+            board.unload()
+        expect(calls).contains('_snapshot', '_append', '_follow_text', '_store_parse_cache')
+    
+    def test_edits_the_text_keeping_the_uuids(self):
+        first, second = self.board.task.children
+        revision = self.board.text_document.revision
+        
+        revision, operation, changed, correction = self.board.edit_text(revision, [10, 'the ', 12])
+        expect(self.read()) == 'first\n    the child\nsecond'
+        expect(changed) == [first.children[0]]
+        expect(correction).is_none()
+        
+        # made without knowing about the first edit, and adds a line
+        self.board.edit_text(revision - 1, [22, '\n    new child'])
+        expect(self.read()) == 'first\n    the child\nsecond\n    new child'
+        expect(self.board.task.children) == [first, second]
+        expect(second.children[0].line) == '    new child'
+    
+    def test_indentation_that_is_not_whole_levels_stays_as_typed(self):
+        revision = self.board.text_document.revision
+        for operation, text in [
+            ([6, ' ', 16], 'first\n     child\nsecond'),
+            ([6, -5, '\t', 12], 'first\n\tchild\nsecond'),
+        ]:
+            revision, _, _, correction = self.board.edit_text(revision, operation)
+            expect(correction).is_none()
+            expect(self.board.text_document.text) == text
+            expect(str(self.board.task)) == text
+    
+    def test_corrects_the_text_if_the_tree_reads_differently(self):
+        document = self.board.text_document
+        child = self.board.task.children[0].children[0]
+        # as if the line could be edited in place, which indents it by whole levels
+        with mock.patch('textdocument.is_indented_by_levels', return_value=True):
+            revision, operation, changed, correction = self.board.edit_text(document.revision, [6, ' ', 16])
+        
+        expect(changed) == [child]
+        expect(correction) == (revision + 1, [10, -1, 12])
+        expect(document.text) == str(self.board.task) == 'first\n    child\nsecond'
+        expect(self.read()) == document.text
+    
+    def test_changes_to_the_tree_become_text_operations(self):
+        document = self.board.text_document
+        second = self.board.task.children[1]
+        self.board.history.apply(self.board.task, [dict(action='set_status', uuid=second.uuid, status='doing')])
+        
+        expect(self.board.sync_text()) == (document.revision, [22, ' status:doing'])
+        expect(document.text) == 'first\n    child\nsecond status:doing'
+        expect(self.board.sync_text()).is_none()
+    
+    def test_writes_atomically_by_replacing_the_file(self):
+        inode = os.stat(self.path).st_ino
+        task = self.board.task
+        task.children[1].on_operation('delete')
+        with mock.patch('os.replace', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                self.board.save()
+        
+        expect(self.read()) == 'first\n    child\nsecond'
+        expect(sorted(os.listdir(os.path.dirname(self.path)))) == ['todo.txt', 'todo.txt.lock']
+        
+        self.board.flush()
+        expect(self.read()) == 'first\n    child'
+        expect(os.stat(self.path).st_ino) != inode
+
+    def test_keeps_uuids_and_history_across_restarts(self):
+        task = self.board.task
+        self.board.history.apply(task, [dict(action='set_status', uuid=task.children[1].uuid, status='doing')])
+        self.board.save()
+        
+        restarted = Board(self.path)
+        expect(restarted.task.uuid) == task.uuid
+        expect([child.uuid for child in restarted.task.children]) == [child.uuid for child in task.children]
+        restarted.history.undo(restarted.task)
+        expect(str(restarted.task)) == 'first\n    child\nsecond'
+        
+        self.write('changed in an editor')
+        restarted = Board(self.path)
+        expect(restarted.task.uuid) != task.uuid
+        expect(restarted.history.can_undo).is_false()
+
+    def test_restarts_from_the_parse_cache(self):
+        board = Board(self.path, parse_cache=True)
+        task = board.task
+        board.history.apply(task, [dict(action='set_status', uuid=task.children[1].uuid, status='doing')])
+        board.save()
+        board.unload()
+        expect(os.path.exists(self.path + '.parsed')).is_true()
+        
+        restarted = Board(self.path, parse_cache=True)
+        with mock.patch('todotxt.Todo.from_stream', side_effect=AssertionError('parsed again')):
+            expect([todo.uuid for todo in restarted.task.iter_tree()]) == [todo.uuid for todo in task.iter_tree()]
+        restarted.history.undo(restarted.task)
+        expect(str(restarted.task)) == 'first\n    child\nsecond'
+        restarted.save()
+        
+        self.write('changed in an editor')
+        restarted = Board(self.path, parse_cache=True)
+        expect(str(restarted.task)) == 'changed in an editor'
+        expect(restarted.task.uuid) != task.uuid
+    
+    def test_the_parse_cache_keeps_the_tree_instead_of_the_history(self):
+        board = Board(self.path, parse_cache=True)
+        uuids = [todo.uuid for todo in board.task.iter_tree()]
+        board.unload()
+        expect(os.path.exists(self.path + '.parsed')).is_true()
+        expect(os.path.exists(board.history.snapshot_path)).is_false()
+        
+        restarted = Board(self.path, parse_cache=True)
+        expect([todo.uuid for todo in restarted.task.iter_tree()]) == uuids
+        restarted.history.apply(restarted.task, [dict(action='delete', uuid=restarted.task.children[0].uuid)])
+        restarted.save()
+        restarted.unload()
+        
+        restarted = Board(self.path)
+        expect([todo.uuid for todo in restarted.task.iter_tree()]) == uuids[:1] + uuids[3:]
+        restarted.history.undo(restarted.task)
+        expect(str(restarted.task)) == 'first\n    child\nsecond'
+    
+    def test_unloads_the_least_recently_used_boards(self):
+        directory = os.path.dirname(self.path)
+        boards = []
+        for name in ('a', 'b', 'c'):
+            path = os.path.join(directory, f'{name}.txt')
+            with open(path, mode='w', encoding='utf8') as f:
+                f.write(f'board {name}\n    task\nsecond')
+            boards.append(Board.for_path(path))
+            self.addCleanup(boards[-1].unload)
+        a, b, c = boards
+        tasks = [board.task for board in boards]
+        a.task # now b is the least recently used
+        
+        Board.unload_least_recently_used(max_boards=2)
+        expect(a.task).is_(tasks[0])
+        expect(c.task).is_(tasks[2])
+        expect(b.task).not_is_(tasks[1])
+        expect([todo.uuid for todo in b.task.iter_tree()]) == [todo.uuid for todo in tasks[1].iter_tree()]
+        
+        in_use, release = threading.Event(), threading.Event()
+        def use_a():
+            with a.lock:
+                in_use.set()
+                release.wait()
+        thread = threading.Thread(target=use_a)
+        thread.start()
+        in_use.wait()
+        try:
+            Board.unload_least_recently_used(max_size=os.stat(a.path).st_size)
+        finally:
+            release.set()
+            thread.join()
+        expect(a.task).is_(tasks[0])
+        expect(c.task).not_is_(tasks[2])
@@ -0,0 +1,311 @@
+"""
+The history of a board: every batch of operations applied to it, in an append-only log next to todo.txt.
+
+Each batch is logged with the operations as applied, see `Todo.apply_recorded_operation()`, and their
+inverses, which makes undo and redo cheap and lets a restarted server rebuild the tree with the same uuids
+by replaying the log on top of the last snapshot instead of handing out new ones.
+    
+    todo.txt.history    one json object per line: {"sequence", "kind": "do"|"undo"|"redo", "operations", "inverses"}
+    todo.txt.snapshot   a header with the format version and the sequence of the last logged batch it includes,
+                        then the tree without parsed metadata in marshal format, see `Todo.flattened()`,
+                        so restoring it is faster than parsing todo.txt
+    todo.txt.stacks     {"sequence", "undo", "redo"}: the undo and redo stacks as of the batch with that sequence,
+                        apart from the tree so resume() does not have to read it
+
+The log is compacted into a new snapshot every `compact_after` batches. todo.txt stays the source of truth:
+if it was changed behind our back, the history starts over from the freshly parsed tree.
+
+Not thread safe, all access has to happen while holding the lock of the board.
+"""
+
+import gc
+import json
+import marshal
+import os
+import struct
+import tempfile
+
+from todotxt import InvalidOperation, Todo
+
+class RollbackFailed(Exception):
+    "A failed batch could not be reverted, so the tree is in an unknown state."
+
+class History:
+    
+    MAGIC = b'history\x00'
+    # Changes whenever the layout of the snapshot or of Todo.flattened() changes
+    VERSION = 2
+    # magic, version, marshal version, sequence of the last logged batch
+    HEADER = struct.Struct('>8sHHQ')
+    
+    def __init__(self, path, keep=100, compact_after=1000, run_blocking=lambda function, *args: function(*args)):
+        """path is the todo.txt this is the history of, keep is how many batches can be undone.
+        
+        Writing the log and the snapshots goes through run_blocking, see `Board.run_blocking`.
+        """
+        self.log_path = path + '.history'
+        self.snapshot_path = path + '.snapshot'
+        self.stacks_path = path + '.stacks'
+        self.keep = keep
+        self.compact_after = compact_after
+        self.run_blocking = run_blocking
+        self._undo = [] # (operations, inverses) of each batch
+        self._redo = []
+        self._sequence = 0
+        self._logged_since_snapshot = 0
+        self._needs_snapshot = True
+        self._log = None
+    
+    def __repr__(self):
+        return f'<History(log_path={self.log_path!r})>'
+    
+    @property
+    def sequence(self):
+        "Of the last logged batch."
+        return self._sequence
+    
+    @property
+    def can_undo(self):
+        return bool(self._undo)
+    
+    @property
+    def can_redo(self):
+        return bool(self._redo)
+    
+    def apply(self, task, operations):
+        """Applies a batch of operations to the tree of task and logs it, returns the changed todos.
+        
+        If one of the operations fails, the ones before it are reverted before the error is raised.
+        """
+        if self._needs_snapshot:
+            self.run_blocking(self._snapshot, task)
+        changed, applied, inverses = self._apply_all(task, operations)
+        self._undo.append((applied, inverses))
+        del self._undo[:-self.keep]
+        self._redo.clear()
+        self.run_blocking(self._append, 'do', applied, inverses)
+        return changed
+    
+    def undo(self, task):
+        "Reverts the last batch that was not undone yet, returns the changed todos."
+        if not self._undo:
+            raise InvalidOperation('nothing to undo')
+        if self._needs_snapshot:
+            self.run_blocking(self._snapshot, task)
+        operations, inverses = self._undo[-1]
+        changed, applied, _ = self._apply_all(task, reversed(inverses))
+        self._redo.append(self._undo.pop())
+        self.run_blocking(self._append, 'undo', applied)
+        return changed
+    
+    def redo(self, task):
+        "Applies the last undone batch again, returns the changed todos."
+        if not self._redo:
+            raise InvalidOperation('nothing to redo')
+        if self._needs_snapshot:
+            self.run_blocking(self._snapshot, task)
+        operations, inverses = self._redo[-1]
+        changed, applied, _ = self._apply_all(task, operations)
+        self._undo.append(self._redo.pop())
+        self.run_blocking(self._append, 'redo', applied)
+        return changed
+    
+    def restore(self):
+        "The tree as of the last logged batch, with its uuids, or None if there is no snapshot."
+        stacks, snapshot = self._read_stacks(), self._read_snapshot()
+        if stacks is None or snapshot is None or stacks['sequence'] > snapshot[0]:
+            return None
+        
+        sequence, flattened = snapshot
+        # see ParseCache.load()
+        was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            task = Todo.from_flattened(*flattened)
+        except (ValueError, TypeError, AssertionError):
+            return None
+        finally:
+            if was_enabled:
+                gc.enable()
+        self._set_stacks(stacks)
+        for entry in self._read_log():
+            if entry['sequence'] <= self._sequence:
+                continue # compacted into the stacks already
+            try:
+                if entry['sequence'] > sequence: # else writing the stacks after the tree was interrupted
+                    self._apply_all(task, entry['operations'])
+                self._replay_stacks(entry)
+            except Exception:
+                return None # the log does not belong to this snapshot, start over from todo.txt
+            self._sequence = entry['sequence']
+            self._logged_since_snapshot += 1
+        
+        self._needs_snapshot = False
+        return task
+    
+    def resume(self, sequence):
+        """Continues the history of a tree that was kept elsewhere as of batch `sequence`, see parsecache.py.
+        
+        Only the undo and redo stacks are restored, the tree is not rebuilt. False if the history
+        does not end with that batch, restore() or reset() have to be used then.
+        """
+        if not os.path.exists(self.stacks_path):
+            # started over since, and nothing was changed after that
+            self._undo, self._redo, self._sequence = [], [], sequence
+            self._logged_since_snapshot = 0
+            self._needs_snapshot = True
+            return next(self._read_log(), None) is None
+        
+        stacks = self._read_stacks()
+        if stacks is None:
+            return False
+        self._set_stacks(stacks)
+        for entry in self._read_log():
+            if entry['sequence'] <= self._sequence:
+                continue # compacted into the stacks already
+            try:
+                self._replay_stacks(entry)
+            except IndexError:
+                return False # the log does not belong to this snapshot
+            self._sequence = entry['sequence']
+            self._logged_since_snapshot += 1
+        
+        self._needs_snapshot = False
+        return self._sequence == sequence
+    
+    def reset(self):
+        "Starts over, e.g. because todo.txt was changed by someone else. The next change writes a new snapshot."
+        self._close_log()
+        for path in (self.log_path, self.snapshot_path, self.stacks_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self._undo.clear()
+        self._redo.clear()
+        self._logged_since_snapshot = 0
+        self._needs_snapshot = True
+    
+    def checkpoint(self, task):
+        "Makes sure restore() can rebuild task, even if nothing was changed since the history started over."
+        if self._needs_snapshot:
+            self.run_blocking(self._snapshot, task)
+    
+    def close(self):
+        "Closes the log, it is opened again when needed."
+        self._close_log()
+    
+    def _apply_all(self, task, operations):
+        changed, applied, inverses = [], [], []
+        try:
+            for operation in operations:
+                changed_todos, operation, inverse = task.apply_recorded_operation(operation)
+                changed.extend(changed_todos)
+                applied.append(operation)
+                inverses.append(inverse)
+        except:
+            try:
+                for inverse in reversed(inverses):
+                    task.apply_operation(inverse)
+            except Exception as error:
+                raise RollbackFailed(f'could not revert {inverse}') from error
+            raise
+        return changed, applied, inverses
+    
+    def _replay_stacks(self, entry):
+        "Does to the undo and redo stacks what happened when the entry was logged."
+        if 'do' == entry['kind']:
+            self._undo.append((entry['operations'], entry['inverses']))
+            del self._undo[:-self.keep]
+            self._redo.clear()
+        elif 'undo' == entry['kind']:
+            self._redo.append(self._undo.pop())
+        elif 'redo' == entry['kind']:
+            self._undo.append(self._redo.pop())
+    
+    def _append(self, kind, operations, inverses=None):
+        self._sequence += 1
+        entry = dict(sequence=self._sequence, kind=kind, operations=operations)
+        if inverses is not None:
+            entry['inverses'] = inverses
+        if self._log is None:
+            self._log = open(self.log_path, mode='a', encoding='utf8')
+        # REFACT not fsynced, a crash can lose the last batches, just like it can lose the last unwritten changes of the board
+        self._log.write(json.dumps(entry) + '\n')
+        self._log.flush()
+        
+        self._logged_since_snapshot += 1
+        if self._logged_since_snapshot >= self.compact_after:
+            self._needs_snapshot = True
+    
+    def _snapshot(self, task):
+        "Writes the current state and empties the log, which it includes."
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, marshal.version, self._sequence)
+        self._replace(self.snapshot_path, header, marshal.dumps(task.root.flattened(with_metadata=False)))
+        # after the tree, so stacks that are newer than the tree are never read
+        stacks = dict(sequence=self._sequence, undo=self._undo, redo=self._redo)
+        self._replace(self.stacks_path, json.dumps(stacks).encode('utf8'))
+        
+        self._close_log()
+        open(self.log_path, mode='w').close()
+        self._logged_since_snapshot = 0
+        self._needs_snapshot = False
+    
+    def _replace(self, path, *chunks):
+        "Writes the file atomically."
+        directory, name = os.path.split(path)
+        temporary_file = tempfile.NamedTemporaryFile(mode='wb', dir=directory, prefix=f'.{name}.', suffix='.tmp', delete=False)
+        try:
+            with temporary_file:
+                for chunk in chunks:
+                    temporary_file.write(chunk)
+            os.replace(temporary_file.name, path)
+        except:
+            os.unlink(temporary_file.name)
+            raise
+    
+    def _read_stacks(self):
+        try:
+            with open(self.stacks_path, encoding='utf8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+    
+    def _set_stacks(self, stacks):
+        self._undo = [tuple(batch) for batch in stacks['undo']]
+        self._redo = [tuple(batch) for batch in stacks['redo']]
+        self._sequence = stacks['sequence']
+        self._logged_since_snapshot = 0
+    
+    def _read_snapshot(self):
+        "(sequence, flattened tree), or None if there is none or it can not be read."
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < self.HEADER.size:
+            return None
+        magic, version, marshal_version, sequence = self.HEADER.unpack_from(data)
+        if (magic, version, marshal_version) != (self.MAGIC, self.VERSION, marshal.version):
+            return None
+        try:
+            return sequence, marshal.loads(memoryview(data)[self.HEADER.size:])
+        except (ValueError, EOFError, TypeError):
+            return None
+    
+    def _read_log(self):
+        try:
+            with open(self.log_path, encoding='utf8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        return # torn write of the last entry
+        except FileNotFoundError:
+            return
+    
+    def _close_log(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
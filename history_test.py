@@ -0,0 +1,190 @@
+from unittest import TestCase, mock
+import os
+import sys
+import tempfile
+
+from pyexpect import expect
+
+from history import History
+from todotxt import InvalidOperation, Todo
+
+class HistoryTest(TestCase):
+    
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'todo.txt')
+        self.history = self.new_history()
+        self.root = Todo.from_lines('first\n    child\nsecond')
+    
+    def new_history(self, **options):
+        history = History(self.path, **options)
+        self.addCleanup(history.close)
+        return history
+    
+    def uuids(self, task):
+        return [todo.uuid for todo in task.iter_tree()]
+    
+    def test_undoes_and_redoes_batches(self):
+        first, second = self.root.children
+        self.history.apply(self.root, [
+            dict(action='set_status', uuid=second.uuid, status='doing'),
+            dict(action='add_child', uuid=second.uuid, child=dict(line='new')),
+        ])
+        self.history.apply(self.root, [dict(action='delete', uuid=first.uuid)])
+        expect(str(self.root)) == 'second status:doing\n    new'
+        
+        changed = self.history.undo(self.root)
+        expect(str(self.root)) == 'first\n    child\nsecond status:doing\n    new'
+        expect(changed[1]).is_(self.root.children[0])
+        expect(self.root.children[0].uuid) == first.uuid
+        self.history.undo(self.root)
+        expect(str(self.root)) == 'first\n    child\nsecond'
+        with self.assertRaises(InvalidOperation):
+            self.history.undo(self.root)
+        
+        self.history.redo(self.root)
+        expect(str(self.root)) == 'first\n    child\nsecond status:doing\n    new'
+        expect(self.history.can_redo).is_true()
+        self.history.apply(self.root, [dict(action='set_status', uuid=second.uuid, status='done')])
+        expect(self.history.can_redo).is_false()
+    
+    def test_rolls_back_failed_batches(self):
+        first, second = self.root.children
+        uuids = self.uuids(self.root)
+        with self.assertRaises(InvalidOperation):
+            self.history.apply(self.root, [
+                dict(action='delete', uuid=first.uuid),
+                dict(action='move', uuid=second.uuid, parent=self.root.uuid, index=0),
+                dict(action='explode', uuid=second.uuid),
+            ])
+        
+        expect(str(self.root)) == 'first\n    child\nsecond'
+        expect(self.uuids(self.root)) == uuids
+        expect(self.history.can_undo).is_false()
+    
+    def test_a_failing_operation_changes_nothing(self):
+        root = Todo.from_lines('a\n    b\n    c')
+        b, c = root.children
+        uuids = self.uuids(root)
+        for operation in [
+            dict(action='move', uuid=b.uuid, parent=c.uuid, index='x'),
+            dict(action='move', uuid=b.uuid, parent='not a uuid'),
+            dict(action='add_child', uuid=c.uuid, index='x', child=dict(line='new')),
+            dict(action='add_child', uuid=c.uuid, child=dict(line='new', children=['not a todo'])),
+        ]:
+            with self.assertRaises(InvalidOperation):
+                self.history.apply(root, [operation])
+        
+        expect(str(root)) == 'a\n    b\n    c'
+        expect(self.uuids(root)) == uuids
+        expect(self.history.can_undo).is_false()
+    
+    def test_undoes_batches_on_the_virtual_root(self):
+        root = Todo.from_lines('\nfirst\nsecond')
+        with self.assertRaises(InvalidOperation):
+            self.history.apply(root, [dict(action='set_status', uuid=root.uuid, status='done')])
+        expect(self.history.can_undo).is_false()
+        
+        self.history.apply(root, [dict(action='edit_line', uuid=root.uuid, body='\n')])
+        expect(str(root)) == '\n\nfirst\nsecond'
+        self.history.undo(root)
+        expect(str(root)) == '\nfirst\nsecond'
+        self.history.redo(root)
+        expect(str(root)) == '\n\nfirst\nsecond'
+    
+    def test_restores_the_tree_with_its_uuids_and_history(self):
+        first, second = self.root.children
+        self.history.apply(self.root, [dict(action='add_child', uuid=first.uuid, child=dict(line='new'))])
+        self.history.apply(self.root, [dict(action='move', uuid=second.uuid, parent=first.uuid, index=0)])
+        self.history.apply(self.root, [dict(action='edit_line', uuid=first.uuid, line='renamed')])
+        self.history.undo(self.root)
+        
+        restored_history = self.new_history()
+        restored = restored_history.restore()
+        expect(str(restored)) == str(self.root)
+        expect(self.uuids(restored)) == self.uuids(self.root)
+        
+        restored_history.redo(restored)
+        expect(str(restored)) == 'renamed\n    second\n    child\n    new'
+        restored_history.undo(restored)
+        restored_history.undo(restored)
+        expect(str(restored)) == 'first\n    child\n    new\nsecond'
+    
+    def test_restores_trees_deeper_than_the_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 100
+        root = Todo.from_lines('\n'.join(' ' * Todo.INDENT * level + f'level {level}' for level in range(depth)))
+        self.history.apply(root, [dict(action='delete', uuid=root.children[0].uuid)])
+        self.history.undo(root)
+        
+        restored_history = self.new_history()
+        restored = restored_history.restore()
+        expect(str(restored)) == str(root)
+        expect(self.uuids(restored)) == self.uuids(root)
+        restored_history.redo(restored)
+        expect(str(restored)) == 'level 0'
+    
+    def test_resumes_the_stacks_for_a_tree_kept_elsewhere(self):
+        second = self.root.children[1]
+        self.history.apply(self.root, [dict(action='set_status', uuid=second.uuid, status='doing')])
+        self.history.apply(self.root, [dict(action='set_status', uuid=second.uuid, status='done')])
+        
+        expect(self.new_history().resume(self.history.sequence - 1)).is_false()
+        resumed = self.new_history()
+        with mock.patch('history.marshal.loads', side_effect=AssertionError('read the tree')):
+            expect(resumed.resume(self.history.sequence)).is_true()
+        resumed.undo(self.root)
+        expect(str(self.root)) == 'first\n    child\nsecond status:doing'
+        
+        self.history.reset()
+        expect(self.new_history().resume(3)).is_true()
+    
+    def test_compacts_the_log_into_a_snapshot(self):
+        history = self.new_history(keep=3, compact_after=5)
+        second = self.root.children[1]
+        for status in ['doing', 'done'] * 6:
+            history.apply(self.root, [dict(action='set_status', uuid=second.uuid, status=status)])
+        
+        with open(history.log_path, encoding='utf8') as f:
+            expect(len(f.readlines())) == 2
+        with open(history.snapshot_path, 'rb') as f:
+            expect(History.HEADER.unpack(f.read(History.HEADER.size))[-1]) == 10
+        
+        restored_history = self.new_history(keep=3)
+        restored = restored_history.restore()
+        expect(str(restored)) == str(self.root)
+        for _ in range(3):
+            restored_history.undo(restored)
+        expect(restored_history.can_undo).is_false()
+        expect(str(restored)) == 'first\n    child\nsecond status:doing'
+        expect(restored.query(status='doing')) == [restored.children[1]]
+    
+    def test_restores_the_stacks_if_writing_them_was_interrupted(self):
+        history = self.new_history(compact_after=2)
+        second = self.root.children[1]
+        history.apply(self.root, [dict(action='set_status', uuid=second.uuid, status='doing')])
+        history.apply(self.root, [dict(action='set_status', uuid=second.uuid, status='done')])
+        replace = history._replace
+        def fail_to_write_the_stacks(path, *chunks):
+            if path == history.stacks_path:
+                raise OSError('disk full')
+            replace(path, *chunks)
+        with mock.patch.object(history, '_replace', side_effect=fail_to_write_the_stacks):
+            with self.assertRaises(OSError):
+                history.apply(self.root, [dict(action='delete', uuid=self.root.children[0].uuid)])
+        
+        restored_history = self.new_history()
+        restored = restored_history.restore()
+        expect(str(restored)) == 'first\n    child\nx second'
+        restored_history.undo(restored)
+        restored_history.undo(restored)
+        expect(str(restored)) == 'first\n    child\nsecond'
+        expect(restored_history.can_undo).is_false()
+    
+    def test_starts_over_after_a_reset(self):
+        self.history.apply(self.root, [dict(action='delete', uuid=self.root.children[0].uuid)])
+        self.history.reset()
+        expect(self.history.can_undo).is_false()
+        expect(self.new_history().restore()).is_none()
+        expect(os.listdir(os.path.dirname(self.path))) == []
@@ -0,0 +1,155 @@
+"""
+Measures how long it takes until a change reaches every other client on the same board.
+    
+    python loadtest.py --clients 300 --changes 50
+    python loadtest.py --url http://localhost:5000 --clients 300
+
+Without --url it starts server.py on a free port with a throwaway todo.txt. One client sends edit_line
+operations, all the others are connected to the same board and note when the delta arrives.
+Reports the percentiles of the latency over all deliveries, in milliseconds.
+
+The changes overwrite the first line of the board, so use a throwaway board with --url. All clients
+run in this process, so with many changes per second this process can become the bottleneck.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import socketio
+
+def main(arguments=None):
+    arguments = parse_arguments(arguments)
+    if arguments.url is not None:
+        results = run(arguments.url, arguments)
+    else:
+        with running_server() as url:
+            results = run(url, arguments)
+    
+    if arguments.json:
+        print(json.dumps(results))
+    else:
+        print(' '.join(f'{key}={value}' for key, value in results.items()))
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', help='of a running server, by default server.py is started')
+    parser.add_argument('--board', help='name of the board to use, see BOARDS_DIRECTORY')
+    parser.add_argument('--clients', type=int, default=300)
+    parser.add_argument('--changes', type=int, default=50)
+    parser.add_argument('--interval', type=float, default=0.2, help='seconds between changes')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for the last deliveries')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    return parser.parse_args(arguments)
+
+class running_server:
+    "Starts server.py on a free port with an empty board, stops it again when leaving the with block."
+    
+    def __enter__(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'todo.txt')
+        with open(path, 'w', encoding='utf8') as f:
+            f.write('load test\n    first\n    second\n')
+        port = free_port()
+        self.server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'server.py'),
+            '--port', str(port), '--todo-file', path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        url = f'http://127.0.0.1:{port}'
+        self.path = path
+        wait_until_up(url, self.server)
+        return url
+    
+    def __exit__(self, *exception_info):
+        self.server.terminate()
+        self.server.wait()
+        self.directory.cleanup()
+
+def free_port():
+    with socket.socket() as listening_socket:
+        listening_socket.bind(('127.0.0.1', 0))
+        return listening_socket.getsockname()[1]
+
+def wait_until_up(url, server, timeout=20):
+    deadline = time.monotonic() + timeout
+    while True:
+        assert server.poll() is None, f'server exited with {server.returncode}'
+        try:
+            with urllib.request.urlopen(url + '/api/v1/todos?depth=0'):
+                return
+        except OSError:
+            assert time.monotonic() < deadline, f'server at {url} did not come up'
+            time.sleep(0.1)
+
+def run(url, arguments):
+    query = '' if arguments.board is None else f'?board={arguments.board}'
+    api_url = url + ('/api/v1/todos' if arguments.board is None else f'/api/v1/boards/{arguments.board}/todos')
+    with urllib.request.urlopen(api_url + '?depth=1') as response:
+        uuid = json.load(response)['json']['uuid']
+    
+    sent = dict() # change number -> time it was sent
+    latencies = []
+    lock = threading.Lock()
+    
+    def on_delta(delta):
+        received = time.perf_counter()
+        for changed in delta['changed']:
+            if changed.get('line', '').startswith('load test '):
+                number = int(changed['line'].split()[-1])
+                with lock:
+                    latencies.append(received - sent[number])
+    
+    receivers = []
+    try:
+        for _ in range(arguments.clients):
+            receiver = socketio.Client()
+            receiver.on('delta', on_delta)
+            receiver.connect(url + query, transports=['websocket'])
+            receivers.append(receiver)
+        sender = socketio.Client()
+        sender.connect(url + query, transports=['websocket'])
+        receivers.append(sender)
+        
+        started = time.perf_counter()
+        for number in range(arguments.changes):
+            sent[number] = time.perf_counter()
+            sender.emit('update_todo', dict(action='edit_line', uuid=uuid, line=f'load test {number}'))
+            time.sleep(arguments.interval)
+        
+        expected = arguments.clients * arguments.changes
+        deadline = time.monotonic() + arguments.timeout
+        while len(latencies) < expected and time.monotonic() < deadline:
+            time.sleep(0.05)
+        duration = time.perf_counter() - started
+    finally:
+        for client in receivers:
+            client.disconnect()
+    
+    with lock:
+        latencies = sorted(latencies)
+    return dict(
+        clients=arguments.clients,
+        changes=arguments.changes,
+        delivered=len(latencies),
+        expected=expected,
+        seconds=round(duration, 2),
+        p50_ms=percentile(latencies, 50),
+        p90_ms=percentile(latencies, 90),
+        p99_ms=percentile(latencies, 99),
+        max_ms=percentile(latencies, 100),
+    )
+
+def percentile(sorted_values, percent):
+    "Nearest rank, in milliseconds, None without values."
+    if not sorted_values:
+        return None
+    index = max(0, -(-len(sorted_values) * percent // 100) - 1)
+    return round(sorted_values[int(index)] * 1000, 1)
+
+if __name__ == '__main__':
+    main()
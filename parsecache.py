@@ -0,0 +1,77 @@
+"""
+A cache of the parsed tree of a board next to its todo.txt, so a restarted server does not have to parse
+large boards again, and their uuids survive the restart.
+    
+    todo.txt.parsed     a header with the format version, the sha256 of the text the tree was parsed from
+                        and the sequence of the history it includes, then the tree in marshal format,
+                        see `Todo.flattened()`: depth, line, body, uuid and parsed metadata of each todo
+
+It is only used if the text still has the same hash, so todo.txt stays the source of truth.
+The cache is written when a board is unloaded or the process exits, see `Board.checkpoint()`.
+"""
+
+import gc
+import hashlib
+import marshal
+import os
+import struct
+import tempfile
+
+from todotxt import Todo
+
+class ParseCache:
+    
+    MAGIC = b'todotxt\x00'
+    # Changes whenever the layout of the header or of Todo.flattened() changes
+    VERSION = 1
+    # magic, version, marshal version, sha256 of the text, history sequence
+    HEADER = struct.Struct('>8sHH32sQ')
+    
+    def __init__(self, path):
+        "path is the todo.txt this caches the tree of."
+        self.path = path + '.parsed'
+    
+    def __repr__(self):
+        return f'<ParseCache(path={self.path!r})>'
+    
+    def load(self, text):
+        "(tree, history sequence) if the cache was written for text, else None."
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < self.HEADER.size:
+            return None
+        magic, version, marshal_version, digest, sequence = self.HEADER.unpack_from(data)
+        if (magic, version, marshal_version, digest) != (self.MAGIC, self.VERSION, marshal.version, digest_of(text)):
+            return None
+        
+        # the tree is millions of new objects, which would trigger the cycle collector many times over for nothing
+        was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            task = Todo.from_flattened(*marshal.loads(memoryview(data)[self.HEADER.size:]))
+        except (ValueError, EOFError, TypeError, AssertionError):
+            return None # damaged, it is parsed again and the cache rewritten
+        finally:
+            if was_enabled:
+                gc.enable()
+        return task, sequence
+    
+    def store(self, task, text, sequence):
+        "Writes the tree of task, which has to be the parsed text, atomically."
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, marshal.version, digest_of(text), sequence)
+        directory, name = os.path.split(self.path)
+        temporary_file = tempfile.NamedTemporaryFile(mode='wb', dir=directory, prefix=f'.{name}.', suffix='.tmp', delete=False)
+        try:
+            with temporary_file:
+                temporary_file.write(header)
+                marshal.dump(task.flattened(), temporary_file)
+            os.replace(temporary_file.name, self.path)
+        except:
+            os.unlink(temporary_file.name)
+            raise
+
+def digest_of(text):
+    return hashlib.sha256(text.encode('utf8')).digest()
@@ -0,0 +1,45 @@
+from unittest import TestCase, mock
+import os
+import tempfile
+
+from pyexpect import expect
+
+from parsecache import ParseCache
+from todotxt import Todo
+
+class ParseCacheTest(TestCase):
+    
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = ParseCache(os.path.join(directory.name, 'todo.txt'))
+        self.text = 'first #1 @home\n    x child +project due:"next week"\n            body\n\n        \nsecond'
+        self.task = Todo.from_lines(self.text)
+    
+    def test_restores_the_tree_with_its_uuids_and_parsed_lines(self):
+        self.cache.store(self.task, self.text, 42)
+        with mock.patch.object(Todo.Parser, 'parse', side_effect=AssertionError('parsed again')):
+            restored, sequence = self.cache.load(self.text)
+            expect(sequence) == 42
+            expect(str(restored)) == self.text
+            expect([todo.uuid for todo in restored.iter_tree()]) == [todo.uuid for todo in self.task.iter_tree()]
+            expect([todo.metadata[:-1] for todo in restored.iter_tree() if not todo.is_virtual]) \
+                == [todo.metadata[:-1] for todo in self.task.iter_tree() if not todo.is_virtual]
+            expect(restored.query(projects=['project'])) == [restored.children[0].children[0]]
+        
+        # usable like a parsed tree
+        child = restored.children[0].children[0]
+        expect(child.parent).is_(restored.children[0])
+        restored.apply_operation(dict(action='set_status', uuid=child.uuid, status='doing'))
+        expect(child.line) == '    child +project due:"next week" status:doing'
+    
+    def test_ignores_caches_of_other_texts_and_damaged_ones(self):
+        expect(self.cache.load(self.text)).is_none()
+        self.cache.store(self.task, self.text, 0)
+        expect(self.cache.load(self.text + '\nthird')).is_none()
+        
+        with open(self.cache.path, 'r+b') as f:
+            f.seek(ParseCache.HEADER.size + 10)
+            f.write(b'\xff\xff\xff')
+        expect(self.cache.load(self.text)).is_none()
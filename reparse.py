@@ -0,0 +1,342 @@
+"""
+Incremental reparsing: the operations (see `Todo.on_operation()`) that make the tree follow an edit of some lines
+of its text, without parsing the rest of the text again.
+    
+    lines = Lines(task)
+    operations = lines.replace(start, stop, ['new line', '    and its child'])
+    for operation in operations:
+        task.apply_operation(operation)
+
+Only the children of the innermost task that contains the edited lines are parsed again, and only those
+whose lines were edited, plus the one before if the new lines continue its body or children. If the new
+lines are indented less than those children, the edit is about the task further up, and so on.
+If only the line and body of a task are edited, its children stay where they are, with the last task
+the new lines start on that level, so editing the line of a large project does not parse all of it again.
+
+The reparsed tasks are matched to the ones they replace by their lines, so they keep their uuids,
+and every other task is not touched at all.
+
+Finding a line uses the number of lines of each subtree, which are counted once and then kept up to date.
+The counts of the children of a task are summed up in blocks, so locating a line skips over most siblings
+a block at a time, even on boards with tens of thousands of tasks on one level.
+"""
+
+from bisect import bisect_right
+from itertools import accumulate
+
+from todotxt import Todo
+from treediff import Patch
+
+BLOCK_SIZE = 64
+
+class Lines:
+    """The lines of str(task), as they are spread over the tree.
+    
+    Only valid as long as the tree changes through the operations of replace(), which have to be applied
+    before the next call. Use a new instance after changing the tree in other ways.
+    """
+    
+    def __init__(self, task):
+        self.task = task
+        self._children_lines = dict() # id of todo -> (todo, LineCounts of its children)
+    
+    def __len__(self):
+        return self.count(self.task)
+    
+    def count(self, todo):
+        "The number of lines of the subtree of todo."
+        if not todo.has_children():
+            return self._own_lines(todo)
+        return self._own_lines(todo) + self._counts(todo).total
+    
+    def locate(self, number):
+        """The todos on the way from the root down to the one line `number` belongs to.
+        
+        A list of (todo, number of its first line, index in its parent), None if there is no such line.
+        """
+        todo, first, index = self.task, 0, None
+        path = [(todo, first, index)]
+        while True:
+            own_lines = self._own_lines(todo)
+            if number < first + own_lines:
+                return path
+            if not todo.has_children():
+                return None
+            counts = self._counts(todo)
+            offset = number - first - own_lines
+            if offset >= counts.total:
+                return None
+            index, within = counts.find(offset)
+            todo, first = todo.children[index], number - within
+            path.append((todo, first, index))
+    
+    def replace(self, start, stop, new_lines):
+        """The operations that replace the lines from start up to stop with new_lines.
+        
+        None if that changes what the root is, e.g. adds a second top level task to a board with only one,
+        or edits the lines at the start of the board that are not part of any task. Parse it all again then.
+        """
+        length = len(self)
+        assert 0 <= start <= stop <= length, f'no lines {start}:{stop}'
+        if 0 == length:
+            return None
+        path = self.locate(min(start, length - 1))
+        # the edit is about the children of the parent of the todo it starts in, or something further up
+        for depth in reversed(range(len(path) - 1)):
+            region = self._region(path[depth], start, stop, new_lines)
+            if region is not None:
+                return self._replace_children(path[:depth + 1], *region)
+        return None
+    
+    def _region(self, step, start, stop, new_lines):
+        """(index, stop index, a virtual todo with the parsed children, whether only the own lines of the last child
+        are replaced) for the children of container the edit replaces, or None if it reaches further up."""
+        container, first, _ = step
+        children_start = first + self._own_lines(container)
+        if start < children_start or not container.has_children():
+            return None
+        counts = self._counts(container)
+        if stop > children_start + counts.total:
+            return None
+        
+        children = container.children
+        index, within = counts.find(start - children_start)
+        line = start - within
+        if stop > start:
+            last, within = counts.find(stop - 1 - children_start)
+            last_line = stop - 1 - within
+        elif index < len(children):
+            last, last_line = index, line
+        else:
+            last, last_line = None, None
+        
+        stop_index = index if last is None else last + 1
+        own_only = last is not None and children[last].has_children() \
+            and stop <= last_line + self._own_lines(children[last])
+        level = Todo.Parser.indentation_level(container.line) + 1
+        while True:
+            if last is None:
+                lines_stop = stop
+            elif own_only:
+                lines_stop = last_line + self._own_lines(children[last])
+            else:
+                lines_stop = last_line + counts[last]
+            lines = self._text_lines(line, start) + new_lines + self._text_lines(stop, lines_stop)
+            if lines and not is_task_line(lines[0], level):
+                if index == 0:
+                    return None # would become part of the body of container
+                # continues the body or children of the child before
+                index -= 1
+                line -= counts[index]
+                continue
+            if own_only and not lines:
+                own_only = False # the children of the last child need another task to belong to
+                continue
+            break
+        
+        if any(Todo.Parser.indentation_level(each) < level for each in lines if not Todo.Parser.is_whitespace(each)):
+            return None
+        parsed = Todo.children_from_lines(lines, level)
+        new_children = parsed.children if parsed.has_children() else []
+        if container is self.task and container.line is None and not container.body \
+                and 1 == len(children) - (stop_index - index) + len(new_children):
+            return None # a single task becomes the root, see Todo.from_iterable()
+        return index, stop_index, parsed, own_only
+    
+    def _replace_children(self, path, index, stop_index, parsed, own_only):
+        container = path[-1][0]
+        new_children = parsed.children if parsed.has_children() else []
+        old_children = container.children[index:stop_index]
+        old_nodes = [todo for child in old_children[:-1] for todo in child.iter_tree()]
+        if own_only:
+            old_nodes.append(old_children[-1]) # its children stay
+        elif old_children:
+            old_nodes.extend(old_children[-1].iter_tree())
+        new_nodes = [todo for child in new_children for todo in child.iter_tree()]
+        matches = match_in_order(old_nodes, new_nodes)
+        keeper_inherits = False
+        if own_only:
+            # the children stay where they are and move on with the last new task on their level,
+            # best by keeping their task for it, unless that task clearly is another one of the new tasks
+            keeper, owner = old_children[-1], new_children[-1]
+            kept_as = next((new_todo for new_todo in new_nodes if matches.get(id(new_todo)) is keeper), None)
+            keeper_inherits = kept_as is None or kept_as is owner or kept_as.line.strip() != keeper.line.strip()
+            if keeper_inherits:
+                matches = {key: todo for key, todo in matches.items() if todo is not keeper}
+                matches[id(owner)] = keeper
+            tail_lines = self._counts(keeper).total
+        matches[id(parsed)] = container
+        operations = Patch(container, parsed, matches, old_nodes=old_nodes, offset=index).operations
+        if own_only and not keeper_inherits:
+            heir = matches.get(id(owner), owner)
+            offset = len(owner.children) if owner.has_children() else 0
+            operations.extend(dict(action='move', uuid=child.uuid, parent=heir.uuid, index=offset + position)
+                for position, child in enumerate(keeper.children))
+        
+        # the counts for after the operations were applied
+        new_counts = [count_lines(child) for child in new_children]
+        if own_only:
+            new_counts[-1] += tail_lines
+        if keeper_inherits and owner.has_children():
+            self._counts(keeper).replace(0, 0, [count_lines(child) for child in owner.children])
+        for todo in old_nodes:
+            if not (keeper_inherits and todo is keeper):
+                self._children_lines.pop(id(todo), None)
+        
+        delta = self._counts(container).replace(index, stop_index, new_counts)
+        for (ancestor, _, _), (_, _, child_index) in zip(reversed(path[:-1]), reversed(path[1:])):
+            self._counts(ancestor).add(child_index, delta)
+        return operations
+    
+    def _counts(self, todo):
+        "The LineCounts of the children of todo."
+        entry = self._children_lines.get(id(todo))
+        if entry is not None and entry[0] is todo:
+            return entry[1]
+        
+        # post order without recursion, deep boards would exceed the recursion limit
+        stack = [(todo, False)]
+        while stack:
+            current, children_counted = stack.pop()
+            if not children_counted:
+                stack.append((current, True))
+                stack.extend((child, False) for child in current.children if child.has_children() and not self._has_entry(child))
+                continue
+            counts = [self._own_lines(child) + (self._children_lines[id(child)][1].total if child.has_children() else 0) for child in current.children]
+            self._children_lines[id(current)] = (current, LineCounts(counts))
+        return self._children_lines[id(todo)][1]
+    
+    def _has_entry(self, todo):
+        entry = self._children_lines.get(id(todo))
+        return entry is not None and entry[0] is todo
+    
+    def _text_lines(self, start, stop):
+        "The current lines from start up to stop, only used for the few lines around an edit."
+        lines = []
+        number = start
+        while number < stop:
+            todo, first, _ = self.locate(number)[-1]
+            todo_lines = own_lines_of(todo, todo is self.task)
+            lines.extend(todo_lines[number - first:stop - first])
+            number = first + len(todo_lines)
+        return lines
+    
+    def _own_lines(self, todo):
+        return own_line_count(todo, todo is self.task)
+
+class LineCounts:
+    """The number of lines of each child of a todo.
+    
+    Kept in blocks that know their sums, so finding a line and inserting or removing children only touch
+    one or two blocks. Where the blocks start is summed up again (in C, by accumulate()) after each change.
+    """
+    
+    def __init__(self, counts):
+        self.blocks = [counts[start:start + BLOCK_SIZE] for start in range(0, len(counts), BLOCK_SIZE)]
+        self.sums = [sum(block) for block in self.blocks]
+        self.total = sum(self.sums)
+        self._starts = None
+    
+    def __len__(self):
+        return sum(map(len, self.blocks))
+    
+    def __getitem__(self, index):
+        block, index = self._block_of(index)
+        return self.blocks[block][index]
+    
+    def find(self, offset):
+        "The index of the child line offset (counted from the first child) is in and the offset in it, or the number of children at the end."
+        line_starts, index_starts = self._block_starts()
+        block = bisect_right(line_starts, offset) - 1
+        if block < 0 or offset >= self.total:
+            return len(self), offset - self.total
+        index, offset = index_starts[block], offset - line_starts[block]
+        for count in self.blocks[block]:
+            if offset < count:
+                break
+            offset -= count
+            index += 1
+        return index, offset
+    
+    def add(self, index, delta):
+        block, index = self._block_of(index)
+        self.blocks[block][index] += delta
+        self.sums[block] += delta
+        self.total += delta
+        self._starts = None
+    
+    def replace(self, start, stop, counts):
+        "Replaces the counts from start up to stop with counts, returns the change of the total."
+        if not self.blocks:
+            self.blocks, self.sums = [[]], [0]
+        first, start_in_block = self._block_of(start)
+        last = first if stop == start else self._block_of(stop - 1)[0]
+        merged = [count for block in self.blocks[first:last + 1] for count in block]
+        merged[start_in_block:start_in_block + stop - start] = counts
+        if len(merged) > 2 * BLOCK_SIZE:
+            blocks = [merged[index:index + BLOCK_SIZE] for index in range(0, len(merged), BLOCK_SIZE)]
+        else:
+            blocks = [merged] if merged else []
+        sums = [sum(block) for block in blocks]
+        delta = sum(sums) - sum(self.sums[first:last + 1])
+        self.blocks[first:last + 1] = blocks
+        self.sums[first:last + 1] = sums
+        self.total += delta
+        self._starts = None
+        return delta
+    
+    def _block_starts(self):
+        "The first line and the first index of each block."
+        if self._starts is None:
+            self._starts = ([0, *accumulate(self.sums)][:-1], [0, *accumulate(map(len, self.blocks))][:-1])
+        return self._starts
+    
+    def _block_of(self, index):
+        "The block index is in and its index there, the end of the last block for the index after the last."
+        assert self.blocks, 'index out of range'
+        index_starts = self._block_starts()[1]
+        block = bisect_right(index_starts, index) - 1
+        return block, index - index_starts[block]
+
+def count_lines(task):
+    "The number of lines of a freshly parsed subtree."
+    return sum(own_line_count(todo, False) for todo in task.iter_tree())
+
+def own_line_count(todo, is_root):
+    count = 0 if todo.line is None else 1
+    if todo.body is not None:
+        count += todo.body.count('\n') + 1
+    if 0 == count and not todo.has_children() and not is_root:
+        count = 1 # an empty child still gets its own line
+    return count
+
+def own_lines_of(todo, is_root):
+    "The lines of todo itself, without those of its children, see Todo.iter_lines()."
+    lines = []
+    if todo.line is not None:
+        lines.append(todo.line)
+    if todo.body is not None:
+        lines.extend(todo.body.split('\n'))
+    if not lines and not todo.has_children() and not is_root:
+        lines.append('')
+    return lines
+
+def is_task_line(line, level):
+    return not Todo.Parser.is_whitespace(line) and Todo.Parser.indentation_level(line) == level
+
+def match_in_order(old_nodes, new_nodes):
+    """Maps the python id() of new todos to old ones: equal lines at the start and the end,
+    the ones in between by position, as they are most likely edits of each other."""
+    matches = dict()
+    shorter = min(len(old_nodes), len(new_nodes))
+    prefix = 0
+    while prefix < shorter and old_nodes[prefix].line == new_nodes[prefix].line:
+        matches[id(new_nodes[prefix])] = old_nodes[prefix]
+        prefix += 1
+    suffix = 0
+    while suffix < shorter - prefix and old_nodes[-suffix - 1].line == new_nodes[-suffix - 1].line:
+        matches[id(new_nodes[-suffix - 1])] = old_nodes[-suffix - 1]
+        suffix += 1
+    for old_todo, new_todo in zip(old_nodes[prefix:len(old_nodes) - suffix], new_nodes[prefix:len(new_nodes) - suffix]):
+        matches[id(new_todo)] = old_todo
+    return matches
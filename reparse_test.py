@@ -0,0 +1,92 @@
+from unittest import TestCase, mock
+import random
+
+from pyexpect import expect
+
+import reparse
+from reparse import Lines
+from todotxt import Todo
+
+def shape(task):
+    return [(Todo.Parser.indentation_level(todo.line), (todo.line or '').strip(), todo.body) for todo in task.iter_tree()]
+
+class ReplaceTest(TestCase):
+    
+    def replace(self, text, start, stop, new_lines):
+        "Applies the replacement to the tree of text, returns the operations and the uuids of the old tree by line."
+        self.task = Todo.from_lines(text)
+        uuids = {todo.line.strip(): todo.uuid for todo in self.task.iter_tree() if todo.line is not None}
+        operations = Lines(self.task).replace(start, stop, new_lines)
+        for operation in operations:
+            self.task.apply_operation(operation)
+        lines = text.split('\n')
+        expect(str(self.task)) == '\n'.join(lines[:start] + new_lines + lines[stop:])
+        return operations, uuids
+    
+    def uuid_of(self, line):
+        for todo in self.task.iter_tree():
+            if todo.line is not None and todo.line.strip() == line:
+                return todo.uuid
+    
+    def test_inserts_and_deletes_tasks_next_to_their_siblings(self):
+        text = 'first\n    child\nsecond'
+        operations, uuids = self.replace(text, 2, 2, ['    other child'])
+        expect(operations) == [dict(action='add_child', uuid=uuids['first'], index=1,
+            child=dict(uuid=self.uuid_of('other child'), line='    other child', body=None))]
+        
+        operations, uuids = self.replace(text, 1, 2, [])
+        expect(operations) == [dict(action='delete', uuid=uuids['child'])]
+    
+    def test_keeps_the_uuids_of_tasks_that_move(self):
+        operations, uuids = self.replace('first\n    child\n        grandchild\nsecond', 1, 2, ['    child', '    new child'])
+        expect(self.uuid_of('child')) == uuids['child']
+        expect(self.uuid_of('grandchild')) == uuids['grandchild']
+        expect(shape(self.task)) == shape(Todo.from_lines('first\n    child\n    new child\n        grandchild\nsecond'))
+        
+        operations, uuids = self.replace('first\nsecond\n    child\nthird', 1, 2, ['    second'])
+        expect(self.uuid_of('second')) == uuids['second']
+        expect(self.uuid_of('child')) == uuids['child']
+    
+    def test_leaves_the_children_alone_when_only_the_line_of_their_task_is_edited(self):
+        children = [f'    child {number}' for number in range(100)]
+        text = '\n'.join(['first', 'second', *children])
+        operations, uuids = self.replace(text, 1, 2, ['new task', 'second'])
+        expect(operations) == [dict(action='add_child', uuid=self.task.uuid, index=1,
+            child=dict(uuid=self.uuid_of('new task'), line='new task', body=None))]
+    
+    def test_replaces_deeply_nested_tasks_without_recursion(self):
+        chain = [f'{"    " * level}level {level}' for level in range(1, 1200)]
+        operations, uuids = self.replace('\n'.join(['first', *chain, 'last']), 1, 1200, [*chain[:-1], chain[-1] + ' edited'])
+        expect(operations) == [dict(action='edit_line', uuid=uuids['level 1199'], line=chain[-1] + ' edited')]
+    
+    def test_needs_a_full_parse_if_the_root_changes(self):
+        expect(Lines(Todo.from_lines('first\nsecond')).replace(1, 2, [])).is_none()
+        expect(Lines(Todo.from_lines('first\n    child')).replace(2, 2, ['second'])).is_none()
+        # would become the body of the root
+        expect(Lines(Todo.from_lines('first\n    child\nsecond')).replace(0, 1, ['    first'])).is_none()
+    
+    def test_edits_keep_the_tree_as_if_parsed_again(self):
+        generator = random.Random(3)
+        lines = ['first', '    child @a', '        grandchild', '            body', '', '    other child', 'second +project', '                deep body']
+        
+        with mock.patch.object(reparse, 'BLOCK_SIZE', 2): # so the lines of children span several blocks
+            for _ in range(500):
+                text = '\n'.join(generator.choice(lines) for _ in range(generator.randint(1, 30)))
+                task = Todo.from_lines(text)
+                if str(task) != text:
+                    continue # some texts are not kept exactly, e.g. a leading empty line
+                task_lines = Lines(task)
+                for _ in range(5):
+                    text_lines = str(task).split('\n')
+                    start = generator.randint(0, len(text_lines))
+                    stop = generator.randint(start, min(len(text_lines), start + 3))
+                    new_lines = [generator.choice(lines) for _ in range(generator.randint(0, 3))]
+                    expected = Todo.from_lines('\n'.join(text_lines[:start] + new_lines + text_lines[stop:]))
+                    
+                    operations = task_lines.replace(start, stop, new_lines)
+                    if operations is None:
+                        break
+                    for operation in operations:
+                        task.apply_operation(operation)
+                    expect(shape(task)) == shape(expected)
+                    expect(len(task_lines)) == len(str(task).split('\n'))
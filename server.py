@@ -0,0 +1,39 @@
+"""
+Serves the boards from one eventlet event loop, which keeps hundreds of socket.io clients connected
+without a thread each, unlike `flask run`, which is for development.
+    
+    python server.py --host 0.0.0.0 --port 5000 --boards-directory boards/
+
+Reading, parsing and writing the boards, waiting for the disk (fsync) and for other processes (flock)
+happen in eventlets thread pool, see `Board.run_blocking`, so neither a slow disk nor a large board
+stalls the broadcasts to every other board. The socket.io events are still sent from the event loop.
+"""
+
+import argparse
+import os
+
+# before anything imports socket, threading or time
+import eventlet
+eventlet.monkey_patch()
+os.environ['TASK_TRACKER_ASYNC_MODE'] = 'eventlet'
+
+from app import app, socketio
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--todo-file', default=app.config['TODO_FILE'])
+    parser.add_argument('--boards-directory', default=app.config['BOARDS_DIRECTORY'],
+        help='serve every *.txt in this directory as a board at /boards/<name>/')
+    parser.add_argument('--parse-cache', action='store_true',
+        help='keep the parsed boards in <name>.txt.parsed, so restarts with large boards are quicker')
+    arguments = parser.parse_args(arguments)
+    
+    app.config['TODO_FILE'] = arguments.todo_file
+    app.config['BOARDS_DIRECTORY'] = arguments.boards_directory
+    app.config['PARSE_CACHE'] = arguments.parse_cache
+    socketio.run(app, host=arguments.host, port=arguments.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+from unittest import TestCase, skipUnless
+import importlib.util
+import time
+
+from pyexpect import expect
+
+import loadtest
+
+@skipUnless(importlib.util.find_spec('eventlet') and importlib.util.find_spec('websocket'),
+    'needs eventlet and websocket-client')
+class ServerTest(TestCase):
+    
+    def read_eventually(self, path, expected_start):
+        deadline = time.monotonic() + 5
+        while True:
+            with open(path, encoding='utf8') as f:
+                text = f.read()
+            if text.startswith(expected_start) or time.monotonic() > deadline:
+                return text
+            time.sleep(0.05)
+    
+    def test_broadcasts_to_many_clients_and_saves_from_the_event_loop(self):
+        server = loadtest.running_server()
+        url = server.__enter__()
+        self.addCleanup(server.__exit__)
+        
+        results = loadtest.run(url, loadtest.parse_arguments(['--clients', '20', '--changes', '5', '--interval', '0.05']))
+        expect(results['delivered']) == 100
+        expect(self.read_eventually(server.path, 'load test 4\n')) == 'load test 4\n    first\n    second\n'
@@ -0,0 +1,100 @@
+import { apply, lengthOf, operationBetween, transform, transformPosition, TextEditor } from '../textdocument.js'
+
+describe('Text document', () => {
+    
+    it('should converge when transforming concurrent operations', () => {
+        const text = 'first\nsecond'
+        const operation = [6, 'the ', 6], other = [6, -6, 'third']
+        const [operationPrime, otherPrime] = transform(operation, other)
+        expect(apply(apply(text, operation), otherPrime)).toBe('first\nthe third')
+        expect(apply(apply(text, other), operationPrime)).toBe('first\nthe third')
+    })
+    
+    it('should describe the difference of two texts', () => {
+        expect(operationBetween('first\nsecond', 'first\nthe second')).toEqual([6, 'the ', 6])
+        expect(operationBetween('same', 'same')).toEqual([])
+    })
+    
+    it('should count emoji as one character, like the server', () => {
+        expect(lengthOf('😀 done')).toBe(6)
+        expect(operationBetween('😀 first', '😀 the first')).toEqual([2, 'the ', 5])
+        expect(apply('😀 first', [2, 'the ', 5])).toBe('😀 the first')
+        const [operationPrime, otherPrime] = transform(['🎉', 7], [2, -5, 'second'])
+        expect(apply(apply('😀 first', ['🎉', 7]), otherPrime)).toBe('🎉😀 second')
+        expect(apply(apply('😀 first', [2, -5, 'second']), operationPrime)).toBe('🎉😀 second')
+        expect(transformPosition(3, ['🎉', 7])).toBe(4)
+    })
+    
+    it('should keep the cursor behind inserted text', () => {
+        expect(transformPosition(8, [6, 'the ', 6])).toBe(12)
+        expect(transformPosition(2, [6, 'the ', 6])).toBe(2)
+    })
+    
+    it('should send what was typed while waiting for the server, based on what the server did meanwhile', () => {
+        const handlers = {}, emitted = []
+        const socket = {
+            connected: true,
+            on(name, handler) { handlers[name] = handler },
+            emit(name, ...args) { const callback = args.pop(); emitted.push({ name, data: args[0], callback }) },
+        }
+        const textarea = document.createElement('textarea')
+        new TextEditor(textarea, socket)
+        emitted.shift().callback({ revision: 3, text: 'hello world' })
+        
+        textarea.value = 'hello big world'
+        textarea.dispatchEvent(new Event('input'))
+        const sent = emitted.shift()
+        expect(sent.data).toEqual({ revision: 3, operation: [6, 'big ', 5] })
+        
+        textarea.value = 'hello big world!'
+        textarea.dispatchEvent(new Event('input'))
+        handlers.text_operation({ revision: 4, operation: ['oh ', 11] })
+        expect(textarea.value).toBe('oh hello big world!')
+        
+        sent.callback({ revision: 5 })
+        expect(emitted.shift().data).toEqual({ revision: 5, operation: [18, '!'] })
+    })
+    
+    it('should keep the cursor in place behind emoji', () => {
+        const handlers = {}, emitted = []
+        const socket = {
+            connected: true,
+            on(name, handler) { handlers[name] = handler },
+            emit(name, ...args) { const callback = args.pop(); emitted.push({ name, data: args[0], callback }) },
+        }
+        const textarea = document.createElement('textarea')
+        new TextEditor(textarea, socket)
+        emitted.shift().callback({ revision: 3, text: '😀 world' })
+        textarea.setSelectionRange(3, 3)
+        
+        handlers.text_operation({ revision: 4, operation: ['🎉', 7] })
+        expect(textarea.value).toBe('🎉😀 world')
+        expect(textarea.selectionStart).toBe(5)
+        
+        textarea.value = '🎉😀 big world'
+        textarea.dispatchEvent(new Event('input'))
+        expect(emitted.shift().data).toEqual({ revision: 4, operation: [3, 'big ', 5] })
+    })
+    
+    it('should apply corrections of what it sent that arrive before the acknowledgement', () => {
+        const handlers = {}, emitted = []
+        const socket = {
+            connected: true,
+            on(name, handler) { handlers[name] = handler },
+            emit(name, ...args) { const callback = args.pop(); emitted.push({ name, data: args[0], callback }) },
+        }
+        const textarea = document.createElement('textarea')
+        new TextEditor(textarea, socket)
+        emitted.shift().callback({ revision: 3, text: 'first\n    child' })
+        
+        textarea.value = 'first\n     child'
+        textarea.dispatchEvent(new Event('input'))
+        const sent = emitted.shift()
+        handlers.text_operation({ revision: 5, operation: [10, -1, 5] })
+        expect(textarea.value).toBe('first\n     child')
+        
+        sent.callback({ revision: 4 })
+        expect(textarea.value).toBe('first\n    child')
+        expect(emitted).toEqual([])
+    })
+})
@@ -20,7 +20,7 @@ describe('Whiteboard', () => {
     }
 	
 	function socketMock() {
-		return {}
+		return { on() {}, off() {}, emit() {} }
 	}
     
     it('smokes', () => {
@@ -46,6 +46,70 @@ describe('Whiteboard', () => {
         })
     })
     
+    describe('loading children', () => {
+        
+        it('should know which tasks were sent without their children', () => {
+            let board = new Whiteboard({ propsData: { rootTask: task(), socket: socketMock() } }).$mount()
+            expect(board.isMissingChildren(task())).toBe(false)
+            expect(board.isMissingChildren(task({ child_count: 2 }))).toBe(true)
+            expect(board.isMissingChildren(task({ child_count: 1, children: [task()] }))).toBe(false)
+        })
+    })
+    
+    describe('applying deltas', () => {
+        
+        beforeEach(function() {
+            this.child = task({ uuid: 'child', line: 'child' })
+            this.root = task({ uuid: 'root', children: [task({ uuid: 'story', children: [this.child] })] })
+            this.board = new Whiteboard({ propsData: { rootTask: this.root, socket: socketMock() } }).$mount()
+        })
+        
+        it('should update changed tasks in place', function() {
+            this.board.applyDelta({ deleted: [], changed: [
+                { uuid: 'child', line: 'child status:doing', status: 'doing', parent: 'story', child_uuids: [] },
+            ]})
+            expect(this.board.task.children[0].children[0].status).toBe('doing')
+            expect(this.board.task.children[0].children[0].line).toBe('child status:doing')
+        })
+        
+        it('should update the rollups above changed tasks', function() {
+            const rollup = { total: 1, status: { new: 0, doing: 1, done: 0, unknown: 0 }, contexts: {}, projects: {} }
+            this.board.applyDelta({ deleted: [], changed: [
+                { uuid: 'child', line: 'child status:doing', status: 'doing', parent: 'story', child_uuids: [] },
+            ], rollups: { story: rollup } })
+            expect(this.board.task.children[0].rollup).toEqual(rollup)
+            expect(this.board.progressBelow(this.board.task.children[0])).toBe('0 of 1 below done')
+        })
+        
+        it('should add and remove children', function() {
+            this.board.applyDelta({ deleted: ['child'], changed: [
+                { uuid: 'story', line: 'story', status: 'new', parent: 'root', child_uuids: ['new'] },
+                { uuid: 'new', line: 'new', status: 'new', parent: 'story', child_uuids: [] },
+            ]})
+            expect(this.board.task.children[0].children.map(each => each.uuid)).toEqual(['new'])
+        })
+        
+        it('should start over when the board was replaced', async function() {
+            this.board.browse(this.board.task.children[0])
+            spyOn(window, 'fetch').and.returnValue(Promise.resolve({
+                json: () => Promise.resolve({ json: task({ uuid: 'new root', children: [task({ uuid: 'new story' })] }) }),
+            }))
+            await this.board.reloadBoard()
+            expect(this.board.task.uuid).toBe('new root')
+            expect(this.board.task.children.map(each => each.uuid)).toEqual(['new story'])
+            expect(this.board.breadcrumbs.length).toBe(1)
+        })
+        
+        it('should browse away from deleted tasks', function() {
+            this.board.browse(this.board.task.children[0])
+            this.board.applyDelta({ deleted: ['story'], changed: [
+                { uuid: 'root', parent: null, child_uuids: [] },
+            ]})
+            expect(this.board.task.uuid).toBe('root')
+            expect(this.board.breadcrumbs.length).toBe(1)
+        })
+    })
+    
     describe('rendering', () => {
         
         beforeEach(function() {
@@ -0,0 +1,207 @@
+// Edits the text of the board together with other clients, see textdocument.py for the operations.
+// Operations are arrays of components: positive numbers retain, negative numbers delete, strings insert.
+// They count code points, like Python does, not the UTF-16 code units of .length, so emoji are one character.
+
+// The number of code points in text
+export function lengthOf(text) {
+  return Array.from(text).length
+}
+
+export function apply(text, operation) {
+  const characters = Array.from(text)
+  const parts = []
+  let position = 0
+  for (const component of operation) {
+    if (typeof component === 'string') {
+      parts.push(component)
+    } else if (component > 0) {
+      parts.push(characters.slice(position, position + component).join(''))
+      position += component
+    } else {
+      position -= component
+    }
+  }
+  return parts.join('')
+}
+
+function append(operation, component) {
+  const last = operation[operation.length - 1]
+  if (typeof component === 'string' && typeof last === 'string') {
+    operation[operation.length - 1] += component
+  } else if (typeof component === 'number' && typeof last === 'number' && (component > 0) === (last > 0)) {
+    operation[operation.length - 1] += component
+  } else {
+    operation.push(component)
+  }
+}
+
+function shorten(component, length) {
+  return component > 0 ? component - length : component + length
+}
+
+// Same as transform() in textdocument.py: [operation', other'] with inserts at the same position of operation first
+export function transform(operation, other) {
+  const operationPrime = [], otherPrime = []
+  let index = 0, otherIndex = 0
+  let component = operation[index++], otherComponent = other[otherIndex++]
+  while (component !== undefined || otherComponent !== undefined) {
+    if (typeof component === 'string') {
+      append(operationPrime, component)
+      append(otherPrime, lengthOf(component))
+      component = operation[index++]
+      continue
+    }
+    if (typeof otherComponent === 'string') {
+      append(operationPrime, lengthOf(otherComponent))
+      append(otherPrime, otherComponent)
+      otherComponent = other[otherIndex++]
+      continue
+    }
+    if (component === undefined || otherComponent === undefined) {
+      throw new Error('operations of different lengths')
+    }
+
+    const length = Math.min(Math.abs(component), Math.abs(otherComponent))
+    if (component > 0 && otherComponent > 0) {
+      append(operationPrime, length)
+      append(otherPrime, length)
+    } else if (component < 0 && otherComponent > 0) {
+      append(operationPrime, -length)
+    } else if (component > 0 && otherComponent < 0) {
+      append(otherPrime, -length)
+    }
+    component = shorten(component, length)
+    otherComponent = shorten(otherComponent, length)
+    if (component === 0) { component = operation[index++] }
+    if (otherComponent === 0) { otherComponent = other[otherIndex++] }
+  }
+  return [operationPrime, otherPrime]
+}
+
+// An operation that turns text into newText, empty if they are the same
+export function operationBetween(text, newText) {
+  if (text === newText) {
+    return []
+  }
+  const characters = Array.from(text), newCharacters = Array.from(newText)
+  const shorter = Math.min(characters.length, newCharacters.length)
+  let start = 0, end = 0
+  while (start < shorter && characters[start] === newCharacters[start]) { start++ }
+  while (end < shorter - start && characters[characters.length - end - 1] === newCharacters[newCharacters.length - end - 1]) { end++ }
+
+  const inserted = newCharacters.slice(start, newCharacters.length - end).join('')
+  const operation = []
+  for (const component of [start, -(characters.length - end - start), inserted, end]) {
+    if (component) {
+      append(operation, component)
+    }
+  }
+  return operation
+}
+
+// Where position (in code points) ends up after operation, inserts right at the position go before it
+export function transformPosition(position, operation) {
+  let index = 0, result = position
+  for (const component of operation) {
+    if (index > position) {
+      break
+    }
+    if (typeof component === 'string') {
+      result += lengthOf(component)
+    } else if (component > 0) {
+      index += component
+    } else {
+      result -= Math.min(-component, position - index)
+      index -= component
+    }
+  }
+  return result
+}
+
+// Keeps a textarea in sync with the text of the board. One operation at a time is sent to the server,
+// what is typed meanwhile is sent once the server acknowledged it, as the difference to what it knows.
+export class TextEditor {
+  constructor(textarea, socket) {
+    this.textarea = textarea
+    this.socket = socket
+    this.revision = null
+    this.serverText = '' // the text at revision
+    this.outstanding = null // sent, but not acknowledged yet
+    this.early = [] // operations based on the outstanding one, e.g. corrections of it, that arrived before its acknowledgement
+
+    this.textarea.addEventListener('input', () => this.send())
+    this.socket.on('text_operation', message => this.receive(message))
+    this.socket.on('connect', () => this.load())
+    if (this.socket.connected) {
+      this.load()
+    }
+  }
+
+  load() {
+    this.socket.emit('get_text', state => {
+      this.revision = state.revision
+      this.serverText = state.text
+      this.outstanding = null
+      this.early = []
+      this.textarea.value = state.text
+    })
+  }
+
+  textWithOutstanding() {
+    return this.outstanding ? apply(this.serverText, this.outstanding) : this.serverText
+  }
+
+  send() {
+    if (this.outstanding || this.revision === null) {
+      return
+    }
+    const operation = operationBetween(this.serverText, this.textarea.value)
+    if ( ! operation.length) {
+      return
+    }
+    this.outstanding = operation
+    this.socket.emit('edit_text', { revision: this.revision, operation }, answer => {
+      if (answer.error) {
+        console.error('edit_text failed', answer.error)
+        return this.load()
+      }
+      this.serverText = apply(this.serverText, this.outstanding)
+      this.revision = answer.revision
+      this.outstanding = null
+      const early = this.early
+      this.early = []
+      early.forEach(message => this.receive(message))
+      this.send()
+    })
+  }
+
+  receive({ revision, operation }) {
+    if (this.outstanding && revision === this.revision + 2 + this.early.length) {
+      return this.early.push({ revision, operation })
+    }
+    if (this.revision === null || revision !== this.revision + 1) {
+      return this.load() // missed something
+    }
+    // what was typed since sending the outstanding operation, not sent yet
+    const typed = operationBetween(this.textWithOutstanding(), this.textarea.value)
+    let remote = operation
+    if (this.outstanding) {
+      [this.outstanding, remote] = transform(this.outstanding, remote)
+    }
+    if (typed.length) {
+      remote = transform(typed, remote)[1]
+    }
+    this.serverText = apply(this.serverText, operation)
+    this.revision = revision
+
+    // the selection counts UTF-16 code units, the operations code points
+    const { selectionStart, selectionEnd, value } = this.textarea
+    const newValue = apply(value, remote)
+    const transformed = offset => {
+      const position = transformPosition(lengthOf(value.slice(0, offset)), remote)
+      return Array.from(newValue).slice(0, position).join('').length
+    }
+    this.textarea.value = newValue
+    this.textarea.setSelectionRange(transformed(selectionStart), transformed(selectionEnd))
+  }
+}
@@ -66,7 +66,7 @@ export default {
 
                 <h2 class=metadata  v-if="columnName === 'done'">
                   <span class=flexspace></span>
-                  <span class="stats" v-text="childrenInStatus(child, 'done').length + '/' + child.children.length"></span>
+                  <span class="stats" v-text="childrenInStatus(child, 'done').length + '/' + child.children.length" v-bind:title="progressBelow(child)"></span>
                 </h2>
                 
                 <!-- REFACT try using the cuid as the item key -->
@@ -85,7 +85,7 @@ export default {
                       <h3>
                         <span class="metadata">
                             <a href="#" class="edit button" title="Edit this task">✎</a>
-                            <span class="child-indicator" title="Has child tasks" v-if="grandChild.children.length > 0"></span>
+                            <span class="child-indicator" v-bind:title="'Has child tasks, ' + progressBelow(grandChild)" v-if="grandChild.child_count > 0"></span>
                             <a href="#" class="id" v-if="grandChild.id" v-text="'#' + grandChild.id" title="External Link to task"></a>
                         </span>
                         <span class="title" v-text="grandChild.line"></span>
@@ -109,7 +109,12 @@ export default {
     socket: {
       type: Object,
       required: true,
-    }
+    },
+    // where the board is served, see the /api/v1/todos routes on the server
+    apiURL: {
+      type: String,
+      default: '/api/v1/todos',
+    },
   },
   data: function() {
     return {
@@ -118,10 +123,12 @@ export default {
     };
   },
   mounted: function() {
-    // this.socket.on
+    this.socket.on('delta', this.applyDelta)
+    this.socket.on('reload', this.reloadBoard)
   },
   beforeUnmount: function() {
-    
+    this.socket.off('delta', this.applyDelta)
+    this.socket.off('reload', this.reloadBoard)
   },
   // watch: {
   //   rootTask: {
@@ -174,6 +181,15 @@ export default {
       return task.children.filter(child => status === child.status)
     },
     
+    // Counted over the whole subtree on the server, see Todo.rollup
+    progressBelow: function(task) {
+      const rollup = task.rollup
+      if (undefined === rollup) {
+        return ''
+      }
+      return rollup.status.done + ' of ' + rollup.total + ' below done'
+    },
+    
     countOfGrandChildrenInStatus: function(task, status) {
       return (task.children || [])
         .map(child => this.childrenInStatus(child, status).length)
@@ -185,7 +201,7 @@ export default {
       // REFACT consider to require using the text interface to do this
       const todo = {
         uuid: this.uuidv4(),
-        line: "",
+        line: "new task", // a blank line would be read back as part of a body, not as a task
         id: "",
         status: 'new',
         is_done: false,
@@ -195,7 +211,7 @@ export default {
         children: [],
       }
       task.children.push(todo);
-      this.socket.emit('update_todo', { action: 'add_child', uuid: '' + task.uuid, child: todo });
+      this.updateTodo({ action: 'add_child', uuid: '' + task.uuid, child: todo });
     },
 
     toggleCollapsed: function($event) {
@@ -208,7 +224,70 @@ export default {
       const task = event.item.__draggable_context.element
       const newStatus = event.to.dataset.status
       task.status = newStatus
-      // this.socket.emit('update_todo', { action: 'change_tag', uuid: '' + task.uuid, tags: { status: newStatus } });
+      this.updateTodo({ action: 'set_status', uuid: '' + task.uuid, status: newStatus });
+    },
+    
+    // Sends one operation to the server, see Todo.on_operation() for the supported actions.
+    // The answer is the delta of what actually changed, which replaces the optimistic local change.
+    updateTodo: function(operation) {
+      this.socket.emit('update_todo', operation, answer => {
+        if (answer.error) {
+          // FIXME tell the user and reload the board
+          console.error('update_todo failed', operation, answer.error)
+          return
+        }
+        this.applyDelta(answer)
+      });
+    },
+    
+    // Applies the changes made by any client, see Todo.delta_json() on the server
+    applyDelta: function(delta) {
+      const tasksByUUID = new Map()
+      const collect = task => {
+        tasksByUUID.set(task.uuid, task)
+        ;(task.children || []).forEach(collect)
+      }
+      collect(this.rootTask)
+      
+      delta.changed.forEach(json => {
+        const { parent, child_uuids, ...properties } = json
+        const task = tasksByUUID.get(json.uuid)
+        if (undefined === task) {
+          tasksByUUID.set(json.uuid, { ...properties, children: [] })
+        } else {
+          Object.assign(task, properties)
+        }
+      })
+      // deleted tasks disappear from here too, as their former parent is part of the delta
+      delta.changed.forEach(json => {
+        tasksByUUID.get(json.uuid).children = json.child_uuids
+          .map(uuid => tasksByUUID.get(uuid))
+          .filter(child => undefined !== child)
+      })
+      Object.entries(delta.rollups || {}).forEach(([uuid, rollup]) => {
+        const task = tasksByUUID.get(uuid)
+        if (undefined !== task) {
+          task.rollup = rollup
+        }
+      })
+      
+      const isDeleted = task => delta.deleted.includes(task.uuid)
+      const firstDeletedCrumb = this.breadcrumbs.findIndex(isDeleted)
+      if (-1 !== firstDeletedCrumb) {
+        this.browse(this.breadcrumbs[firstDeletedCrumb - 1])
+      }
+    },
+    
+    // The todo file was replaced in a way that can not be sent as a delta, see Board.follow_file() on the server
+    reloadBoard: function() {
+      return fetch(this.apiURL + '?depth=2')
+        .then(response => response.json())
+        .then(answer => {
+          Object.assign(this.rootTask, answer.json)
+          this.task = this.rootTask
+          this.breadcrumbs = [this.rootTask]
+          return this.rootTask
+        })
     },
     
     browse: function(task) {
@@ -220,6 +299,26 @@ export default {
         this.breadcrumbs.splice(index + 1);
       }
       this.task = task;
+      this.loadChildren(task);
+    },
+    
+    // The server only sends a few levels of the tree, see Todo.to_json(), the rest is fetched when browsing into it
+    isMissingChildren: function(task) {
+      return (task.child_count || 0) > (task.children || []).length
+    },
+    
+    loadChildren: function(task) {
+      if ( ! this.isMissingChildren(task) && ! task.children.some(this.isMissingChildren)) {
+        return Promise.resolve(task)
+      }
+      return fetch(this.apiURL + '?depth=2&root=' + encodeURIComponent(task.uuid))
+        .then(response => response.json())
+        .then(answer => {
+          if (answer.json) {
+            task.children = answer.json.children
+          }
+          return task
+        })
     },
     
     // REFACT this should go away, each task already has / should have a uuid
@@ -0,0 +1,310 @@
+"""
+The text of a board as several clients type into it at the same time, kept consistent by operational transformation.
+
+An operation is a list of components that walk over the whole text from start to end:
+    
+    5           retain: keep the next five characters
+    -3          delete the next three characters
+    'abc'       insert abc here
+
+Clients send their operations together with the revision of the text they made them on. Operations of others
+that the server applied since then are transformed into them, see `transform()`, so every operation is applied
+to the text it was meant for, and everyone ends up with the same text. The server decides on the order,
+clients only ever have to transform against the operations the server sends them, like in ot.js or Google Wave.
+
+The tree of the board follows the text, see `TextDocument.tree_operations()`: as long as no lines are
+added or removed, only the edited task lines and bodies are parsed again, otherwise only the edited lines
+and the tasks around them, see reparse.py. The tree changing in other ways, e.g. from the board ui,
+becomes an operation on the text, see `TextDocument.replace()`.
+
+Not thread safe, all access has to happen while holding the lock of the board.
+"""
+
+from collections import deque
+
+from reparse import Lines, is_task_line
+from todotxt import InvalidOperation, Todo
+
+class TextDocument:
+    
+    def __init__(self, text, revision=0, keep=1000):
+        "keep is how many revisions back the operations of clients can be based on."
+        self.text = text
+        self.revision = revision
+        self._operations = deque(maxlen=keep) # the operations that led to the last revisions
+        self._lines = None # of the tree that follows the text
+    
+    def __repr__(self):
+        return f'<TextDocument(revision={self.revision}, length={len(self.text)})>'
+    
+    def transform(self, revision, operation):
+        "Transforms an operation made on revision of the text, so it applies to the current text."
+        if not (isinstance(revision, int) and 0 <= revision <= self.revision):
+            raise InvalidOperation(f'unknown revision {revision!r}')
+        if self.revision - revision > len(self._operations):
+            raise InvalidOperation(f'revision {revision} is too old, fetch the text again')
+        check(operation)
+        for index in range(len(self._operations) - (self.revision - revision), len(self._operations)):
+            operation, _ = transform(operation, self._operations[index])
+        if base_length(operation) != len(self.text):
+            raise InvalidOperation('operation does not fit the text')
+        return operation
+    
+    def apply(self, operation):
+        "Applies an operation on the current text, returns the new revision."
+        self.text = apply(self.text, operation)
+        self._operations.append(operation)
+        self.revision += 1
+        return self.revision
+    
+    def replace(self, text):
+        "Changes the text to text, returns the operation that did that, or None if it already was text."
+        if text == self.text:
+            return None
+        operation = operation_between(self.text, text)
+        self.apply(operation)
+        self.forget_lines()
+        return operation
+    
+    def forget_lines(self):
+        "The tree changed in a way the lines of the text did not, see tree_operations()."
+        self._lines = None
+    
+    def tree_operations(self, task, operation):
+        """The operations (see `Todo.on_operation()`) that make the tree of task follow operation on the current text.
+        
+        None if only parsing the whole text again will do, because what the root of the tree is changes,
+        see `reparse.Lines.replace()`, or the edited lines are not indented by whole levels, which
+        operations can not express. Then the text has to be parsed again, see treediff.
+        The tree of task has to have been parsed from the current text, or be kept in sync with it,
+        by applying the operations before the next call.
+        """
+        lines = self._lines_of(task)
+        if lines is None:
+            return None
+        edited = edited_lines(self.text, operation)
+        if edited is not None:
+            operations = edit_operations(lines, edited)
+            if operations is not None:
+                return operations
+        replaced = replaced_lines(self.text, operation)
+        if replaced is None:
+            return []
+        if not all(is_whitespace(line) or is_indented_by_levels(line) for line in replaced[2]):
+            return None # the operations would indent it by whole levels, see treediff.diff()
+        return lines.replace(*replaced)
+        
+    def _lines_of(self, task):
+        if self._lines is None or self._lines.task is not task:
+            self._lines = Lines(task)
+            if len(self._lines) != self.text.count('\n') + 1:
+                self._lines = None # the tree does not fit the text
+        return self._lines
+        
+def edit_operations(lines, edited):
+    """The edit_line operations for lines that were edited in place (see `edited_lines()`),
+    None if that changes whether a line is a task or part of a body."""
+    edits = dict() # id of todo -> (todo, line, body lines)
+    for number, old_line, new_line in edited:
+        todo, first, _ = lines.locate(number)[-1]
+        body_line = number - first - (0 if todo.line is None else 1)
+        level = Todo.Parser.indentation_level(todo.line)
+        if id(todo) not in edits:
+            edits[id(todo)] = (todo, None, None)
+        todo, line, body = edits[id(todo)]
+        if body_line < 0 or todo.body is None:
+            if todo.line is None or not is_task_line(new_line, level) or not is_task_line(old_line, level):
+                return None # an empty child, or the line would become part of a body
+            if not is_indented_by_levels(new_line):
+                return None # edit_line would indent it by whole levels
+            line = new_line
+        else:
+            if not is_whitespace(new_line) and Todo.Parser.indentation_level(new_line) < level + 2:
+                return None # would become a task of its own
+            body = body or todo.body.split('\n')
+            body[body_line] = new_line
+        edits[id(todo)] = (todo, line, body)
+    
+    operations = []
+    for todo, line, body in edits.values():
+        edit = dict(action='edit_line', uuid=todo.uuid)
+        if line is not None:
+            edit['line'] = line
+        if body is not None:
+            edit['body'] = '\n'.join(body)
+        operations.append(edit)
+    return operations
+
+def is_whitespace(line):
+    return '' == line.strip()
+
+def is_indented_by_levels(line):
+    prefix = Todo.Parser.prefix(line)
+    return prefix == ' ' * len(prefix) and 0 == len(prefix) % Todo.INDENT
+
+def check(operation):
+    if not isinstance(operation, list):
+        raise InvalidOperation('operation has to be a list')
+    for component in operation:
+        if not ((isinstance(component, str) and component) or (type(component) is int and 0 != component)):
+            raise InvalidOperation(f'invalid component {component!r}')
+
+def base_length(operation):
+    "The length of the text operation applies to."
+    return sum(abs(component) for component in operation if isinstance(component, int))
+
+def apply(text, operation):
+    if base_length(operation) != len(text):
+        raise InvalidOperation('operation does not fit the text')
+    parts, position = [], 0
+    for component in operation:
+        if isinstance(component, str):
+            parts.append(component)
+        elif component > 0:
+            parts.append(text[position:position + component])
+            position += component
+        else:
+            position -= component
+    return ''.join(parts)
+
+def transform(operation, other):
+    """Answers (operation', other') for two operations on the same text, so that
+    `apply(apply(text, operation), other') == apply(apply(text, other), operation')`.
+    
+    Inserts at the same position are ordered operation first.
+    """
+    operation_prime, other_prime = [], []
+    components, other_components = iter(operation), iter(other)
+    component, other_component = next(components, None), next(other_components, None)
+    while component is not None or other_component is not None:
+        if isinstance(component, str):
+            append(operation_prime, component)
+            append(other_prime, len(component))
+            component = next(components, None)
+            continue
+        if isinstance(other_component, str):
+            append(operation_prime, len(other_component))
+            append(other_prime, other_component)
+            other_component = next(other_components, None)
+            continue
+        if component is None or other_component is None:
+            raise InvalidOperation('operations of different lengths')
+        
+        length = min(abs(component), abs(other_component))
+        if component > 0 and other_component > 0:
+            append(operation_prime, length)
+            append(other_prime, length)
+        elif component < 0 and other_component > 0:
+            append(operation_prime, -length)
+        elif component > 0 and other_component < 0:
+            append(other_prime, -length)
+        # both deleted the same characters, which is nothing left to do for either
+        component = shorten(component, length)
+        other_component = shorten(other_component, length)
+        if 0 == component:
+            component = next(components, None)
+        if 0 == other_component:
+            other_component = next(other_components, None)
+    return operation_prime, other_prime
+
+def shorten(component, length):
+    return component - length if component > 0 else component + length
+
+def append(operation, component):
+    "Merges component into the last one if they are of the same kind."
+    if operation and isinstance(component, str) and isinstance(operation[-1], str):
+        operation[-1] += component
+    elif operation and isinstance(component, int) and isinstance(operation[-1], int) and (component > 0) == (operation[-1] > 0):
+        operation[-1] += component
+    else:
+        operation.append(component)
+
+def operation_between(text, new_text):
+    "An operation that turns text into new_text, replacing everything between the common start and end."
+    start = 0
+    shorter = min(len(text), len(new_text))
+    while start < shorter and text[start] == new_text[start]:
+        start += 1
+    end = 0
+    while end < shorter - start and text[-end - 1] == new_text[-end - 1]:
+        end += 1
+    
+    operation = []
+    for component in (start, -(len(text) - end - start), new_text[start:len(new_text) - end], end):
+        if component:
+            append(operation, component)
+    return operation
+
+def edited_lines(text, operation):
+    """(line number, old line, new line) for each line of text operation changes, if it does not add or remove lines.
+    
+    None if it does, or if operation does not fit text. Only looks at the lines that change.
+    """
+    if base_length(operation) != len(text):
+        return None
+    touched = [] # positions in the old and new text
+    position = new_position = 0
+    for component in operation:
+        if isinstance(component, str):
+            if '\n' in component:
+                return None
+            touched.append((position, new_position))
+            new_position += len(component)
+        elif component > 0:
+            position += component
+            new_position += component
+        else:
+            if '\n' in text[position:position - component]:
+                return None
+            touched.append((position, new_position))
+            position -= component
+    if not touched:
+        return []
+    
+    result, number, counted_up_to = [], 0, 0
+    for position, new_position in touched:
+        number += text.count('\n', counted_up_to, position)
+        counted_up_to = position
+        if result and result[-1][0] == number:
+            continue
+        result.append((number, line_at(text, position), new_position))
+    
+    new_text = apply(text, operation)
+    return [(number, old_line, line_at(new_text, new_position)) for number, old_line, new_position in result]
+
+def line_at(text, position):
+    start = text.rfind('\n', 0, position) + 1
+    end = text.find('\n', position)
+    return text[start:] if -1 == end else text[start:end]
+
+def replaced_lines(text, operation):
+    """(start, stop, new lines): the lines of text from start up to stop that operation replaces by new lines.
+    
+    None if operation changes nothing. Only the changed part of the text is copied.
+    """
+    changes, position, first, last = [], 0, None, None
+    for component in operation:
+        if isinstance(component, str):
+            changes.append(component)
+            first = position if first is None else first
+            last = position
+        elif component > 0:
+            if first is not None:
+                changes.append((position, position + component))
+            position += component
+        else:
+            first = position if first is None else first
+            position -= component
+            last = position
+    if first is None:
+        return None
+    while changes and not isinstance(changes[-1], str) and changes[-1][0] >= last:
+        changes.pop() # retained after the last change
+    
+    line_start = text.rfind('\n', 0, first) + 1
+    line_end = text.find('\n', last)
+    line_end = len(text) if -1 == line_end else line_end
+    start = text.count('\n', 0, first)
+    stop = start + text.count('\n', line_start, line_end) + 1
+    middle = ''.join(change if isinstance(change, str) else text[change[0]:change[1]] for change in changes)
+    return start, stop, (text[line_start:first] + middle + text[last:line_end]).split('\n')
@@ -0,0 +1,129 @@
+from unittest import TestCase
+import random
+
+from pyexpect import expect
+
+from textdocument import TextDocument, apply, operation_between, transform
+from todotxt import InvalidOperation, Todo
+
+def random_operation(generator, text):
+    "Retains, deletes and inserts at random, with inserts that sometimes contain a newline."
+    operation, position = [], 0
+    while position < len(text):
+        length = generator.randint(1, len(text) - position)
+        kind = generator.random()
+        if kind < 0.6:
+            operation.append(length)
+        elif kind < 0.8:
+            operation.append(-length)
+        else:
+            operation.extend([generator.choice(['x', 'new\n', ' @a', '    ']), length])
+        position += length
+    if generator.random() < 0.3:
+        operation.append('end')
+    return operation
+
+class TransformTest(TestCase):
+    
+    def test_applies_retains_deletes_and_inserts(self):
+        expect(apply('hello world', [6, -5, 'there'])) == 'hello there'
+        with self.assertRaises(InvalidOperation):
+            apply('hello', [3])
+    
+    def test_describes_the_difference_of_two_texts(self):
+        expect(operation_between('first\nsecond', 'first\nthe second')) == [6, 'the ', 6]
+        expect(operation_between('aaa', 'aa')) == [2, -1]
+    
+    def test_counts_emoji_as_one_character_like_the_client(self):
+        expect(operation_between('😀 first', '😀 the first')) == [2, 'the ', 5]
+        document = TextDocument('😀 first')
+        document.apply(document.transform(0, [2, 'the ', 5]))
+        expect(document.text) == '😀 the first'
+    
+    def test_concurrent_operations_converge(self):
+        generator = random.Random(23)
+        for _ in range(500):
+            text = ''.join(generator.choice('ab\n ') for _ in range(generator.randint(0, 20)))
+            operation, other = random_operation(generator, text), random_operation(generator, text)
+            operation_prime, other_prime = transform(operation, other)
+            expect(apply(apply(text, operation), other_prime)) == apply(apply(text, other), operation_prime)
+    
+    def test_orders_inserts_at_the_same_position_by_argument(self):
+        operation_prime, other_prime = transform(['a', 1], ['b', 1])
+        expect(apply(apply('x', ['a', 1]), other_prime)) == 'abx'
+
+class TextDocumentTest(TestCase):
+    
+    def test_transforms_operations_made_on_older_revisions(self):
+        document = TextDocument('first\nsecond')
+        revision = document.apply(document.transform(0, ['the ', 12]))
+        expect(revision) == 1
+        
+        # made on revision 0, without knowing about the first change
+        document.apply(document.transform(0, [6, -6, 'third']))
+        expect(document.text) == 'the first\nthird'
+    
+    def test_rejects_unknown_revisions_and_operations_that_do_not_fit(self):
+        document = TextDocument('first', revision=5, keep=1)
+        with self.assertRaises(InvalidOperation):
+            document.transform(6, [5])
+        with self.assertRaises(InvalidOperation):
+            document.transform(4, [5])
+        with self.assertRaises(InvalidOperation):
+            document.transform(5, [3])
+        with self.assertRaises(InvalidOperation):
+            document.transform(5, [5, 0])
+    
+    def tree_operations(self, text, operation):
+        task = Todo.from_lines(text)
+        document = TextDocument(text)
+        return task, document.tree_operations(task, operation)
+    
+    def test_follows_edits_within_lines_with_edit_line(self):
+        task, operations = self.tree_operations('first\n    child\n            body\nsecond', [10, -5, 'task', 13, -4, 'text', 7])
+        child = task.children[0].children[0]
+        expect(operations) == [dict(action='edit_line', uuid=child.uuid, line='    task', body='            text')]
+    
+    def test_reparses_only_the_tasks_around_lines_that_are_added_or_removed(self):
+        text = 'first\n    child\n            body\nsecond'
+        task, operations = self.tree_operations(text, [32, '\n    new child', 7])
+        first = task.children[0]
+        expect(operations) == [dict(action='add_child', uuid=first.uuid, index=1,
+            child=dict(uuid=operations[0]['child']['uuid'], line='    new child', body=None))]
+        # the child turns into a body line of first
+        task, operations = self.tree_operations(text, [6, '        ', len(text) - 6])
+        expect(operations) == [
+            dict(action='edit_line', uuid=task.children[0].uuid, body='            child\n            body'),
+            dict(action='delete', uuid=task.children[0].children[0].uuid),
+        ]
+    
+    def test_needs_a_reparse_if_the_root_changes(self):
+        text = 'first\n    child\n            body\nsecond'
+        # a single task becomes the root
+        expect(self.tree_operations(text, [32, -7])[1]).is_none()
+    
+    def test_edits_keep_the_tree_as_if_parsed_again(self):
+        generator = random.Random(7)
+        lines = ['first', '    child @a', '            body', '', '        grandchild', 'second', '            body of second']
+        
+        def shape(task):
+            return [(Todo.Parser.indentation_level(todo.line), (todo.line or '').strip(), todo.body) for todo in task.iter_tree()]
+        
+        for _ in range(300):
+            text = '\n'.join(generator.sample(lines, generator.randint(2, len(lines))))
+            task = Todo.from_lines(text)
+            document = TextDocument(text)
+            position = generator.randint(0, len(text) - 1)
+            if generator.random() < 0.5:
+                operation = [position, generator.choice(['x', ' ', '    ', '+project']), len(text) - position]
+            else:
+                operation = [position, -1, len(text) - position - 1]
+            operation = [component for component in operation if component]
+            
+            operations = document.tree_operations(task, operation)
+            document.apply(operation)
+            if operations is None:
+                continue
+            for each in operations:
+                task.apply_operation(each)
+            expect(shape(task)) == shape(Todo.from_lines(document.text))
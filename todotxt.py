@@ -33,18 +33,45 @@ Some syntax ideas that are not yet very very final
 """
 
 import re
+from collections import namedtuple
 from functools import wraps
+from itertools import islice, repeat
 import uuid
 
-import fluentpy as _
-import json
-
 def tupelize(method):
     @wraps(method)
     def wrapper(*args, **kwargs):
         return tuple(method(*args, **kwargs))
     return wrapper
 
+class InvalidOperation(ValueError):
+    "An operation or todo from a client that does not fit the tree. Raised before anything is changed."
+
+def uuid_to_int(value):
+    "Accepts uuids as strings, UUID instances or ints, raises ValueError for anything else."
+    if isinstance(value, int):
+        return value
+    if isinstance(value, uuid.UUID):
+        return value.int
+    return uuid.UUID(str(value)).int
+
+def indent(line, level):
+    "Replaces the indentation of line with `level` levels of indentation."
+    return ' ' * (Todo.INDENT * max(level, 0)) + line.lstrip()
+
+def shift_indentation(text, levels):
+    "Indents (or dedents for negative levels) every line of text that is not just whitespace."
+    lines = text.split('\n')
+    for index, line in enumerate(lines):
+        if line.strip() == '':
+            continue
+        if levels > 0:
+            lines[index] = ' ' * (Todo.INDENT * levels) + line
+        else:
+            prefix = Todo.Parser.prefix(line)
+            lines[index] = prefix[:max(len(prefix) + Todo.INDENT * levels, 0)] + line[len(prefix):]
+    return '\n'.join(lines)
+
 def id_generator():
     if not hasattr(id_generator, 'counter'):
         id_generator.counter = 0
@@ -53,52 +80,345 @@ def id_generator():
     return id_generator.counter
 
 class FilterableList(list):
-    def __init__(self, parent):
-        super()
+    """The children of a Todo.
+    
+    All mutations go through the owning Todo, so parent pointers, the tree index and the rollups stay correct.
+    """
+    
+    __slots__ = ('_parent', '_buckets')
+    
+    def __init__(self, parent, children=()):
+        super().__init__()
         self._parent = parent
+        self._buckets = None
+        self.extend(children)
+    
+    def append(self, child):
+        self._parent._adopt(child)
+        super().append(child)
+    
+    def insert(self, index, child):
+        self._parent._adopt(child)
+        super().insert(index, child)
+    
+    def extend(self, children):
+        children = list(children)
+        for child in children:
+            self._parent._adopt(child)
+        super().extend(children)
+    
+    def __iadd__(self, children):
+        self.extend(children)
+        return self
+    
+    def __setitem__(self, index, children):
+        if isinstance(index, slice):
+            children = list(children)
+            removed = self[index]
+        else:
+            removed = [self[index]]
+        
+        for child in removed:
+            self._parent._orphan(child)
+        for child in children if isinstance(index, slice) else [children]:
+            self._parent._adopt(child)
+        super().__setitem__(index, children)
+    
+    def __delitem__(self, index):
+        removed = self[index] if isinstance(index, slice) else [self[index]]
+        for child in removed:
+            self._parent._orphan(child)
+        super().__delitem__(index)
+    
+    def pop(self, index=-1):
+        self._parent._orphan(self[index])
+        return super().pop(index)
+    
+    def remove(self, child):
+        index = self.index(child)
+        self._parent._orphan(child)
+        super().__delitem__(index)
+    
+    def clear(self):
+        for child in self:
+            self._parent._orphan(child)
+        super().clear()
+    
+    def sort(self, *args, **kwargs):
+        self._invalidate()
+        super().sort(*args, **kwargs)
+    
+    def reverse(self):
+        self._invalidate()
+        super().reverse()
     
     @property
     def tagged(self):
         return self
     
     # REFACT consider putting them on their own class, to have a smaller interface
-
+    
     @property
-    @tupelize
     def new(self):
-        candidates = self._parent.children_tagged('status:new') \
-            + self._parent.children_not_tagged('status:')
-        done = self._parent.children.tagged.done
-        for child in self:
-            if child in candidates and child not in done:
-                yield child
+        return self._status_buckets()['new']
     
     @property
     def doing(self):
-        return self._parent.children_tagged('status:doing')
+        return self._status_buckets()['doing']
     
     @property
-    @tupelize
     def done(self):
-        done_tasks = _(self._parent.children).filter(_.each.is_done._)._ + self._parent.children_tagged('status:done')
-        for child in self._parent.children:
-            if child in done_tasks:
-                yield child
+        return self._status_buckets()['done']
     
     @property
-    @tupelize
     def unknown(self):
-        known_tagged = self.new + self.doing + self.done
+        return self._status_buckets()['unknown']
+    
+    def _status_buckets(self):
+        """Sorts all children into their status in one pass.
+        
+        Cached until the list changes or one of the children gets a new line.
+        A child can be in more than one bucket, e.g. 'x foo status:doing' is done and doing.
+        """
+        if self._buckets is not None:
+            return self._buckets
+        
+        new, doing, done, unknown = [], [], [], []
         for child in self:
-            if child not in known_tagged:
-                yield child
+            metadata = child.metadata
+            status = metadata.tags.get('status')
+            is_done = metadata.is_marked_done or 'done' == status
+            
+            if is_done:
+                done.append(child)
+            if 'doing' == status:
+                doing.append(child)
+            if not is_done and status in (None, 'new'):
+                new.append(child)
+            if not is_done and status not in (None, 'new', 'doing'):
+                unknown.append(child)
+        
+        self._buckets = dict(new=tuple(new), doing=tuple(doing), done=tuple(done), unknown=tuple(unknown))
+        return self._buckets
+    
+    def _invalidate(self):
+        self._buckets = None
+
+class TodoIndex:
+    """Lookup tables for a whole tree of Todos, owned by its root.
+    
+    Built on first use and afterwards maintained by the tree itself whenever children
+    are added or removed or a line changes.
+    
+    Besides uuids and ids, todos are indexed by the terms of their line, see terms(), which is what Todo.query() uses.
+    """
+    
+    def __init__(self, root):
+        self.by_uuid = dict()
+        self.by_id = dict()
+        self.by_term = dict()
+        self.add_subtree(root)
+    
+    @staticmethod
+    def terms(metadata):
+        """What a line can be searched by: ('status', status), ('context', name), ('project', name),
+        ('tag', key) and ('tag', key, value).
+        """
+        if metadata is None:
+            return set()
+        
+        terms = {('status', status_of(metadata))}
+        terms.update(('context', context) for context in metadata.contexts)
+        terms.update(('project', project) for project in metadata.projects)
+        for key, value in metadata.tags.items():
+            terms.add(('tag', key))
+            terms.add(('tag', key, value))
+        return terms
+    
+    def add_subtree(self, todo):
+        for each in todo.iter_tree():
+            self.by_uuid[each.uuid_int] = each
+            for id in each.metadata.ids:
+                self.by_id.setdefault(id, []).append(each)
+            self._add_terms(each, self._terms_of(each))
+    
+    def remove_subtree(self, todo):
+        for each in todo.iter_tree():
+            self.by_uuid.pop(each.uuid_int, None)
+            self._remove_ids(each, each.metadata.ids)
+            self._remove_terms(each, self._terms_of(each))
+    
+    def update_line(self, todo, old_metadata):
+        "Indexed todos always have parsed metadata, so the old ids and terms are known. None if the todo was virtual."
+        new_ids = todo.metadata.ids
+        old_ids = old_metadata.ids if old_metadata is not None else ()
+        if old_ids != new_ids:
+            self._remove_ids(todo, old_ids)
+            for id in new_ids:
+                self.by_id.setdefault(id, []).append(todo)
+        
+        old_terms = self.terms(old_metadata)
+        new_terms = self._terms_of(todo)
+        self._remove_terms(todo, old_terms - new_terms)
+        self._add_terms(todo, new_terms - old_terms)
+    
+    def _terms_of(self, todo):
+        return self.terms(None if todo.is_virtual else todo.metadata)
+    
+    def _remove_ids(self, todo, ids):
+        for id in ids:
+            todos = self.by_id.get(id, [])
+            if todo in todos:
+                todos.remove(todo)
+            if not todos:
+                self.by_id.pop(id, None)
+    
+    def _add_terms(self, todo, terms):
+        for term in terms:
+            self.by_term.setdefault(term, set()).add(todo)
+    
+    def _remove_terms(self, todo, terms):
+        for term in terms:
+            todos = self.by_term.get(term)
+            if todos is None:
+                continue
+            todos.discard(todo)
+            if not todos:
+                del self.by_term[term]
+
+class Rollup:
+    """How many todos below one todo are in each status, context and project, see Todo.rollup.
+    
+    Every todo with a line counts once, however deep below it is. Virtual todos do not count.
+    Counts are added and subtracted as the tree changes, so they are never recounted.
+    """
+    
+    __slots__ = ('statuses', 'contexts', 'projects')
+    
+    STATUSES = ('new', 'doing', 'done', 'unknown')
+    
+    def __init__(self):
+        self.statuses = dict.fromkeys(self.STATUSES, 0)
+        self.contexts = dict()
+        self.projects = dict()
+    
+    def __repr__(self):
+        return f'<Rollup(statuses={self.statuses!r}, contexts={self.contexts!r}, projects={self.projects!r})>'
+    
+    def __bool__(self):
+        "False if nothing would change by adding this."
+        return any(self.statuses.values()) or bool(self.contexts) or bool(self.projects)
+    
+    @property
+    def total(self):
+        return sum(self.statuses.values())
+    
+    @property
+    def json(self):
+        return dict(total=self.total, status=dict(self.statuses), contexts=dict(self.contexts), projects=dict(self.projects))
+    
+    def add_line(self, metadata, sign=1):
+        "Counts (or with sign=-1 uncounts) one line, nothing if metadata is None."
+        if metadata is None:
+            return
+        
+        self.statuses[status_of(metadata)] += sign
+        for context in set(metadata.contexts):
+            self._count(self.contexts, context, sign)
+        for project in set(metadata.projects):
+            self._count(self.projects, project, sign)
+    
+    def add_todo(self, todo, sign=1):
+        "Counts todo and everything below it."
+        self.add_line(None if todo.is_virtual else todo.metadata, sign)
+        self.add(todo.rollup, sign)
+    
+    def add(self, other, sign=1):
+        for status, count in other.statuses.items():
+            self.statuses[status] += sign * count
+        for context, count in other.contexts.items():
+            self._count(self.contexts, context, sign * count)
+        for project, count in other.projects.items():
+            self._count(self.projects, project, sign * count)
+    
+    def _count(self, counts, key, difference):
+        count = counts.get(key, 0) + difference
+        if count:
+            counts[key] = count
+        else:
+            del counts[key]
+
+# shared by all todos without children, replaced before anything is counted in it, see Todo._roll_up()
+Rollup.EMPTY = Rollup()
+
+def status_of(metadata):
+    "The status of a line, see Todo.status"
+    # FIXME find a way to make these status configurable
+    # REFACT consider using is: tag for status because of shortness
+    if 'status' in metadata.tags:
+        status = metadata.tags['status']
+        if status in ('new', 'doing', 'done'):
+            return status
+        else:
+            return 'unknown'
+    
+    if metadata.is_marked_done:
+        return 'done'
+    
+    return 'new'
+
+def inherit(metadata, inherited):
+    """The effective metadata of a line below a todo whose effective metadata is `inherited`, see Todo.effective_metadata.
+    
+    metadata is None for virtual todos, they pass on what they inherited. Parts that do not change
+    are shared with `inherited`, treat them as read only.
+    """
+    if metadata is None:
+        metadata = Todo.Parser.EMPTY
+    
+    contexts, projects, tags = inherited
+    added = tuple(context for context in dict.fromkeys(metadata.contexts) if context not in contexts)
+    if added:
+        contexts += added
+    added = tuple(project for project in dict.fromkeys(metadata.projects) if project not in projects)
+    if added:
+        projects += added
+    
+    if not Todo.UNINHERITED_TAGS.isdisjoint(tags):
+        tags = {key: value for key, value in tags.items() if key not in Todo.UNINHERITED_TAGS}
+    if metadata.tags:
+        tags = {**tags, **metadata.tags}
+    
+    if contexts is inherited.contexts and projects is inherited.projects and tags is inherited.tags:
+        return inherited
+    return EffectiveMetadata(contexts, projects, tags)
+
+LineMetadata = namedtuple('LineMetadata', 'ids is_marked_done contexts projects tags spans')
+LineMetadata.__doc__ = "Everything the parser extracts from one line, see Todo.Parser.parse(). spans stays None until needed, see Todo.spans"
+
+EffectiveMetadata = namedtuple('EffectiveMetadata', 'contexts projects tags')
+EffectiveMetadata.__doc__ = """The contexts, projects and tags that apply to a todo, its own and those of its ancestors.
+
+Contexts and projects are ordered outermost first. Tags apply too, except for Todo.UNINHERITED_TAGS,
+and the innermost value of each wins. See Todo.effective_metadata.
+"""
+EffectiveMetadata.EMPTY = EffectiveMetadata(contexts=(), projects=(), tags={})
+
+Span = namedtuple('Span', 'kind start end key value quote')
+Span.__doc__ = """Where a token was found in a line, line[start:end] is its complete text.
+
+kind is one of 'done' (the leading x), 'id', 'context', 'project' or 'tag'. Only tags have a key
+and a quote, which is '', "'" or '"' depending on how the value was written.
+"""
 
-# TODO consider to retain offsets of all matches, so they can easily be used for a highlighter
 class Todo:
     
     "int: how many spaces is one level of indentation."
     INDENT = 4
     
+    "Tags that only apply to the todo they are written on, all others apply to the todos below it too."
+    UNINHERITED_TAGS = frozenset(('id', 'status'))
+    
     class Parser:
         IS_DONE = re.compile(r'^\s*(x)\s')
         ID = re.compile(r'#(\d+)')
@@ -112,6 +432,94 @@ class Todo:
             |\"(?P<double>[\-\w\s]+)\")
         ''', flags=re.X
         )
+        SIMPLE_TAG_VALUE = re.compile(r'[\-\w]+')
+        
+        EMPTY = LineMetadata(ids=(), is_marked_done=False, contexts=(), projects=(), tags={}, spans=())
+        
+        @classmethod
+        def parse(cls, line):
+            "The tokens are not located here, that's slower and only needed for editing, see spans()."
+            if not line:
+                return cls.EMPTY
+            
+            return LineMetadata(
+                ids=tuple(cls.ID.findall(line)),
+                is_marked_done=bool(cls.IS_DONE.match(line)),
+                contexts=tuple(cls.CONTEXTS.findall(line)),
+                projects=tuple(cls.PROJECTS.findall(line)),
+                tags=dict((
+                    match[0],
+                    match[1] or match[2] or match[3]
+                ) for match in cls.TAGS.findall(line)),
+                spans=None,
+            )
+        
+        @classmethod
+        def spans(cls, line):
+            "All tokens of line, in the order they appear in it."
+            if not line:
+                return ()
+            
+            spans = []
+            is_done = cls.IS_DONE.match(line)
+            if is_done:
+                spans.append(Span('done', *is_done.span(1), None, 'x', None))
+            for kind, pattern in (('id', cls.ID), ('context', cls.CONTEXTS), ('project', cls.PROJECTS)):
+                for match in pattern.finditer(line):
+                    spans.append(Span(kind, *match.span(), None, match[1], None))
+            for match in cls.TAGS.finditer(line):
+                key, simple, single, double = match.groups()
+                quote, value = ('', simple) if simple else ("'", single) if single else ('"', double)
+                spans.append(Span('tag', *match.span(), key, value, quote))
+            
+            spans.sort(key=lambda span: span.start)
+            return tuple(spans)
+        
+        @classmethod
+        def parse_with_spans(cls, line):
+            "Same as parse(), but with spans, which are only located once this way."
+            if not line:
+                return cls.EMPTY
+            
+            spans = cls.spans(line)
+            return LineMetadata(
+                ids=tuple(span.value for span in spans if 'id' == span.kind),
+                is_marked_done=any('done' == span.kind for span in spans),
+                contexts=tuple(span.value for span in spans if 'context' == span.kind),
+                projects=tuple(span.value for span in spans if 'project' == span.kind),
+                tags=dict((span.key, span.value) for span in spans if 'tag' == span.kind),
+                spans=spans,
+            )
+        
+        @classmethod
+        def format_tag(cls, key, value):
+            "Quotes values that can't be written plainly, the inverse of what TAGS matches."
+            value = str(value)
+            if cls.SIMPLE_TAG_VALUE.fullmatch(value):
+                return f'{key}:{value}'
+            quote = '"' if "'" in value else "'"
+            return f'{key}:{quote}{value}{quote}'
+        
+        @classmethod
+        def splice(cls, line, edits):
+            """Applies all (start, end, replacement) edits to line in one pass.
+            
+            Removing (replacing with '') also removes the whitespace that separated the token from the rest
+            of the line, so no double spaces are left behind. Edits overlapping an earlier one are skipped.
+            """
+            parts, position = [], 0
+            for start, end, replacement in sorted(edits, key=lambda edit: edit[:2]):
+                if start < position:
+                    continue
+                parts.append(line[position:start])
+                parts.append(replacement)
+                position = end
+                if '' == replacement:
+                    position = len(line) - len(line[end:].lstrip())
+                    if position == len(line):
+                        parts = [''.join(parts).rstrip()]
+            parts.append(line[position:])
+            return ''.join(parts)
         
         @classmethod
         def is_whitespace(cls, line):
@@ -128,24 +536,89 @@ class Todo:
         def prefix(cls, line):
             return re.match(r'^(\s*)', line).groups()[0] or ''
     
+    # Boards can have a lot of tasks, so keep them small. Most of them are leafs without children.
+    __slots__ = ('_line', 'body', '_children', '_parent', '_index', '_metadata', '_uuid', '_rollup', '_effective')
+    
     def __init__(self, line=None, body=None):
+        self._parent = None
+        self._index = None
+        self._rollup = None # counted on first use, see rollup
+        self._effective = None # see effective_metadata
+        self._metadata = None
+        self._uuid = None
+        self._children = None # created on first access, see children
         self.line = line
         self.body = body
-        # REFACT lazy create
-        self.children = FilterableList(self)
     
     @classmethod
     def from_lines(cls, lines):
         """Tasks become children of Tasks when they are indented by two spaces after another task.
         """
-        root = Todo(line=None, body=None)
-        for line in lines.split('\n'):
-            root.append_body_or_child(line)
+        return cls.from_iterable(lines.split('\n'))
+    
+    @classmethod
+    def from_stream(cls, stream):
+        """Like from_lines, but consumes a file object lazily, line by line."""
+        return cls.from_iterable(cls._split_lines(stream))
+    
+    @classmethod
+    def from_iterable(cls, lines):
+        """Builds the tree in one pass over lines (without line endings).
+        
+        Produces the same tree as calling append_body_or_child() for each line on a virtual root,
+        but keeps the chain of last children as an explicit stack instead of walking down it for every line.
+        Only the stack and the body lines of the task that was started last are held in extra memory.
+        """
+        root = cls(line=None, body=None)
+        cls._parse_into([root], lines)
         
         if root.body or 1 != len(root.children):
             return root
         
-        return root.children[0]
+        return root.children.pop()
+    
+    @classmethod
+    def children_from_lines(cls, lines, level):
+        """Parses lines as they would be parsed below a task on indentation level `level - 1`.
+        
+        Answers a virtual todo with the resulting tasks as its children. The first line has to be a task
+        on `level`, and no line may be indented less, as those would belong to tasks further up.
+        """
+        container = cls(line=None, body=None)
+        cls._parse_into([None] * level + [container], lines)
+        return container
+    
+    @classmethod
+    def _parse_into(cls, stack, lines):
+        "stack[level + 1] is the task that was started last on that indentation level, the lines continue after it."
+        body_lines = []
+        for line in lines:
+            level = cls.Parser.indentation_level(line)
+            if cls.Parser.is_whitespace(line) or level >= len(stack):
+                body_lines.append(line)
+                continue
+            
+            if body_lines:
+                stack[-1].body = '\n'.join(body_lines)
+                body_lines = []
+            
+            child = cls(line)
+            stack[level].children.append(child)
+            del stack[level + 1:]
+            stack.append(child)
+        
+        if body_lines:
+            stack[-1].body = '\n'.join(body_lines)
+    
+    @classmethod
+    def _split_lines(cls, stream):
+        "Same lines as stream.read().split('\\n') without reading everything into memory."
+        line = ''
+        for line in stream:
+            yield line[:-1] if line.endswith('\n') else line
+        
+        if line == '' or line.endswith('\n'):
+            yield ''
     
     def append_body_or_child(self, line):
         current_indentation_level = self.Parser.indentation_level(self.line)
@@ -160,6 +633,56 @@ class Todo:
         else:
             return self.children.append(Todo(line))
     
+    @property
+    def line(self):
+        return self._line
+    
+    @line.setter
+    def line(self, line):
+        index = self._tree_index()
+        old_metadata = self._metadata if index is not None and self._line is not None else None
+        is_rolled_up = self._parent is not None and self._parent._rollup is not None
+        if is_rolled_up:
+            delta = Rollup()
+            delta.add_line(None if self._line is None else self.metadata, -1)
+        old_effective = self._effective
+        self._line = line
+        self._metadata = None
+        
+        if self._parent is not None:
+            self._parent._children._invalidate()
+        
+        if index is not None:
+            index.update_line(self, old_metadata)
+        
+        if is_rolled_up:
+            delta.add_line(None if line is None else self.metadata)
+            if delta:
+                self._parent._roll_up(delta)
+        
+        if old_effective is not None:
+            self._effective = None
+            if inherit(None, self.effective_metadata) != inherit(None, old_effective):
+                # what the todos below inherit changed
+                for child in self._children or ():
+                    child._forget_effective_metadata()
+    
+    @property
+    def metadata(self):
+        "Parsed once per line and cached until the line changes. Treat as read only."
+        if self._metadata is None:
+            self._metadata = self.Parser.parse(self._line)
+        return self._metadata
+    
+    @property
+    def spans(self):
+        "Where the tokens of metadata are in the line, located on first use and cached along with it."
+        if self._metadata is None:
+            self._metadata = self.Parser.parse_with_spans(self._line)
+        elif self._metadata.spans is None:
+            self._metadata = self._metadata._replace(spans=self.Parser.spans(self._line))
+        return self._metadata.spans
+    
     # REFACT consider inlining
     @property
     def is_virtual(self):
@@ -173,43 +696,327 @@ class Todo:
         self.body += '\n' + line
     
     def __str__(self):
-        lines = []
+        return '\n'.join(self.iter_lines())
         
-        if self.line is not None:
-            lines.append(self.line)
+    def iter_lines(self):
+        """The lines of str(self) in order, a body is one item even if it spans several lines.
         
-        if self.body is not None:
-            lines.append(self.body)
+        Walks the tree once, without building the text of any subtree.
+        """
+        for todo in self.iter_tree():
+            if todo._line is not None:
+                yield todo._line
+            if todo.body is not None:
+                yield todo.body
+            if todo._line is None and todo.body is None and not todo._children and todo is not self:
+                yield '' # an empty child still gets its own line
         
-        lines.extend(map(str, self.children))
+    def write_to(self, fileobj):
+        "Writes str(self) to fileobj in one pass, without building it in memory first."
+        lines = self.iter_lines()
+        first_line = next(lines, None)
+        if first_line is None:
+            return
         
-        return '\n'.join(lines)
+        fileobj.write(first_line)
+        fileobj.writelines('\n' + line for line in lines)
     
     def __repr__(self):
-        return f'<Todo(line={self.line!r}, body={self.body!r} children={self.children!r})>'
+        return f'<Todo(line={self.line!r}, body={self.body!r} children={self._children or []!r})>'
     
     @property
     def uuid(self):
-        if not hasattr(self, '_uuid'):
-            self._uuid = str(uuid.uuid4())
-            
+        return str(uuid.UUID(int=self.uuid_int))
+    
+    @property
+    def uuid_int(self):
+        "The uuid is kept as a plain int and only turned into a string for serialization."
+        if self._uuid is None:
+            self._uuid = uuid.uuid4().int
+        
         return self._uuid
     
-    # REFACT this should really use a dict as cache or as primary lookup structure
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = FilterableList(self)
+        return self._children
+    
+    @children.setter
+    def children(self, children):
+        children = list(children)
+        self.children.clear()
+        self.children.extend(children)
+    
+    @property
+    def parent(self):
+        return self._parent
+    
+    @property
+    def root(self):
+        todo = self
+        while todo._parent is not None:
+            todo = todo._parent
+        return todo
+    
+    def is_in_subtree_of(self, ancestor):
+        todo = self
+        while todo is not None:
+            if todo is ancestor:
+                return True
+            todo = todo._parent
+        return False
+    
+    def iter_tree(self):
+        "All todos of this subtree in file order, starting with self."
+        stack = [self]
+        while stack:
+            todo = stack.pop()
+            yield todo
+            if todo._children:
+                stack.extend(reversed(todo._children))
+    
+    @property
+    def index(self):
+        root = self.root
+        if root._index is None:
+            root._index = TodoIndex(root)
+        return root._index
+    
+    def _tree_index(self):
+        "The index of the tree this todo is part of, None if it was never needed."
+        if self._parent is None:
+            return self._index
+        return self.root._index
+    
+    def _adopt(self, child):
+        if child._parent is not None and child._parent is not self:
+            child._parent.children.remove(child)
+        
+        self._children._invalidate()
+        child._parent = self
+        child._index = None
+        index = self._tree_index()
+        if index is not None:
+            index.add_subtree(child)
+        child._forget_effective_metadata()
+        if self._rollup is not None:
+            delta = Rollup()
+            delta.add_todo(child)
+            self._roll_up(delta)
+    
+    def _orphan(self, child):
+        self._children._invalidate()
+        index = self._tree_index()
+        if index is not None:
+            index.remove_subtree(child)
+        if self._rollup is not None:
+            delta = Rollup()
+            delta.add_todo(child, -1)
+            self._roll_up(delta)
+        child._forget_effective_metadata()
+        child._parent = None
+    
+    @property
+    def effective_metadata(self):
+        """The contexts, projects and tags of this line together with those it inherits from the lines above, see EffectiveMetadata.
+        
+        Resolved top down, from the closest ancestor that has it already, and cached. Changes to a line forget
+        the cached effective metadata below it, but only if what it passes on changed. Treat as read only.
+        """
+        if self._effective is not None:
+            return self._effective
+        
+        # if a todo has its effective metadata, all its ancestors have theirs too
+        path = []
+        todo = self
+        while todo is not None and todo._effective is None:
+            path.append(todo)
+            todo = todo._parent
+        inherited = EffectiveMetadata.EMPTY if todo is None else todo._effective
+        for todo in reversed(path):
+            inherited = todo._effective = inherit(None if todo.is_virtual else todo.metadata, inherited)
+        return self._effective
+    
+    def _forget_effective_metadata(self):
+        "Of this todo and all below it, e.g. because it has new ancestors."
+        stack = [self]
+        while stack:
+            todo = stack.pop()
+            if todo._effective is None:
+                continue # neither have the todos below it
+            todo._effective = None
+            stack.extend(todo._children or ())
+    
+    @property
+    def rollup(self):
+        """How many todos below this one are in each status, context and project, see Rollup.
+        
+        Counted in one pass over the subtree on first use, which also gives every todo below its rollup.
+        Afterwards kept up to date whenever todos are added or removed below or get a new line.
+        """
+        if self._rollup is not None:
+            return self._rollup
+        
+        # children first, without recursion as trees can be deep
+        stack = [(self, False)]
+        while stack:
+            todo, are_children_counted = stack.pop()
+            if not are_children_counted:
+                stack.append((todo, True))
+                stack.extend((child, False) for child in todo._children or () if child._rollup is None)
+                continue
+            
+            if not todo._children:
+                todo._rollup = Rollup.EMPTY
+                continue
+            rollup = Rollup()
+            for child in todo._children:
+                rollup.add_todo(child)
+            todo._rollup = rollup
+        return self._rollup
+    
+    def _roll_up(self, delta):
+        "Adds delta to the rollups of this todo and its ancestors, as far up as they were counted."
+        todo = self
+        # if a todo has a rollup, all todos below it have one too
+        while todo is not None and todo._rollup is not None:
+            if todo._rollup is Rollup.EMPTY:
+                todo._rollup = Rollup()
+            todo._rollup.add(delta)
+            todo = todo._parent
+    
     def task_by_uuid(self, uuid):
-        if self.uuid == uuid:
-            return self
+        try:
+            task = self.index.by_uuid.get(uuid_to_int(uuid))
+        except ValueError:
+            return None
+        if task is not None and task.is_in_subtree_of(self):
+            return task
+    
+    def task_by_id(self, id):
+        for task in self.index.by_id.get(str(id), []):
+            if task.is_in_subtree_of(self):
+                return task
+    
+    def query(self, status=None, contexts=(), projects=(), tags=None, id=None, inherited=False):
+        """All todos below this one that match every given criterion, in file order.
         
-        for child in self.children:
-            child_or_none = child.task_by_uuid(uuid)
-            if child_or_none is not None:
-                return child_or_none
+        tags maps keys to the value they need to have, or to None if any value will do.
+        E.g. story.query(status='doing', contexts=['martin']) are the tasks martin is working on in story.
+        With inherited, contexts, projects and tags are matched against the effective metadata,
+        e.g. board.query(projects=['release'], inherited=True) includes everything below a +release story.
         
+        Answered from the index, only the todos matching the rarest criterion are looked at.
+        """
+        if inherited:
+            return self._query_inherited(status, contexts, projects, tags, id)
+        
+        index = self.index
+        candidates = []
+        if status is not None:
+            candidates.append(index.by_term.get(('status', status), ()))
+        candidates.extend(index.by_term.get(('context', context), ()) for context in contexts)
+        candidates.extend(index.by_term.get(('project', project), ()) for project in projects)
+        for key, value in (tags or {}).items():
+            term = ('tag', key) if value is None else ('tag', key, str(value))
+            candidates.append(index.by_term.get(term, ()))
+        if id is not None:
+            candidates.append(set(index.by_id.get(str(id), ())))
+        
+        if not candidates:
+            return [todo for todo in self.iter_tree() if todo is not self]
+        
+        candidates.sort(key=len)
+        rarest, others = candidates[0], candidates[1:]
+        
+        # small subtrees are quicker to walk than the todos of the whole tree matching the rarest criterion
+        subtree = list(islice(self.iter_tree(), len(rarest) + 2))
+        if len(subtree) <= len(rarest) + 1:
+            return [todo for todo in subtree[1:] if all(todo in each for each in candidates)]
+        
+        matches = [
+            todo for todo in rarest
+            if todo is not self and todo.is_in_subtree_of(self) and all(todo in other for other in others)
+        ]
+        return self._in_file_order(matches)
+    
+    def _query_inherited(self, status, contexts, projects, tags, id):
+        "See query(). Only the subtrees of the todos that have the rarest criterion in their own line are looked at."
+        tags = {key: None if value is None else str(value) for key, value in (tags or {}).items()}
+        
+        def matches(todo):
+            if status is not None and (todo.is_virtual or status != todo.status):
+                return False
+            if id is not None and (todo.is_virtual or str(id) not in todo.metadata.ids):
+                return False
+            effective = todo.effective_metadata
+            return all(context in effective.contexts for context in contexts) \
+                and all(project in effective.projects for project in projects) \
+                and all(key in effective.tags and value in (None, effective.tags[key]) for key, value in tags.items())
+        
+        # a tag can be overridden below, so all lines with the key have to be looked at, matches() checks the value
+        terms = [('context', context) for context in contexts] + [('project', project) for project in projects] \
+            + [('tag', key) for key in tags]
+        if not terms or all(self._inherits_term(term) for term in terms):
+            candidates = islice(self.iter_tree(), 1, None)
+        else:
+            index = self.index
+            rarest = min((term for term in terms if not self._inherits_term(term)), key=lambda term: len(index.by_term.get(term, ())))
+            seeds = self._in_file_order([
+                todo for todo in index.by_term.get(rarest, ()) if todo is not self and todo.is_in_subtree_of(self)])
+            candidates = self._iter_subtrees(seeds)
+        
+        return [todo for todo in candidates if matches(todo)]
+    
+    def _inherits_term(self, term):
+        "If every todo below this one has term, see TodoIndex.terms()."
+        kind, name = term
+        effective = inherit(None, self.effective_metadata)
+        return name in dict(context=effective.contexts, project=effective.projects, tag=effective.tags)[kind]
+    
+    def _iter_subtrees(self, todos):
+        "All todos in the subtrees of todos, which have to be in file order, each only once."
+        last = None
+        for todo in todos:
+            if last is not None and todo.is_in_subtree_of(last):
+                continue
+            last = todo
+            yield from todo.iter_tree()
+    
+    def _in_file_order(self, todos):
+        "Sorts todos of this subtree by their position, only looking at the siblings of them and their ancestors."
+        parents = dict()
+        for todo in todos:
+            while todo is not self and id(todo._parent) not in parents:
+                parents[id(todo._parent)] = len(todo._parent._children)
+                todo = todo._parent
+        if 2 * sum(parents.values()) >= len(self.index.by_uuid):
+            # finding out the positions would touch about as many todos as walking the whole tree
+            todos = set(todos)
+            return [todo for todo in self.iter_tree() if todo in todos]
+        
+        positions = dict()
+        
+        def position(todo):
+            parent = todo._parent
+            if id(parent) not in positions:
+                positions[id(parent)] = {id(child): index for index, child in enumerate(parent._children)}
+            return positions[id(parent)][id(todo)]
+        
+        def path(todo):
+            path = []
+            while todo is not self:
+                path.append(position(todo))
+                todo = todo._parent
+            return path[::-1]
+        
+        return sorted(todos, key=path)
     
     @property
     def id(self):
-        ids = self.Parser.ID.findall(self.line)
-        assert len(ids) in (0,1), 'Detected more than one ID for this task'
+        "The first id of the line, later ones refer to other tasks, as in 'blocked by #1 and #3'."
+        ids = self.metadata.ids
         if 0 == len(ids):
             return
         return ids[0]
@@ -217,55 +1024,89 @@ class Todo:
     # REFACT consider to remove, self.status should be easier to work with
     @property
     def is_done(self):
-        return bool(self.Parser.IS_DONE.match(self.line)) \
-            or self.has_tags('status:done')
+        metadata = self.metadata
+        return metadata.is_marked_done or 'done' == metadata.tags.get('status')
     
     @property
     def contexts(self):
-        return self.Parser.CONTEXTS.findall(self.line)
+        return list(self.metadata.contexts)
     
     @property
     def projects(self):
-        return self.Parser.PROJECTS.findall(self.line)
+        return list(self.metadata.projects)
     
     @property
     def tags(self):
-        if not self.line:
-            return dict()
-        matches = self.Parser.TAGS.findall(self.line)
-        return dict((
-            match[0],
-            match[1] or match[2] or match[3]
-        ) for match in matches)
+        return dict(self.metadata.tags)
     
     @property
     def status(self):
-        # FIXME find a way to make these status configurable
-        # REFACT consider using is: tag for status because of shortness
-        if self.has_tags('status:'):
-            status = self.tags['status']
-            if status in 'new doing done'.split():
-                return status
-            else:
-                return 'unknown'
-        
-        if self.is_done:
-            return 'done'
-        
-        if self.has_no_tags('status:'):
-            return 'new'
+        return status_of(self.metadata)
     
     def has_children(self):
-        return len(self.children) > 0
+        return bool(self._children)
     
     @property
     def json(self):
+        return self.to_json()
+    
+    def to_json(self, depth=None):
+        """Like json, but with only `depth` levels of children (all if None).
+        
+        Todos below that get an empty list of children, their child_count tells if there are more to fetch.
+        """
+        json = self._json_without_children()
+        if depth is None or depth > 0:
+            child_depth = None if depth is None else depth - 1
+            json['children'] = [child.to_json(child_depth) for child in self._children or ()]
+        else:
+            json['children'] = []
+        return json
+    
+    def iter_flat_json(self, depth=None):
+        """Like to_json(), but yields the todos one by one in file order instead of nesting them.
+        
+        Each refers to its parent by uuid and knows its depth below self, so large boards can be streamed.
+        The todos are read when they are reached, so a tree that changes between them yields them as they are then.
+        Todos removed from the tree before they are reached are left out.
+        """
+        root = self.root
+        stack = [(self, 0)]
+        while stack:
+            todo, level = stack.pop()
+            if todo is not self and todo.root is not root:
+                continue
+            json = todo._json_without_children()
+            json['parent'] = todo._parent.uuid if todo._parent is not None else None
+            json['depth'] = level
+            yield json
+            if todo._children and (depth is None or level < depth):
+                stack.extend((child, level + 1) for child in reversed(todo._children))
+    
+    @property
+    def shallow_json(self):
+        "Like json, but refers to parent and children by uuid instead of including them."
+        json = self._json_without_children()
+        json['parent'] = self._parent.uuid if self._parent is not None else None
+        json['child_uuids'] = [child.uuid for child in self._children or ()]
+        return json
+    
+    @property
+    def inherited_json(self):
+        "The effective_metadata: the contexts, projects and tags that apply to this todo, its own and inherited ones."
+        contexts, projects, tags = self.effective_metadata
+        return dict(contexts=list(contexts), projects=list(projects), tags=dict(tags))
+    
+    def _json_without_children(self):
         if self.is_virtual:
             return dict(
+                uuid=self.uuid,
                 body=self.body,
-                children=[child.json for child in self.children],
+                child_count=len(self._children or ()),
+                rollup=self.rollup.json,
             )
         
+        spans = self.spans # first, so the line is only tokenized once
         return dict(
             uuid=self.uuid,
             line=self.line, 
@@ -276,73 +1117,375 @@ class Todo:
             contexts=self.contexts, 
             projects=self.projects, 
             tags=self.tags,
-            children=[child.json for child in self.children],
+            spans=[[span.kind, span.start, span.end] for span in spans],
+            child_count=len(self._children or ()),
+            rollup=self.rollup.json,
         )
     
+    @property
+    def snapshot_json(self):
+        """Only what from_json() needs to rebuild this subtree with the same uuids.
+        
+        The todos below it are listed flat as [depth, uuid, line, body] in file order, so it is not
+        nested deeper than a few levels, however deep the subtree is, as json and marshal limit that.
+        """
+        json = dict(uuid=self.uuid, line=self._line, body=self.body)
+        if self._children:
+            json['descendants'] = [[depth, todo.uuid, todo._line, todo.body] for todo, depth in self._iter_descendants()]
+        return json
+    
+    def _iter_descendants(self):
+        "(todo, depth) of every todo below this one in file order, without recursion."
+        stack = [(child, 1) for child in reversed(self._children or ())]
+        while stack:
+            todo, depth = stack.pop()
+            yield todo, depth
+            if todo._children:
+                stack.extend((child, depth + 1) for child in reversed(todo._children))
+    
+    @classmethod
+    def from_json(cls, json):
+        """Builds a new subtree from line, body, uuid and children. Everything else is derived from the line.
+        
+        The todos below it can also be given as descendants, like snapshot_json() lists them.
+        Invalid uuids are ignored, the todo gets a fresh one then.
+        """
+        root = cls._from_json_without_children(json)
+        if 'descendants' in json:
+            cls._add_descendants(root, json['descendants'])
+            return root
+        
+        # without recursion, boards can be nested deeper than the recursion limit.
+        # The subtree is not part of a tree yet, so building it top down is cheap.
+        stack = [(root, json)]
+        while stack:
+            todo, todo_json = stack.pop()
+            children_json = list(todo_json.get('children', []))
+            children = [cls._from_json_without_children(child) for child in children_json]
+            todo.children.extend(children)
+            stack.extend(zip(children, children_json))
+        return root
+    
+    @classmethod
+    def _add_descendants(cls, root, descendants):
+        stack = [root]
+        for descendant in descendants:
+            try:
+                depth, uuid, line, body = descendant
+            except (TypeError, ValueError):
+                raise InvalidOperation(f'a descendant has to be [depth, uuid, line, body], not {descendant!r}') from None
+            if not isinstance(depth, int) or not 1 <= depth <= len(stack):
+                raise InvalidOperation(f'a descendant has to be below the one before it, not at depth {depth!r}')
+            todo = cls._from_json_without_children(dict(uuid=uuid, line=line, body=body))
+            del stack[depth:]
+            stack[-1].children.append(todo)
+            stack.append(todo)
+    
+    @classmethod
+    def _from_json_without_children(cls, json):
+        if not isinstance(json, dict):
+            raise InvalidOperation(f'a todo has to be an object, not {json!r}')
+        todo = cls(line=json.get('line'), body=json.get('body'))
+        try:
+            todo._uuid = uuid_to_int(json['uuid'])
+        except (KeyError, ValueError):
+            pass
+        return todo
+    
+    def flattened(self, with_metadata=True):
+        """This subtree as lists of the depth, line, body, uuid and parsed metadata of each todo in file order.
+        
+        Only made of tuples, lists, dicts, strings and ints, so it can be stored by marshal, see parsecache.py.
+        Every line gets parsed, so from_flattened() does not have to. Without metadata, the list of it is None
+        and the lines are parsed on first use after from_flattened(), like after parsing the text.
+        """
+        depths, lines, bodies, uuids, metadata = [], [], [], [], []
+        stack = [(self, 0)]
+        while stack:
+            todo, depth = stack.pop()
+            depths.append(depth)
+            lines.append(todo._line)
+            bodies.append(todo.body)
+            uuids.append(todo.uuid_int)
+            if with_metadata:
+                metadata.append(None if todo._line is None else tuple(todo.metadata[:-1])) # without the spans
+            if todo._children:
+                stack.extend((child, depth + 1) for child in reversed(todo._children))
+        return depths, lines, bodies, uuids, metadata if with_metadata else None
+    
+    @classmethod
+    def from_flattened(cls, depths, lines, bodies, uuids, metadata):
+        "Rebuilds the tree of flattened(), with its uuids and without parsing any line."
+        stack = []
+        if metadata is None:
+            metadata = repeat(False) # parsed on first use, like after Todo()
+        for depth, line, body, uuid_int, line_metadata in zip(depths, lines, bodies, uuids, metadata):
+            # the tree is new and has no index yet, so children can be added without adopting them one by one
+            todo = cls.__new__(cls)
+            todo._parent = todo._index = todo._children = todo._rollup = todo._effective = None
+            todo._line, todo.body, todo._uuid = line, body, uuid_int
+            if line_metadata is False:
+                todo._metadata = None
+            else:
+                todo._metadata = cls.Parser.EMPTY if line_metadata is None else LineMetadata(*line_metadata, spans=None)
+            del stack[depth:]
+            if stack:
+                parent = stack[-1]
+                if parent._children is None:
+                    parent._children = FilterableList(parent)
+                list.append(parent._children, todo)
+                todo._parent = parent
+            stack.append(todo)
+        assert stack, 'nothing to rebuild'
+        return stack[0]
+    
+    def apply_operation(self, operation):
+        """Applies one operation, e.g. dict(action='set_status', uuid='…', status='doing'), to the task in this tree it addresses by uuid.
+        
+        Returns the changed todos, see on_operation().
+        """
+        arguments = dict(operation)
+        action = arguments.pop('action')
+        uuid = arguments.pop('uuid')
+        task = self.task_by_uuid(uuid)
+        if task is None:
+            raise InvalidOperation(f'no task with uuid {uuid}')
+        return task.on_operation(action, **arguments)
+    
+    def apply_recorded_operation(self, operation):
+        """Like apply_operation(), but also describes how to repeat and how to revert it.
+        
+        Returns (changed todos, operation, inverse operation). The returned operation has everything
+        filled in that was left to chance, like uuids and positions of new todos, so applying it
+        to the same tree again has the same result. Applying the inverse afterwards restores the tree,
+        including the uuids of deleted todos.
+        """
+        operation = dict(operation)
+        task = self.task_by_uuid(operation.get('uuid'))
+        if task is None:
+            raise InvalidOperation(f'no task with uuid {operation.get("uuid")}')
+        action = operation.get('action')
+        
+        inverse = None # unknown actions and moving or deleting the root fail below
+        if action in ['change_tag', 'set_status', 'edit_line'] and task.is_virtual:
+            inverse = dict(action='edit_line', uuid=task.uuid, body=task.body) # it can not have a line
+        elif action in ['change_tag', 'set_status', 'edit_line']:
+            inverse = dict(action='edit_line', uuid=task.uuid, line=task.line, body=task.body)
+        elif task.parent is None:
+            pass
+        elif action in ['move']:
+            inverse = dict(action='move', uuid=task.uuid, parent=task.parent.uuid, index=task.parent.children.index(task))
+        elif action in ['delete']:
+            inverse = dict(action='add_child', uuid=task.parent.uuid, index=task.parent.children.index(task), child=task.snapshot_json)
+        
+        changed = self.apply_operation(operation)
+        
+        if action in ['add_child']:
+            child = changed[1]
+            operation.update(child=child.snapshot_json, index=task.children.index(child))
+            inverse = dict(action='delete', uuid=child.uuid)
+        elif action in ['move']:
+            operation.update(index=task.parent.children.index(task))
+        
+        return changed, operation, inverse
+    
     def on_operation(self, operation_name, **json):
+        """Applies one targeted change to this task.
+        
+        Returns the todos that were changed by it. Todos that were removed from the tree are included
+        and can be recognized by no longer sharing the root of the tree, see delta_json().
+        Everything is checked before the tree is changed, so an operation that fails with InvalidOperation changes nothing.
+        """
+        if operation_name in ['change_tag', 'set_status'] and self.is_virtual:
+            raise InvalidOperation(f'can not {operation_name} of the virtual root, it has no line')
+        
         if operation_name in ['change_tag']:
-            self.json = json
+            changed_tags = json.get('tags', {})
+            tags = {**self.tags, **changed_tags}
+            line = self._checked_tag_edit(dict(tags={key: value for key, value in tags.items() if value is not None}), changed_tags)
+            if line != self.line:
+                self.line = line
+            return [self]
+        elif operation_name in ['set_status']:
+            status = json['status']
+            line = self._checked_tag_edit(dict(tags={**self.tags, 'status': status}, is_done='done' == status), dict(status=status))
+            if line != self.line:
+                self.line = line
+            return [self]
+        elif operation_name in ['edit_line']:
+            # its body are the empty lines before the first task, but a line would make it a task of its own
+            if 'line' in json and self.is_virtual:
+                raise InvalidOperation('can not give the virtual root a line')
+            level = self.Parser.indentation_level(self.line)
+            line = indent(self._checked_line(json['line']), level) if 'line' in json else self.line
+            body = self._checked_body(json['body'], level) if 'body' in json else self.body
+            # only changed once everything is known to be valid, so a failing operation changes nothing
+            self.line = line
+            self.body = body
+            return [self]
         elif operation_name in ['add_child']:
-            child = Todo()
-            child.json = json
+            index = self._checked_index(json.get('index'))
+            child = self.from_json(json.get('child', {}))
+            # uuids of the client are kept, unless they are taken already, in the tree or earlier in the subtree
+            seen = set()
+            for each in child.iter_tree():
+                if each._uuid is not None and (each._uuid in seen or each._uuid in self.index.by_uuid):
+                    each._uuid = None
+                seen.add(each.uuid_int)
+            child._indent_subtree(self._child_indentation_level())
+            self._insert_child(index, child)
+            return [self, *child.iter_tree()]
+        elif operation_name in ['move']:
+            new_parent = self.root.task_by_uuid(json['parent'])
+            if new_parent is None:
+                raise InvalidOperation(f'no task with uuid {json["parent"]}')
+            if new_parent.is_in_subtree_of(self):
+                raise InvalidOperation('can not move a task below itself')
+            old_parent = self._parent
+            if old_parent is None:
+                raise InvalidOperation('can not move the root task')
+            index = self._checked_index(json.get('index'))
+            
+            old_parent.children.remove(self)
+            levels = new_parent._child_indentation_level() - self.Parser.indentation_level(self.line)
+            self._shift_indentation(levels)
+            new_parent._insert_child(index, self)
+            return [old_parent, new_parent, *(self.iter_tree() if levels else [self])]
+        elif operation_name in ['delete']:
+            parent = self._parent
+            if parent is None:
+                raise InvalidOperation('can not delete the root task')
+            parent.children.remove(self)
+            return [parent, self]
+        else:
+            raise InvalidOperation(f'operation {operation_name} is not supported')
+    
+    def delta_json(self, changed_todos):
+        "What the client needs to know to apply the result of on_operation() to its copy of this tree."
+        changed, deleted, seen = [], [], set()
+        root = self.root
+        for todo in changed_todos:
+            if id(todo) in seen:
+                continue
+            seen.add(id(todo))
+            
+            if todo.root is root:
+                changed.append(todo.shallow_json)
+            else:
+                deleted.append(todo.uuid)
+        
+        # the counts of everything above the changed todos changed too
+        rollups = dict()
+        for todo in changed_todos:
+            ancestor = todo._parent if todo.root is root else None
+            while ancestor is not None and id(ancestor) not in seen:
+                seen.add(id(ancestor))
+                rollups[ancestor.uuid] = ancestor.rollup.json
+                ancestor = ancestor._parent
+        
+        return dict(changed=changed, deleted=deleted, rollups=rollups)
+    
+    def _child_indentation_level(self):
+        return self.Parser.indentation_level(self.line) + 1
+    
+    @classmethod
+    def _checked_index(cls, index):
+        "index, if children can be inserted there. None appends."
+        if not (index is None or (isinstance(index, int) and not isinstance(index, bool))):
+            raise InvalidOperation(f'an index has to be a number, not {index!r}')
+        return index
+    
+    def _insert_child(self, index, child):
+        if index is None:
             self.children.append(child)
         else:
-            assert False, f'operation {operation_name} is not supported'
+            self.children.insert(index, child)
+    
+    def _indent_subtree(self, level):
+        """Indents the line of this todo to `level` and each todo below one level deeper than its parent.
+        
+        Bodies move along with their line. For new subtrees, whose lines can be indented in any way.
+        """
+        stack = [(self, level)]
+        while stack:
+            todo, todo_level = stack.pop()
+            line = todo._checked_line(todo.line)
+            levels = todo_level - self.Parser.indentation_level(line)
+            todo.line = indent(line, todo_level)
+            if todo.body is not None:
+                todo.body = todo._checked_body(shift_indentation(todo.body, levels), todo_level)
+            stack.extend((child, todo_level + 1) for child in todo._children or ())
+    
+    @classmethod
+    def _checked_line(cls, line):
+        "line, if it stays one line in the file, and is read back as a task."
+        if not isinstance(line, str):
+            raise InvalidOperation(f'a line has to be a string, not {line!r}')
+        if '\n' in line or '\r' in line:
+            raise InvalidOperation('a line can not contain line breaks')
+        if cls.Parser.is_whitespace(line):
+            raise InvalidOperation('a line can not be blank, it would be read back as part of a body')
+        return line
+    
+    def _checked_tag_edit(self, json, tags):
+        """The line as json edits it (see the json setter), if it stays one line and reads back with `tags`.
+        
+        A tag with the value None has to be gone. new and done are written as the done marker or nothing.
+        """
+        line = self._checked_line(self._line_edited_from_json(json))
+        metadata = self.Parser.parse(line)
+        for key, value in tags.items():
+            if 'status' == key and value in ('new', 'done'):
+                is_read_back = status_of(metadata) == value
+            else:
+                is_read_back = metadata.tags.get(key) == value
+            if not is_read_back:
+                raise InvalidOperation(f'the tag {key!r} can not be {value!r}, it would not read back like that')
+        return line
+    
+    @classmethod
+    def _checked_body(cls, body, level):
+        "body, if it is read back as the body of a task on `level`, and not as tasks of its own."
+        if body is None:
+            return body
+        
+        if not isinstance(body, str):
+            raise InvalidOperation(f'a body has to be a string, not {body!r}')
+        for line in body.split('\n'):
+            if not (cls.Parser.is_whitespace(line) or cls.Parser.indentation_level(line) > level + 1):
+                raise InvalidOperation(f'body lines have to be indented by more than {level + 1} levels: {line!r}')
+        return body
+    
+    def _shift_indentation(self, levels):
+        "Moves the lines and bodies of this subtree `levels` indentation levels to the right (or left if negative)."
+        if 0 == levels:
+            return
+        
+        for todo in self.iter_tree():
+            if todo.line is not None:
+                todo.line = shift_indentation(todo.line, levels)
+            if todo.body is not None:
+                todo.body = shift_indentation(todo.body, levels)
     
     @json.setter
     def json(self, json):
         """Updates the line from the json properties
         
-        Currently very basic, in that it only really updates the status
-        Everything else needs to happen later
-        TODO allow updating all parts via json
+        line and body are taken as they are, id, status, tags and is_done are then edited into the line.
         
         To make this method viable, it probably needs that the client files
         minimal update bundles, that are then applied as an update that only changes one aspect?
         Not sure how this is to work with child tasks.
         """
-        # REFACT Gnarly code, not sure how to write this more beautifull
-        
         if 'line' in json:
             self.line = json['line']
         
         if 'body' in json:
             self.body = json['body']
         
-        if 'status' in json:
-            json.setdefault('tags', {})['status'] = json.get('status')
-        
-        if 'id' in json:
-            if json['id'] and not self.id:
-                self.line += f' #{json["id"]}'
-            else:
-                self.edit(remove=f'#{self.id}', replace_with=f" #{json['id']}")
-        
-        if json.get('tags', {}) or self.tags:
-            for existing_key, existing_value in self.tags.items():
-                if existing_key not in json.get('tags', {}) or existing_value != json.get('tags', {}).get(existing_key):
-                    self.edit(remove=f'{existing_key}:{existing_value}') # FIXME handle quoting
-            
-            existing_tags = self.tags
-            for key, value in json.get('tags', {}).items():
-                if key not in existing_tags:
-                    self.line += f' {key}:{value}' # FIXME handle quoting
-        
-            # normalize status tags
-            if self.has_tags('status:new'):
-                self.edit(remove='status:new')
-            
-            if self.has_tags('status:done'):
-                self.edit(remove='status:done')
-                json['is_done'] = True
-        
-        # REFACT Could be that it is signifficantly easier to just reflect the status 
-        # as it's own syntactic ting instead of hijacking tags
-        if 'is_done' in json:
-            if json['is_done'] and not self.is_done:
-                self.line = re.sub(r'(^\s*)(.*$)', r'\1x \2', self.line)
-            elif not json['is_done'] and self.is_done:
-                self.line = re.sub(r'(^\s*)x\s+\b(.*$)', r'\1\2', self.line)
+        line = self._line_edited_from_json(json)
+        if line != self.line:
+            self.line = line
         
         if json.get('children', []):
             json_children = json.get('children', [])
@@ -351,11 +1494,73 @@ class Todo:
                 for _ in range((len(json_children) - len(self.children))):
                     self.children.append(Todo())
             elif len(json_children) < len(self.children):
-                self.children = self.children[:len(json_children)]
+                del self.children[len(json_children):]
             
             for child, child_json in zip(self.children, json_children):
                 child.json = child_json
     
+    def _line_edited_from_json(self, json):
+        """The line with id, tags and done marker changed as described by json, see the json setter.
+        
+        Works on the token spans of the current line, so all changes are spliced in in one pass.
+        """
+        if self.is_virtual:
+            return self.line
+        
+        metadata = self.metadata
+        line = self.line
+        edits, appended = [], []
+        
+        tags = dict(json.get('tags', {}))
+        if 'status' in json:
+            tags['status'] = json['status']
+        
+        if json.get('id'):
+            id_spans = [span for span in self.spans if 'id' == span.kind]
+            if id_spans:
+                edits.append((id_spans[0].start, id_spans[0].end, f'#{json["id"]}'))
+            else:
+                appended.append(f'#{json["id"]}')
+        
+        is_done = json.get('is_done')
+        if tags or metadata.tags:
+            kept = set()
+            for span in self.spans:
+                if 'tag' != span.kind:
+                    continue
+                # normalize status tags, new is the default and done is written as the done marker
+                is_redundant = 'status' == span.key and span.value in ('new', 'done')
+                if span.key not in tags or tags[span.key] != span.value or is_redundant:
+                    edits.append((span.start, span.end, ''))
+                else:
+                    kept.add(span.key)
+            
+            for key, value in tags.items():
+                if 'status' == key and value in ('new', 'done'):
+                    continue
+                if key not in kept:
+                    appended.append(self.Parser.format_tag(key, value))
+            
+            if 'done' == tags.get('status'):
+                is_done = True
+        
+        # REFACT Could be that it is signifficantly easier to just reflect the status 
+        # as it's own syntactic ting instead of hijacking tags
+        if is_done is not None:
+            done_spans = [span for span in self.spans if 'done' == span.kind]
+            if is_done and not done_spans:
+                indentation = len(self.Parser.prefix(line))
+                edits.append((indentation, indentation, 'x '))
+            elif not is_done and done_spans:
+                edits.append((done_spans[0].start, done_spans[0].end, ''))
+        
+        if not edits and not appended:
+            return self.line
+        
+        if appended:
+            edits.append((len(line), len(line), ' ' + ' '.join(appended)))
+        return self.Parser.splice(line, edits)
+    
     def edit(self, remove=None, remove_re=None, replace_with=' '):
         if remove is not None:
             self.line, ignored = re.subn(r'\s+' + re.escape(remove) + r'(\s+|$)', replace_with, self.line)
@@ -378,13 +1583,14 @@ class Todo:
     
     def has_tags(self, *tags):
         "Accepts 'tag:' if the value doesn't matter or 'tag:foo' for specific values"
+        own_tags = self.metadata.tags
         for tag in tags:
             key, value = tag.split(':')
             if value == '': # value doesn't matter:
-                if key not in self.tags:
+                if key not in own_tags:
                     return False
             else:
-                if self.tags.get(key, None) != value:
+                if own_tags.get(key, None) != value:
                     return False
         return True
     
@@ -2,6 +2,10 @@ from todotxt import *
 
 from pyexpect import expect
 from unittest import TestCase
+import io
+import json
+import os
+import sys
 
 class TodoTest(TestCase):
     
@@ -59,7 +63,36 @@ class TodoTest(TestCase):
     def test_id_property(self):
         todo = Todo('foo #23')
         expect(todo.id) == '23'
+        expect(Todo('#4 blocked by #1 and #3').id) == '4'
     
+    def test_parses_line_once_and_reparses_after_changes(self):
+        todo = Todo('foo @context +project tag:value #1')
+        expect(todo.metadata).is_(todo.metadata)
+        expect(todo.metadata.tags) == dict(tag='value')
+
+        todo.tags['tag'] = 'changed'
+        expect(todo.tags) == dict(tag='value')
+
+        todo.line = 'x bar @other'
+        expect(todo.contexts) == ['other']
+        expect(todo.projects) == []
+        expect(todo.is_done).is_true()
+        expect(todo.id).is_none()
+
+        todo.edit(remove='@other')
+        expect(todo.contexts) == []
+
+    def test_leaf_todos_stay_small(self):
+        todo = Todo('leaf')
+        expect(todo).not_has_attr('__dict__')
+        expect(todo.has_children()).is_false()
+        expect(str(todo)) == 'leaf'
+        expect(todo.json['children']) == []
+        expect(todo._children).is_none()
+
+        expect(todo.uuid_int).is_instance(int)
+        expect(todo.uuid) == str(uuid.UUID(int=todo.uuid_int))
+
     def test_empty_todo_knows_it_is_virtual(self):
         todo = Todo()
         expect(todo.is_virtual) == True
@@ -121,13 +154,106 @@ class TodoTest(TestCase):
         # todo.json = dict(body=None, children=[])
         # expect(todo.line) == None
     
+    def test_rebuilds_subtrees_from_json_with_their_uuids(self):
+        task = Todo.from_lines('first\n    child\n        grandchild\n    other child\n            body\nsecond').children[0]
+        snapshot = task.snapshot_json
+        expect(snapshot['descendants'][0]) == [1, task.children[0].uuid, '    child', None]
+        rebuilt = Todo.from_json(snapshot)
+        expect(str(rebuilt)) == str(task)
+        expect([todo.uuid for todo in rebuilt.iter_tree()]) == [todo.uuid for todo in task.iter_tree()]
+        
+        nested = Todo.from_json(dict(line='first', children=[dict(line='    child', children=[dict(line='        grandchild')])]))
+        expect(str(nested)) == 'first\n    child\n        grandchild'
+        for malformed in [dict(descendants=[[2, None, 'too deep', None]]), dict(descendants=['not a todo']), dict(children=['not a todo'])]:
+            with self.assertRaises(InvalidOperation):
+                Todo.from_json(malformed)
+    
+    def test_rebuilds_subtrees_deeper_than_the_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 100
+        task = Todo.from_lines('\n'.join(' ' * Todo.INDENT * level + f'level {level}' for level in range(depth)))
+        expect(str(Todo.from_json(task.snapshot_json))) == str(task)
+        nested = dict(line='deepest')
+        for _ in range(depth):
+            nested = dict(line='level', children=[nested])
+        expect(len(list(Todo.from_json(nested).iter_tree()))) == depth + 1
+    
     def test_id_is_ignored_if_none(self):
         todo = Todo('task id:1')
         todo.json = dict(id=None)
         expect(todo.line) == 'task'
     
+    def test_locates_tokens_in_the_line(self):
+        todo = Todo("    x task #1 @home +garden simple:value single:'with space' double:\"with space\"")
+        expect([(span.kind, todo.line[span.start:span.end]) for span in todo.spans]) == [
+            ('done', 'x'), ('id', '#1'), ('context', '@home'), ('project', '+garden'),
+            ('tag', 'simple:value'), ('tag', "single:'with space'"), ('tag', 'double:"with space"'),
+        ]
+        expect([span.quote for span in todo.spans if 'tag' == span.kind]) == ['', "'", '"']
+        expect(todo.spans[-1]._asdict()).has_subdict(key='double', value='with space')
+        expect(todo.json['spans'][1]) == ['id', 11, 13]
+        
+        expect(todo.metadata).is_(todo.metadata)
+        expect(todo.spans).is_(todo.spans)
+        todo.line = 'changed'
+        expect(todo.spans) == ()
+    
+    def test_edits_quoted_tags(self):
+        todo = Todo("task sprint:'sprint 1' #1")
+        todo.on_operation('change_tag', tags=dict(sprint='sprint 2'))
+        expect(todo.line) == "task #1 sprint:'sprint 2'"
+        expect(todo.tags) == dict(sprint='sprint 2')
+        
+        todo.on_operation('change_tag', tags=dict(sprint=None, owner='me too'))
+        expect(todo.line) == "task #1 owner:'me too'"
+    
+    def test_rejects_tags_that_would_not_read_back(self):
+        root = Todo.from_lines('a\n    b status:doing\nc')
+        b = root.children[0].children[0]
+        for operation, json in [
+            ('change_tag', dict(tags=dict(k='a\n    x injected'))),
+            ('change_tag', dict(tags={'two words': 'value'})),
+            ('change_tag', dict(tags=dict(owner="it's me"))), # quotes can not be read back inside of values
+            ('change_tag', dict(tags=dict(estimate=3))),
+            ('set_status', dict(status='doing\n    x injected')),
+            ('set_status', dict(status='')),
+        ]:
+            with self.assertRaises(InvalidOperation):
+                b.on_operation(operation, **json)
+        expect(str(root)) == 'a\n    b status:doing\nc'
+        
+        b.on_operation('change_tag', tags=dict(status=None, estimate='3'))
+        b.on_operation('set_status', status='blocked')
+        expect(str(Todo.from_lines(str(root)))) == str(root) == 'a\n    b estimate:3 status:blocked\nc'
+    
+    def test_edits_keep_indentation_and_unrelated_tokens_in_place(self):
+        todo = Todo('    status:doing task @home estimate:3 #1')
+        todo.json = dict(tags=dict(estimate='3', status='done'))
+        expect(todo.line) == '    x task @home estimate:3 #1'
+        
+        todo.json = dict(tags=dict(estimate='3'), is_done=False)
+        expect(todo.line) == '    task @home estimate:3 #1'
+    
+    def test_changes_the_line_only_if_needed(self):
+        todo = Todo('task status:doing')
+        spans = todo.spans
+        todo.on_operation('set_status', status='doing')
+        expect(todo.spans).is_(spans)
+    
 
 from textwrap import dedent
+
+EXAMPLE_BOARDS = [
+    '',
+    '\n  \n    \n      ',
+    "first id:1\nx second id:2\nthird id:2346 sprint:'fnordy fnord roughnecks'",
+    '\n\n    \n        \ntask',
+    "first\n    x second\n        third id:2346\n    fourth +project1",
+    'foo id:1\n    bar id:2\n    \n    baz id:3\n\nquoox id:4\n',
+    'task\n        body\n    \n            \n        eats whitespace lines\n    child\n            child body',
+    'task\n            deep body\n    child\n        grandchild\nsecond\n        body\n',
+    'task\n    child\n            body\n        grandchild\n    \n',
+]
+
 class MultipleTodosTest(TestCase):
     
     def setUp(self):
@@ -231,6 +357,22 @@ class MultipleTodosTest(TestCase):
 
         expect(parent.children.tagged.unknown).has_length(2)
     
+    def test_task_states_follow_changes_to_children(self):
+        parent = Todo.from_lines('parent\n    first\n    second status:doing')
+        first, second = parent.children
+        expect(parent.children.tagged.new) == (first,)
+        expect(parent.children.tagged.doing) == (second,)
+        
+        first.line = '    x first'
+        expect(parent.children.tagged.new) == ()
+        expect(parent.children.tagged.done) == (first,)
+        
+        parent.children.append(Todo('    third status:waiting'))
+        expect(parent.children.tagged.unknown).has_length(1)
+        
+        parent.children.remove(second)
+        expect(parent.children.tagged.doing) == ()
+    
     def test_json_serialization(self):
         parent = Todo.from_lines(dedent('''
             parent id:1
@@ -254,6 +396,48 @@ class MultipleTodosTest(TestCase):
         for index, child in enumerate(todo.children):
             expect(recreated_todo.children[index].line) == child.line
     
+    def test_depth_limited_json_counts_the_children_it_leaves_out(self):
+        story = Todo.from_lines(dedent('''
+            story
+                task
+                    subtask
+                        detail
+        '''))
+        expect(story.to_json()) == story.json
+        
+        shallow = story.to_json(depth=1)
+        expect(shallow).has_subdict(line='story', child_count=1)
+        expect(shallow['children'][0]).has_subdict(line='    task', child_count=1, children=[])
+        
+        expect(story.to_json(depth=0)).has_subdict(child_count=1, children=[])
+        expect(story.to_json(depth=2)['children'][0]['children'][0]).has_subdict(line='        subtask', child_count=1, children=[])
+    
+    def test_flat_json_lists_todos_in_file_order_with_parent_and_depth(self):
+        story = Todo.from_lines(dedent('''
+            story
+                first
+                    subtask
+                second
+        '''))
+        flat = list(story.iter_flat_json())
+        expect([(each['line'].strip(), each['depth']) for each in flat]) == [
+            ('story', 0), ('first', 1), ('subtask', 2), ('second', 1)]
+        expect([each['parent'] for each in flat]) == [None, story.uuid, story.children[0].uuid, story.uuid]
+        expect(flat[1]).not_has_key('children')
+        expect(flat[1]).has_subdict(child_count=1)
+        
+        expect([each['line'].strip() for each in story.iter_flat_json(depth=1)]) == ['story', 'first', 'second']
+        expect([each['depth'] for each in story.children[0].iter_flat_json()]) == [0, 1]
+    
+    def test_flat_json_leaves_out_todos_removed_before_they_are_reached(self):
+        story = Todo.from_lines('story\n    first\n        subtask\n    second\n    third')
+        flat = story.iter_flat_json()
+        expect(next(flat)['line']) == 'story'
+        first, second, third = story.children
+        first.on_operation('delete')
+        second.on_operation('edit_line', line='edited')
+        expect([each['line'].strip() for each in flat]) == ['edited', 'third']
+    
     def test_empty_lines_are_attached_as_body_to_tasks(self):
         # Sadly dedent will kill _all_ whitespace in empty lines, so can't use it here
         lines = dedent("""\
@@ -294,6 +478,41 @@ class MultipleTodosTest(TestCase):
         expect(virtual.is_virtual).is_true()
         expect(virtual.body) == '\n\n    \n        '
     
+    def test_streaming_parser_builds_the_same_tree_as_appending_line_by_line(self):
+        def append_line_by_line(lines):
+            root = Todo()
+            for line in lines.split('\n'):
+                root.append_body_or_child(line)
+            return root
+        
+        for lines in EXAMPLE_BOARDS:
+            expected = append_line_by_line(lines)
+            for todo in (Todo.from_lines(lines), Todo.from_stream(io.StringIO(lines))):
+                if todo.is_virtual:
+                    expect(repr(todo)) == repr(expected)
+                else:
+                    expect(repr(todo)) == repr(expected.children[0])
+                expect(str(todo)) == lines
+    
+    def test_writes_back_exactly_what_was_read(self):
+        fixtures = [*EXAMPLE_BOARDS, 'windows\r\n    line endings\r\n', '\ttabs\n    \tand spaces  ']
+        with open(os.path.join(os.path.dirname(__file__), 'todo.txt'), encoding='utf8', newline='') as f:
+            fixtures.append(f.read())
+        
+        for text in fixtures:
+            todo = Todo.from_stream(io.StringIO(text, newline=''))
+            written = io.StringIO(newline='')
+            todo.write_to(written)
+            expect(written.getvalue()) == text
+            expect(str(todo)) == text
+            expect('\n'.join(todo.iter_lines())) == text
+    
+    def test_serializes_trees_deeper_than_the_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 100
+        text = '\n'.join(' ' * Todo.INDENT * level + f'level {level}' for level in range(depth))
+        todo = Todo.from_lines(text)
+        expect(str(todo)) == text
+    
     def _test_expanded_stories_can_be_collapsed(self):
         r"""
         Not sure at all that this is a good idea. How do I want to represent collapsed stories?
@@ -344,7 +563,230 @@ class OperationApplication(TestCase):
         child1 = parent.children[0]
         expect(child1.line).contains('child1')
         expect(parent.task_by_uuid(child1.uuid)) == child1
+
+    def test_index_follows_changes_to_the_tree(self):
+        parent = Todo.from_lines('parent #1\n    child1 #2\n    child2 #3')
+        child1, child2 = parent.children
+        expect(parent.task_by_id(2)).is_(child1)
+        expect(child1.parent).is_(parent)
+
+        parent.on_operation('add_child', child=dict(line='yeehaw'))
+        added = parent.children[-1]
+        expect(added.parent).is_(parent)
+        expect(parent.task_by_uuid(added.uuid)).is_(added)
+
+        child1.children.append(Todo('        grandchild #4'))
+        expect(parent.task_by_id('4').parent).is_(child1)
+        expect(parent.task_by_id('4').root).is_(parent)
+
+        child2.line = '    child2 #5'
+        expect(parent.task_by_id('3')).is_none()
+        expect(parent.task_by_id('5')).is_(child2)
+
+        parent.json = dict(children=[dict(), dict()])
+        expect(parent.children).has_length(2)
+        expect(parent.task_by_uuid(added.uuid)).is_none()
+        expect(added.parent).is_none()
+
+        expect(child1.task_by_uuid(child2.uuid)).is_none()
+
+    def test_queries_the_whole_subtree(self):
+        board = Todo.from_lines(dedent('''
+            story #12
+                first @martin status:doing
+                    nested @martin status:doing sprint:3
+                second @martin
+                x third @martin +garden
+            story #13
+                fourth @martin status:doing sprint:4
+        '''))
+        lines = lambda todos: [todo.line.strip() for todo in todos]
+        story = board.task_by_id(12)
+        
+        expect(lines(story.query(status='doing', contexts=['martin']))) == [
+            'first @martin status:doing', 'nested @martin status:doing sprint:3']
+        expect(lines(board.query(tags=dict(sprint=None)))) == [
+            'nested @martin status:doing sprint:3', 'fourth @martin status:doing sprint:4']
+        expect(lines(board.query(tags=dict(sprint=4)))) == ['fourth @martin status:doing sprint:4']
+        expect(lines(board.query(status='done', projects=['garden']))) == ['x third @martin +garden']
+        expect(lines(board.query(id=13))) == ['story #13']
+        expect(board.query(contexts=['nobody'])) == []
+        expect(story.query()).has_length(4)
+    
+    def test_query_index_follows_changes_to_the_tree(self):
+        story = Todo.from_lines('story\n    first @martin\n    second')
+        first, second = story.children
+        expect(story.query(contexts=['martin'])) == [first]
+        
+        second.on_operation('edit_line', line='second @martin status:doing')
+        first.on_operation('set_status', status='done')
+        expect(story.query(contexts=['martin'])) == [first, second]
+        expect(story.query(status='doing')) == [second]
+        expect(story.query(status='new')) == []
+        
+        story.children.reverse()
+        expect(story.query(contexts=['martin'])) == [second, first]
+        
+        first.on_operation('delete')
+        expect(story.query(contexts=['martin'])) == [second]
+        story.on_operation('add_child', child=dict(line='third @martin', children=[dict(line='fourth @martin')]))
+        expect([todo.line.strip() for todo in story.query(contexts=['martin'])]) == [
+            'second @martin status:doing', 'third @martin', 'fourth @martin']
+    
+    def test_resolves_inherited_contexts_projects_and_tags(self):
+        board = Todo.from_lines(dedent('''
+            epic +release @team sprint:3 status:doing #1
+                story @martin @team
+                    task sprint:4 +docs id:7
+                story
+        '''))
+        epic = board
+        story, other_story = epic.children
+        task = story.children[0]
+        
+        expect(epic.effective_metadata) == (('team',), ('release',), dict(sprint='3', status='doing'))
+        expect(story.effective_metadata) == (('team', 'martin'), ('release',), dict(sprint='3'))
+        expect(task.effective_metadata) == (('team', 'martin'), ('release', 'docs'), dict(sprint='4', id='7'))
+        expect(task.contexts) == []
+        # nothing to add, so nothing is copied
+        expect(other_story.effective_metadata.contexts).is_(epic.effective_metadata.contexts)
+        expect(Todo().effective_metadata) == EffectiveMetadata.EMPTY
+    
+    def test_effective_metadata_follows_changes_above(self):
+        board = Todo.from_lines('epic +release\n    story\n        task\n    other @martin\n        task')
+        story, other = board.children
+        task = story.children[0]
+        expect(task.effective_metadata.projects) == ('release',)
+        
+        cached = task.effective_metadata
+        story.on_operation('set_status', status='doing')
+        expect(task.effective_metadata).is_(cached)
+        
+        board.line = 'epic +later'
+        expect(task.effective_metadata.projects) == ('later',)
+        
+        task.on_operation('move', parent=other.uuid)
+        expect(task.effective_metadata.contexts) == ('martin',)
+        story.children.append(task)
+        expect(task.effective_metadata.contexts) == ()
+        
+        story.children.remove(task)
+        expect(task.effective_metadata) == EffectiveMetadata.EMPTY
+    
+    def test_queries_by_inherited_metadata(self):
+        board = Todo.from_lines(dedent('''
+            epic +release
+                story @martin sprint:3
+                    first
+                    second sprint:4 status:doing
+                story
+                    third +release @martin
+            epic
+                fourth +release
+                    fifth
+        '''))
+        lines = lambda todos: [todo.line.strip() for todo in todos]
+        epic = board.children[0]
+        
+        expect(lines(board.query(projects=['release'], inherited=True))) == [
+            'epic +release', 'story @martin sprint:3', 'first', 'second sprint:4 status:doing', 'story', 'third +release @martin',
+            'fourth +release', 'fifth']
+        expect(lines(board.query(projects=['release'], contexts=['martin'], inherited=True))) == [
+            'story @martin sprint:3', 'first', 'second sprint:4 status:doing', 'third +release @martin']
+        expect(lines(board.query(tags=dict(sprint=3), inherited=True))) == ['story @martin sprint:3', 'first']
+        expect(lines(board.query(status='doing', projects=['release'], inherited=True))) == ['second sprint:4 status:doing']
+        expect(lines(epic.children[0].query(projects=['release'], inherited=True))) == ['first', 'second sprint:4 status:doing']
+        expect(board.query(contexts=['nobody'], inherited=True)) == []
+        expect(lines(board.query(projects=['release']))) == ['epic +release', 'third +release @martin', 'fourth +release']
     
+    def test_rolls_up_the_counts_of_the_whole_subtree(self):
+        board = Todo.from_lines(dedent('''
+            epic +release
+                story @martin
+                    first @martin status:doing
+                    x second +release +release
+                story status:waiting
+        '''))
+        epic = board
+        story = epic.children[0]
+        expect(epic.rollup.json) == dict(
+            total=4,
+            status=dict(new=1, doing=1, done=1, unknown=1),
+            contexts=dict(martin=2),
+            projects=dict(release=1),
+        )
+        expect(story.rollup.json).has_subdict(total=2, status=dict(new=0, doing=1, done=1, unknown=0))
+        expect(story.children[0].rollup.json) == dict(total=0, status=dict(new=0, doing=0, done=0, unknown=0), contexts={}, projects={})
+        expect(epic.json['rollup']) == epic.rollup.json
+        expect(epic.json['children'][0]['rollup']) == story.rollup.json
+    
+    def test_rollups_follow_changes_to_the_tree(self):
+        board = Todo.from_lines(dedent('''
+            epic
+                story @martin
+                    first @martin status:doing
+                        detail +release
+                    second
+                story
+        '''))
+        story, other_story = board.children
+        first, second = story.children
+        expect(board.rollup.total) == 5
+        
+        def expect_recounted():
+            recounted = Todo.from_lines(str(board))
+            expect([todo.rollup.json for todo in board.iter_tree()]) == [todo.rollup.json for todo in recounted.iter_tree()]
+        
+        first.on_operation('set_status', status='done')
+        expect(board.rollup.statuses) == dict(new=4, doing=0, done=1, unknown=0)
+        expect_recounted()
+        
+        second.on_operation('add_child', child=dict(line='nested @martin +release', children=[dict(line='    deeper')]))
+        expect(board.rollup.total) == 7
+        expect(story.rollup.projects) == dict(release=2)
+        expect_recounted()
+        
+        second.on_operation('move', parent=other_story.uuid)
+        expect(story.rollup.total) == 2
+        expect(other_story.rollup.total) == 3
+        expect_recounted()
+        
+        first.on_operation('delete')
+        expect(board.rollup.json) == dict(
+            total=5,
+            status=dict(new=5, doing=0, done=0, unknown=0),
+            contexts=dict(martin=2),
+            projects=dict(release=1),
+        )
+        expect_recounted()
+        
+        other_story.children = []
+        story.line = '    story'
+        expect(board.rollup.json) == dict(total=2, status=dict(new=2, doing=0, done=0, unknown=0), contexts={}, projects={})
+        expect_recounted()
+    
+    def test_deltas_include_the_rollups_above_the_changed_todos(self):
+        board = Todo.from_lines('epic\n    story\n        task\n    other')
+        story = board.children[0]
+        task = story.children[0]
+        board.rollup # counted, as when the board was sent to a client
+        
+        delta = board.delta_json(task.on_operation('set_status', status='doing'))
+        expect(delta['changed'][0]).has_subdict(uuid=task.uuid)
+        expect(delta['rollups']) == {story.uuid: story.rollup.json, board.uuid: board.rollup.json}
+        expect(delta['rollups'][board.uuid]['status']) == dict(new=2, doing=1, done=0, unknown=0)
+    
+    def test_adding_a_child_moves_it_from_its_old_parent(self):
+        parent = Todo.from_lines('parent\n    child1\n        grandchild\n    child2')
+        child1, child2 = parent.children
+        grandchild = child1.children[0]
+        expect(parent.task_by_uuid(grandchild.uuid)).is_(grandchild)
+
+        child2.children.append(grandchild)
+        expect(child1.children).has_length(0)
+        expect(grandchild.parent).is_(child2)
+        expect(parent.task_by_uuid(grandchild.uuid)).is_(grandchild)
+
     def test_apply_change_tag(self):
         todo = Todo('fnord')
         todo.on_operation('change_tag', tags=dict(status='done'))
@@ -355,4 +797,179 @@ class OperationApplication(TestCase):
         todo = Todo('fnord')
         todo.on_operation('add_child', child=dict(line='yeehaw'))
         expect(todo.children).has_length(1)
-        expect(todo.children[0]).line = '    yeehaw'
\ No newline at end of file
+        expect(todo.children[0]).line = '    yeehaw'
+        expect(todo.children[0].line) == '    yeehaw'
+    
+    def test_added_children_keep_valid_unused_uuids_from_the_client(self):
+        todo = Todo.from_lines('parent\n    child')
+        client_uuid = str(uuid.uuid4())
+        todo.on_operation('add_child', child=dict(uuid=client_uuid, line='new'))
+        expect(todo.children[-1].uuid) == client_uuid
+        
+        todo.on_operation('add_child', child=dict(uuid=client_uuid, line='newer'))
+        expect(todo.children[-1].uuid) != client_uuid
+        
+        todo.on_operation('add_child', child=dict(uuid='not a uuid', line='newest'))
+        expect(todo.task_by_uuid(todo.children[-1].uuid)).is_(todo.children[-1])
+        
+        twice = str(uuid.uuid4())
+        todo.on_operation('add_child', child=dict(uuid=twice, line='twin', children=[dict(uuid=twice, line='twin')]))
+        twin = todo.children[-1]
+        expect(twin.uuid) == twice
+        expect(twin.children[0].uuid) != twice
+        expect(todo.task_by_uuid(twin.children[0].uuid)).is_(twin.children[0])
+        twin.children[0].on_operation('delete')
+        expect(todo.task_by_uuid(twice)).is_(twin)
+    
+    def test_change_tag_only_touches_the_given_tags(self):
+        todo = Todo('fnord sprint:1 owner:martin')
+        todo.on_operation('change_tag', tags=dict(sprint='2', owner=None))
+        expect(todo.line) == 'fnord sprint:2'
+    
+    def test_set_status(self):
+        todo = Todo('fnord sprint:1')
+        todo.on_operation('set_status', status='doing')
+        expect(todo.line) == 'fnord sprint:1 status:doing'
+        todo.on_operation('set_status', status='done')
+        expect(todo.line) == 'x fnord sprint:1'
+        todo.on_operation('set_status', status='new')
+        expect(todo.line) == 'fnord sprint:1'
+    
+    def test_edit_line_keeps_indentation(self):
+        parent = Todo.from_lines('parent\n    child')
+        child = parent.children[0]
+        expect(child.on_operation('edit_line', line='edited #3', body='            body')) == [child]
+        expect(str(parent)) == 'parent\n    edited #3\n            body'
+        expect(parent.task_by_id(3)).is_(child)
+    
+    def test_add_child_at_index_with_subtree(self):
+        parent = Todo.from_lines('parent\n    first\n    last')
+        changed = parent.on_operation('add_child', index=1, child=dict(
+            line='middle', body='        body', children=[dict(line='    grandchild')]))
+        expect(str(parent)) == 'parent\n    first\n    middle\n            body\n        grandchild\n    last'
+        middle = parent.children[1]
+        expect(changed) == [parent, middle, middle.children[0]]
+    
+    def test_added_subtrees_are_indented_by_their_depth(self):
+        parent = Todo.from_lines('parent\n    sibling')
+        parent.on_operation('add_child', child=dict(line='new', body='        body', children=[
+            dict(line='kid', children=[dict(line='grandkid', body='        body')]),
+            dict(line='second kid'),
+        ]))
+        expect(str(parent)) == dedent('''
+            parent
+                sibling
+                new
+                        body
+                    kid
+                        grandkid
+                                body
+                    second kid
+        ''').strip()
+        
+        shape = lambda todo: [(each['line'], each['body'], each['depth']) for each in todo.iter_flat_json()]
+        expect(shape(Todo.from_lines(str(parent)))) == shape(parent)
+        
+        with self.assertRaises(InvalidOperation):
+            parent.on_operation('add_child', child=dict(line='new', children=[dict(line='kid', body='not indented')]))
+        expect(parent.children).has_length(2)
+    
+    def test_edit_line_rejects_what_would_not_read_back(self):
+        root = Todo.from_lines('a\n    b\nc')
+        b = root.children[0].children[0]
+        for todo, json in [
+            (root, dict(line='oops')),
+            (b, dict(line='two\nlines')),
+            (b, dict(line=None)),
+            (b, dict(line='    ')),
+            (b, dict(line='edited', body='    not indented enough')),
+            (b, dict(body='        nor this')),
+        ]:
+            with self.assertRaises(InvalidOperation):
+                todo.on_operation('edit_line', **json)
+        expect(str(root)) == 'a\n    b\nc'
+        
+        b.on_operation('edit_line', body='            body\n\n            more')
+        expect(Todo.from_lines(str(root)).children[0].children[0].body) == b.body
+    
+    def test_add_child_rejects_blank_lines(self):
+        root = Todo.from_lines('a\n    b\nc')
+        b = root.children[0].children[0]
+        for child in [dict(), dict(line=''), dict(line='new', children=[dict(body='        only a body')])]:
+            with self.assertRaises(InvalidOperation):
+                b.on_operation('add_child', child=child)
+        expect(str(root)) == 'a\n    b\nc'
+    
+    def test_move_reindents_the_subtree(self):
+        root = Todo.from_lines('first\n    child\n            body\n        grandchild\nsecond')
+        first, second = root.children
+        child = first.children[0]
+        
+        changed = child.on_operation('move', parent=second.uuid, index=0)
+        expect(str(root)) == 'first\nsecond\n    child\n            body\n        grandchild'
+        expect(changed) == [first, second, child]
+        
+        changed = child.on_operation('move', parent=root.uuid, index=0)
+        expect(changed) == [second, root, child, child.children[0]]
+        expect(str(root)) == 'child\n        body\n    grandchild\nfirst\nsecond'
+        
+        with self.assertRaises(InvalidOperation):
+            root.children[0].on_operation('move', parent=child.children[0].uuid)
+    
+    def test_delete(self):
+        root = Todo.from_lines('first\n    child\nsecond')
+        first, second = root.children
+        child = first.children[0]
+        expect(first.on_operation('delete')) == [root, first]
+        expect(str(root)) == 'second'
+        expect(root.task_by_uuid(child.uuid)).is_none()
+    
+    def test_apply_operations_addressed_by_uuid(self):
+        root = Todo.from_lines('first\n    child\nsecond')
+        first, second = root.children
+        child = first.children[0]
+        
+        changed = root.apply_operation(dict(action='set_status', uuid=child.uuid, status='doing'))
+        changed += root.apply_operation(dict(action='delete', uuid=second.uuid))
+        delta = root.delta_json(changed)
+        
+        expect(delta['deleted']) == [second.uuid]
+        expect(delta['changed']).has_length(2)
+        expect(delta['changed'][0]).has_subdict(uuid=child.uuid, parent=first.uuid, status='doing', child_uuids=[])
+        expect(delta['changed'][1]).has_subdict(uuid=root.uuid, child_uuids=[first.uuid])
+        expect(delta['changed'][1]).not_has_key('children')
+        
+        with self.assertRaises(InvalidOperation):
+            root.apply_operation(dict(action='delete', uuid=second.uuid))
+
+    def test_recorded_operations_can_be_repeated_and_reverted(self):
+        text = 'first\n    child\n            body\nsecond status:doing'
+        root = Todo.from_lines(text)
+        first, second = root.children
+        child = first.children[0]
+        operations = [
+            dict(action='add_child', uuid=second.uuid, child=dict(line='new')),
+            dict(action='move', uuid=child.uuid, parent=second.uuid),
+            dict(action='set_status', uuid=second.uuid, status='done'),
+            dict(action='delete', uuid=first.uuid),
+        ]
+        
+        applied, inverses = [], []
+        for operation in operations:
+            changed, recorded, inverse = root.apply_recorded_operation(operation)
+            applied.append(recorded)
+            inverses.append(inverse)
+        changed_text = str(root)
+        expect(changed_text) == 'x second\n    new\n    child\n            body'
+        expect(applied[0]['child']['uuid']) == second.children[0].uuid
+        expect(applied[1]['index']) == 1
+        
+        for inverse in reversed(inverses):
+            root.apply_operation(inverse)
+        expect(str(root)) == text
+        expect([todo.uuid for todo in root.iter_tree()]) == [root.uuid, first.uuid, child.uuid, second.uuid]
+        
+        for operation in applied:
+            root.apply_operation(operation)
+        expect(str(root)) == changed_text
+        expect(second.children[0].uuid) == applied[0]['child']['uuid']
@@ -0,0 +1,310 @@
+"""
+Structural diff between two trees of todos, e.g. the board in memory and todo.txt after someone edited it.
+
+`diff(old, new)` answers the operations (see `Todo.on_operation()`) that turn old into new. Applied to old,
+every task that is still there keeps its uuid, so clients can apply the delta instead of reloading everything.
+
+Todos are matched in passes, each only looking at what the ones before left unmatched:
+
+1. by #id, if it is unique in both trees
+2. among the children of matched parents, by equal lines, then by similar lines between the same matched neighbours
+3. anywhere in the tree by equal lines, which finds tasks that were moved to another parent,
+   followed by 2. again for the children of the newly matched ones
+
+Each pass is linear in the size of the trees, only the similarity of lines is compared quadratically,
+and only for a few neighbouring siblings. Unmatched todos are added, or deleted at the end.
+Children that are already in the right order (the longest increasing subsequence) are not moved.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict, deque
+from difflib import SequenceMatcher
+from itertools import islice
+import operator
+
+from todotxt import Todo, indent, shift_indentation
+
+# How similar two lines have to be to count as an edit of the same task, see difflib.SequenceMatcher.ratio()
+SIMILARITY = 0.6
+# How many unmatched siblings are compared for similarity, further apart counts as delete and insert
+SIMILARITY_WINDOW = 3
+
+def diff(old, new):
+    """The operations that turn the tree of old into the tree of new.
+    
+    None if there are none, because only one of the roots is virtual (a file with only one top level task
+    has that as its root). Lines that are not indented by multiples of Todo.INDENT are indented that way.
+    """
+    if old.is_virtual != new.is_virtual:
+        return None
+    return Patch(old, new, match(old, new)).operations
+
+def match(old, new):
+    "Maps the python id() of new todos to the old todos they are the same task as. The roots always match."
+    matches = {id(new): old}
+    matched_old = {id(old)}
+    
+    def pair(new_todo, old_todo):
+        matches[id(new_todo)] = old_todo
+        matched_old.add(id(old_todo))
+    
+    def match_children(new_parent):
+        old_parent = matches[id(new_parent)]
+        new_children, old_children = children_of(new_parent), children_of(old_parent)
+        # mostly children stay where they are
+        for child, old_child in zip(new_children, old_children):
+            if child.line == old_child.line and id(child) not in matches and id(old_child) not in matched_old:
+                pair(child, old_child)
+        
+        by_line = defaultdict(deque)
+        for child in old_children:
+            if id(child) not in matched_old:
+                by_line[key(child)].append(child)
+        if not by_line:
+            return
+        for child in new_children:
+            candidates = by_line.get(key(child))
+            if id(child) not in matches and candidates:
+                pair(child, candidates.popleft())
+        
+        # similar lines between the same matched neighbours, e.g. after adding a tag
+        positions = {id(child): index for index, child in enumerate(old_children)}
+        start = 0
+        for child in new_children:
+            if id(child) in matches:
+                start = positions.get(id(matches[id(child)]), start - 1) + 1
+                continue
+            best, best_similarity = None, SIMILARITY
+            for candidate in islice(old_children, start, start + SIMILARITY_WINDOW):
+                if id(candidate) in matched_old:
+                    break # the next matched neighbour
+                candidate_similarity = similarity(key(child), key(candidate), best_similarity)
+                if candidate_similarity >= best_similarity:
+                    best, best_similarity = candidate, candidate_similarity
+            if best is not None:
+                pair(child, best)
+                start = positions[id(best)] + 1
+    
+    def match_top_down():
+        for todo in new.iter_tree():
+            if id(todo) in matches and todo.has_children():
+                match_children(todo)
+    
+    old_by_id = unique_ids(old)
+    for id_, todo in unique_ids(new).items():
+        if id_ in old_by_id:
+            pair(todo, old_by_id[id_])
+    
+    match_top_down()
+    
+    old_by_line = defaultdict(deque)
+    for todo in old.iter_tree():
+        if id(todo) not in matched_old:
+            old_by_line[key(todo)].append(todo)
+    moved = 0
+    for todo in new.iter_tree():
+        if id(todo) not in matches and old_by_line.get(key(todo)):
+            pair(todo, old_by_line[key(todo)].popleft())
+            moved += 1
+    
+    if moved:
+        match_top_down()
+    return matches
+
+class Patch:
+    """Builds the operations for matched trees, see diff().
+    
+    The children of the old tree are simulated as plain lists while the operations are generated,
+    as the indexes of later operations depend on the earlier ones.
+    Added todos stand in for themselves, and keep the uuid they have in the new tree.
+    
+    With old_nodes, only part of old is replaced, see reparse.py: the children of new replace the children
+    of old from `offset` on that are among old_nodes, which are the todos of that part. Only those are
+    looked at, moved or deleted, and old itself is not edited.
+    """
+    
+    def __init__(self, old, new, matches, old_nodes=None, offset=0):
+        self.old = old
+        self.new = new
+        self.matches = matches
+        self.matched_old = {id(todo) for todo in matches.values()}
+        self.operations = []
+        self._children = dict()
+        self._parents = dict()
+        self._added = set()
+        self._offsets = dict()
+        self._has_matched_descendants = self._ancestors_of_matches()
+        self._old_nodes = old_nodes
+        if old_nodes is not None:
+            self._children[id(old)] = [todo for todo in old_nodes if todo.parent is old]
+            self._offsets[id(old)] = offset
+        
+        for todo in self._iter_new_tree():
+            if id(todo) not in self.matches and id(todo) not in self._added:
+                continue # added with its whole subtree
+            if not (todo is new and old_nodes is not None):
+                self._update(todo)
+            self._arrange_children(todo)
+        self._delete_unmatched()
+    
+    def _iter_new_tree(self):
+        "The new tree in file order, without the subtrees that are added as a whole."
+        stack = [self.new]
+        while stack:
+            todo = stack.pop()
+            yield todo
+            if id(todo) in self.matches or id(todo) in self._has_matched_descendants:
+                stack.extend(reversed(children_of(todo)))
+    
+    def _ancestors_of_matches(self):
+        ancestors = set()
+        for todo in self.new.iter_tree():
+            if id(todo) not in self.matches:
+                continue
+            parent = todo.parent
+            while parent is not None and id(parent) not in ancestors:
+                ancestors.add(id(parent))
+                parent = parent.parent
+        return ancestors
+    
+    def _partner(self, new_todo):
+        if id(new_todo) in self._added:
+            return new_todo
+        return self.matches[id(new_todo)]
+    
+    def _update(self, new_todo):
+        if id(new_todo) in self._added:
+            return
+        operation = edit_operation(self.matches[id(new_todo)], new_todo)
+        if operation is not None:
+            self.operations.append(operation)
+    
+    def _arrange_children(self, new_parent):
+        desired = children_of(new_parent)
+        if not desired:
+            return
+        parent = self._partner(new_parent)
+        current = self._children_of(parent)
+        if len(current) == len(desired) and all(map(operator.is_, current, map(self._match_of, desired))):
+            return # nothing changed, by far the most common case
+        positions = {id(child): index for index, child in enumerate(current)}
+        in_place = in_order([
+            self.matches[id(child)] for child in desired
+            if id(child) in self.matches and id(self.matches[id(child)]) in positions
+        ], key=lambda todo: positions[id(todo)])
+        
+        previous = None
+        for child in desired:
+            old_child = self.matches.get(id(child))
+            if old_child is not None and id(old_child) in in_place:
+                previous = old_child
+                continue
+            
+            if old_child is not None:
+                self._children_of(self._parent_of(old_child)).remove(old_child)
+            index = 0 if previous is None else current.index(previous) + 1
+            # current is only the replaced part of the children of old, see old_nodes
+            tree_index = index + self._offsets.get(id(parent), 0)
+            if old_child is not None:
+                current.insert(index, old_child)
+                self._parents[id(old_child)] = parent
+                self.operations.append(dict(action='move', uuid=old_child.uuid, parent=parent.uuid, index=tree_index))
+                previous = old_child
+            elif id(child) in self._has_matched_descendants:
+                # only the todo itself, its children are arranged when it is its turn
+                current.insert(index, child)
+                self._added.add(id(child))
+                self._children[id(child)] = []
+                self.operations.append(dict(action='add_child', uuid=parent.uuid, index=tree_index,
+                    child=dict(uuid=child.uuid, line=child.line, body=child.body)))
+                previous = child
+            else:
+                current.insert(index, child)
+                self.operations.append(dict(action='add_child', uuid=parent.uuid, index=tree_index, child=child.snapshot_json))
+                previous = child
+    
+    def _match_of(self, new_todo):
+        return self.matches.get(id(new_todo))
+    
+    def _children_of(self, old_todo):
+        if id(old_todo) not in self._children:
+            self._children[id(old_todo)] = list(children_of(old_todo))
+        return self._children[id(old_todo)]
+    
+    def _parent_of(self, old_todo):
+        return self._parents.get(id(old_todo), old_todo.parent)
+    
+    def _delete_unmatched(self):
+        """Deletes the topmost unmatched todos with their subtrees.
+        
+        Matched todos below them were moved out of their way already, and unmatched todos below those are deleted, too.
+        """
+        for todo in self.old.iter_tree() if self._old_nodes is None else self._old_nodes:
+            if id(todo) not in self.matched_old and id(todo.parent) in self.matched_old:
+                self.operations.append(dict(action='delete', uuid=todo.uuid))
+
+def edit_operation(old_todo, new_todo):
+    "The edit_line operation that gives old_todo the line and body of new_todo, once it is on its level, or None."
+    if old_todo.line == new_todo.line and old_todo.body == new_todo.body:
+        return None # by far the most common case
+    level = Todo.Parser.indentation_level(new_todo.line)
+    old_level = Todo.Parser.indentation_level(old_todo.line)
+    
+    edit = dict()
+    if new_todo.line is not None and indent(old_todo.line, level) != new_todo.line:
+        edit['line'] = new_todo.line
+    # moves shift the body along with the line
+    old_body = old_todo.body if old_todo.body is None else shift_indentation(old_todo.body, level - old_level)
+    if old_body != new_todo.body:
+        edit['body'] = new_todo.body
+    if edit:
+        return dict(action='edit_line', uuid=old_todo.uuid, **edit)
+    return None
+
+def children_of(todo):
+    "Does not create lists of children for leafs, like Todo.children does."
+    return todo.children if todo.has_children() else ()
+
+def key(todo):
+    return todo.line.strip()
+
+def similarity(line, other_line, at_least):
+    "The SequenceMatcher.ratio() of the lines, or 0 if the cheaper upper bounds show it is below at_least."
+    matcher = SequenceMatcher(None, line, other_line, autojunk=False)
+    if matcher.real_quick_ratio() < at_least or matcher.quick_ratio() < at_least:
+        return 0
+    return matcher.ratio()
+
+def unique_ids(root):
+    "The todos below root that have exactly one #id, by id, leaving out ids that are used more than once."
+    by_id, duplicates = dict(), set()
+    for todo in root.iter_tree():
+        if todo is root or 1 != len(todo.metadata.ids):
+            continue
+        id_ = todo.metadata.ids[0]
+        if id_ in by_id:
+            duplicates.add(id_)
+        by_id[id_] = todo
+    for id_ in duplicates:
+        del by_id[id_]
+    return by_id
+
+def in_order(items, key):
+    "The python id()s of a longest subsequence of items whose keys are increasing."
+    tails, tail_indexes, predecessors = [], [], []
+    for index, item in enumerate(items):
+        position = bisect_left(tails, key(item))
+        if position == len(tails):
+            tails.append(key(item))
+            tail_indexes.append(index)
+        else:
+            tails[position] = key(item)
+            tail_indexes[position] = index
+        predecessors.append(tail_indexes[position - 1] if position > 0 else None)
+    
+    result = set()
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        result.add(id(items[index]))
+        index = predecessors[index]
+    return result
@@ -0,0 +1,89 @@
+from unittest import TestCase
+import random
+
+from pyexpect import expect
+
+from todotxt import Todo
+from treediff import diff
+
+class DiffTest(TestCase):
+    
+    def patch(self, old_text, new_text):
+        "Applies the diff to the old tree, returns the operations and the uuids of the old tree by line."
+        old, new = Todo.from_lines(old_text), Todo.from_lines(new_text)
+        uuids = {todo.line.strip(): todo.uuid for todo in old.iter_tree() if todo.line is not None}
+        operations = diff(old, new)
+        for operation in operations:
+            old.apply_operation(operation)
+        expect(str(old)) == new_text
+        self.patched = old
+        return operations, uuids
+    
+    def uuid_of(self, line):
+        for todo in self.patched.iter_tree():
+            if todo.line is not None and todo.line.strip() == line:
+                return todo.uuid
+    
+    def test_equal_trees_need_no_operations(self):
+        text = 'first #1\n    child\n            body\nsecond'
+        expect(self.patch(text, text)[0]) == []
+    
+    def test_edits_lines_and_bodies_in_place(self):
+        operations, uuids = self.patch('first #1\n    child\nsecond', 'first #1 status:doing\n    child\n            body\nsecond')
+        expect(operations) == [
+            dict(action='edit_line', uuid=uuids['first #1'], line='first #1 status:doing'),
+            dict(action='edit_line', uuid=uuids['child'], body='            body'),
+        ]
+    
+    def test_matches_by_id_before_lines(self):
+        operations, uuids = self.patch('story #1\n    task\nstory #2\n    task', 'story #2\n    task\nrenamed story #1\n    task')
+        expect(self.uuid_of('story #2')) == uuids['story #2']
+        expect(self.uuid_of('renamed story #1')) == uuids['story #1']
+        expect([operation['action'] for operation in operations]) == ['move', 'edit_line']
+    
+    def test_matches_similar_lines_in_the_same_position(self):
+        operations, uuids = self.patch('first\n    write the tests\n    write the code', 'first\n    write the tests @martin\n    ship it')
+        expect(self.uuid_of('write the tests @martin')) == uuids['write the tests']
+        expect([operation['action'] for operation in operations]) == ['add_child', 'edit_line', 'delete']
+    
+    def test_moves_only_what_is_out_of_order(self):
+        operations, uuids = self.patch('a\nb\nc\nd\ne', 'b\nc\nd\ne\na')
+        expect(operations) == [dict(action='move', uuid=uuids['a'], parent=self.patched.uuid, index=4)]
+    
+    def test_moves_subtrees_to_other_parents(self):
+        old_text = 'first\n    child\n        grandchild\n                body\nsecond'
+        new_text = 'first\nsecond\n    child\n        grandchild\n                body'
+        operations, uuids = self.patch(old_text, new_text)
+        expect(operations) == [dict(action='move', uuid=uuids['child'], parent=uuids['second'], index=0)]
+    
+    def test_adds_new_parents_around_existing_tasks(self):
+        operations, uuids = self.patch('first\nsecond\nthird', 'first\nnew story\n    new task\n    second\nthird')
+        expect(self.uuid_of('second')) == uuids['second']
+        expect([operation['action'] for operation in operations]) == ['add_child', 'add_child', 'move']
+    
+    def test_deletes_subtrees_after_moving_what_stays_out_of_them(self):
+        operations, uuids = self.patch('first\n    keep me\n    drop me\nsecond\nthird', 'second\n    keep me\nthird')
+        expect(self.uuid_of('keep me')) == uuids['keep me']
+        expect([operation['action'] for operation in operations]) == ['move', 'delete']
+    
+    def test_keeps_leading_empty_lines_of_the_board(self):
+        self.patch('first\nsecond', '\n\nfirst\nsecond')
+    
+    def test_can_not_turn_a_virtual_root_into_a_task(self):
+        expect(diff(Todo.from_lines('first\nsecond'), Todo.from_lines('first'))).is_none()
+    
+    def test_random_edits(self):
+        lines = [f'task {number} #{number}' if number % 3 else f'task {number}' for number in range(60)]
+        generator = random.Random(42)
+        
+        def random_board():
+            result, level = ['first', 'second'], 0
+            for line in generator.sample(lines, generator.randint(0, len(lines))):
+                level = generator.randint(0, level + 1)
+                result.append('    ' * level + line + generator.choice(['', '', ' status:doing']))
+                if generator.random() < 0.1:
+                    result.append('    ' * (level + 2) + 'body')
+            return '\n'.join(result)
+        
+        for _ in range(200):
+            self.patch(random_board(), random_board())